@@ -0,0 +1,25 @@
+# coding: utf-8
+
+# The engine names shared by the benchmark, the differential harness and the command line interface.
+
+import subprocess
+import sys
+
+from transcript_to_genome.benchmark import RUNNERS
+from transcript_to_genome.engines import BENCH_ENGINES, ENGINES, REFERENCE_ENGINES
+
+
+def test_every_runner_is_an_engine():
+
+    assert set(RUNNERS) == set(ENGINES)
+    assert set(BENCH_ENGINES) <= set(ENGINES) and REFERENCE_ENGINES <= set(ENGINES)
+
+
+def test_parser_does_not_load_numpy_or_pandas():
+
+    code = ("import sys; from transcript_to_genome.cli import parse_arguments; "
+            "parse_arguments(['compare', '--engines', 'procedural', 'oop_batch']); "
+            "print(sorted({'numpy', 'pandas'} & set(sys.modules)))")
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+
+    assert output.strip() == '[]'
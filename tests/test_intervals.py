@@ -0,0 +1,44 @@
+# coding: utf-8
+
+# BlockIndex.project() against project_interval(), and the intervals without any block.
+
+from transcript_to_genome.cigar import Alignment
+from transcript_to_genome.intervals import KINDS, BlockIndex, GenomeBlock, project_interval
+from transcript_to_genome.store import AlignmentStore
+
+
+ALIGNMENTS = [
+    ('TR1', 'CHR1', 3, '8M7D6M2I2M11D7M'),
+    ('TR2', 'CHR2', 10, '2S5M3N5M'),
+]
+
+
+def test_project_matches_project_interval():
+
+    index = BlockIndex(AlignmentStore(ALIGNMENTS))
+    queries = [(name, start, end) for name, _, _, _ in ALIGNMENTS for start in range(-2, 34) for end in range(start, 36)]
+
+    transcript_ids = index.transcript_ids([name for name, _, _ in queries])
+    projected = index.project(transcript_ids, [start for _, start, _ in queries], [end for _, _, end in queries])
+
+    alignments = {alignment[0]: Alignment.from_cigar(*alignment) for alignment in ALIGNMENTS}
+    expected = [(row, block) for row, (name, start, end) in enumerate(queries)
+                for block in project_interval(alignments[name], start, end)]
+    blocks = [(row, GenomeBlock(*fields[:4], KINDS[kind])) for row, *fields, kind in zip(*projected)]
+
+    assert blocks == expected
+
+
+def test_project_without_any_block():
+
+    index = BlockIndex(AlignmentStore(ALIGNMENTS))
+    projected = index.project([-1, 0, 1, 0], [0, 40, 5, 10], [4, 50, 5, 2])
+
+    assert all(len(field) == 0 for field in projected)
+
+
+def test_project_without_any_interval():
+
+    projected = BlockIndex(AlignmentStore(ALIGNMENTS)).project([], [], [])
+
+    assert all(len(field) == 0 for field in projected)
@@ -0,0 +1,75 @@
+# coding: utf-8
+
+# read_interned_positions() gives the queries of read_positions() followed by intern_positions().
+
+import pytest
+
+from transcript_to_genome.batch import read_positions
+from transcript_to_genome.join import NameTable, PositionsTokenizer, intern_positions, read_interned_positions
+
+
+HEADER = 'transcript_name\ttranscript_coordinate\n'
+
+PLAIN_LINES = ['TR1\t4', 'TR2\t0', 'TR1\t-1', 'TR3\t13', '', 'TR2\t7\r']
+
+# Lines that pandas reads and the tokenizer does not
+PANDAS_LINES = ['TR1\t+4', 'TR2\t 5 ', '"TR3"\t6', 'TR1\t"7"', 'TR2\t8.0', '" TR 4"\t9']
+
+
+def queries(filename, **options):
+
+    interned = NameTable(['TR1', 'TR2'])
+    tokenized = read_interned_positions(filename, interned, **options)
+
+    expected = NameTable(['TR1', 'TR2'])
+    read = intern_positions(expected, read_positions(filename))
+
+    names = [interned.names[name_id] for name_id in tokenized.transcript_ids.tolist()]
+    assert names == [expected.names[name_id] for name_id in read.transcript_ids.tolist()]
+    assert tokenized.transcript_positions.tolist() == read.transcript_positions.tolist()
+
+    return list(zip(names, tokenized.transcript_positions.tolist()))
+
+
+def write(tmp_path, lines):
+
+    filename = str(tmp_path / 'positions.txt')
+    with open(filename, 'w', newline='') as handle:
+        handle.write(HEADER + ''.join(line + '\n' for line in lines))
+    return filename
+
+
+def test_plain_lines(tmp_path):
+
+    assert queries(write(tmp_path, PLAIN_LINES)) == [
+        ('TR1', 4), ('TR2', 0), ('TR1', -1), ('TR3', 13), ('TR2', 7)]
+
+
+def test_lines_read_by_pandas(tmp_path):
+
+    assert queries(write(tmp_path, PANDAS_LINES)) == [
+        ('TR1', 4), ('TR2', 5), ('TR3', 6), ('TR1', 7), ('TR2', 8), (' TR 4', 9)]
+
+
+def test_blocks_of_both_kinds(tmp_path):
+
+    # With small blocks, only some of the blocks fall back to pandas
+    lines = PLAIN_LINES * 50 + PANDAS_LINES + PLAIN_LINES * 50
+    assert len(queries(write(tmp_path, lines), block_size=64)) == 5 * 100 + len(PANDAS_LINES)
+
+
+def test_tokenizer_grammar():
+
+    tokenizer = PositionsTokenizer(NameTable())
+    assert tokenizer.tokenize(b'TR1\t-12\nTR2\t0\n').transcript_positions.tolist() == [-12, 0]
+
+    for line in (b'TR1\t+4\n', b'TR1\t 4\n', b'TR1\t4.0\n', b'"TR1"\t4\n', b'TR1\n', b'TR1\t4\t5\n'):
+        with pytest.raises(ValueError, match='line 3'):
+            tokenizer.tokenize(b'TR1\t1\nTR2\t2\n' + line)
+
+
+def test_malformed_lines(tmp_path):
+
+    filename = write(tmp_path, PLAIN_LINES + ['TR1\tfour'])
+    with pytest.raises(ValueError, match='line 8 : the coordinate is not an integer'):
+        read_interned_positions(filename, NameTable())
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+# AlignmentIndex.records() rebuilds alignments that map every position as the original ones.
+
+import numpy as np
+
+from transcript_to_genome.batch import AlignmentIndex
+from transcript_to_genome.cigar import Alignment
+from transcript_to_genome.index_file import load_index, write_index
+from transcript_to_genome.reverse import GenomeIndex
+from transcript_to_genome.store import AlignmentStore
+
+
+ALIGNMENTS = [
+    ('TR1', 'CHR1', 10, '3D5M'),
+    ('TR2', 'CHR1', 20, '5M4D'),
+    ('TR3', 'CHR2', 0, '2S3N4M2I3M6D2S'),
+    ('TR4', 'CHR2', 50, '1H2S8M100N4M3S1H'),
+    ('TR5', 'CHR1', 5, '4I'),
+]
+
+
+def rebuilt(index):
+
+    return AlignmentIndex(Alignment.from_cigar(*record) for record in index.records())
+
+
+def assert_same_mappings(index, copy):
+
+    transcript_ids = np.repeat(np.arange(len(index)), 40)
+    transcript_positions = np.tile(np.arange(-5, 35), len(index))
+
+    np.testing.assert_array_equal(copy.starts, index.starts)
+    np.testing.assert_array_equal(copy.genome_lengths, index.genome_lengths)
+    np.testing.assert_array_equal(copy.genome_positions(transcript_ids, transcript_positions),
+                                  index.genome_positions(transcript_ids, transcript_positions))
+
+    # The introns come back as deletions : only the transcripts and positions of the hits are compared
+    genome_index = GenomeIndex(Alignment.from_cigar(*alignment) for alignment in ALIGNMENTS)
+    copy_index = GenomeIndex(Alignment.from_cigar(*record) for record in copy.records())
+    for chromosome in ('CHR1', 'CHR2'):
+        for genome_position in range(-2, 180):
+            assert ([hit[:2] for hit in copy_index.transcripts_at(chromosome, genome_position)]
+                    == [hit[:2] for hit in genome_index.transcripts_at(chromosome, genome_position)])
+
+
+def test_records_keep_the_genome_gaps():
+
+    records = dict((name, cigar) for name, _, _, cigar in AlignmentIndex(
+        Alignment.from_cigar(*alignment) for alignment in ALIGNMENTS).records())
+
+    assert records['TR1'] == '3D5M'
+    assert records['TR2'] == '5M4D'
+    assert records['TR3'] == '2S3D4M2I3M6D2S'
+
+
+def test_records_round_trip():
+
+    index = AlignmentIndex(Alignment.from_cigar(*alignment) for alignment in ALIGNMENTS)
+    assert_same_mappings(index, rebuilt(index))
+
+
+def test_records_round_trip_from_store():
+
+    index = AlignmentIndex.from_store(AlignmentStore(ALIGNMENTS))
+    assert_same_mappings(index, rebuilt(index))
+
+
+def test_records_round_trip_through_index_file(tmp_path):
+
+    filename = str(tmp_path / 'alignments.t2g')
+    write_index(AlignmentIndex(Alignment.from_cigar(*alignment) for alignment in ALIGNMENTS), filename)
+    index = load_index(filename)
+    assert_same_mappings(index, rebuilt(index))
@@ -0,0 +1,71 @@
+# coding: utf-8
+
+# SAM and BGZF-compressed BAM files written by write_sam() / write_bam() and read back.
+
+from transcript_to_genome.compression import bgzf_compress
+from transcript_to_genome.sam import (AlignmentRecord, is_bam_file, is_sam_file, read_bam, read_records,
+                                      read_sam, write_bam, write_sam)
+
+
+RECORDS = [
+    AlignmentRecord('TR1', 'CHR1', 3, '8M7D6M2I2M11D7M'),
+    AlignmentRecord('TR2', 'CHR2', 0, '2S5M3N5M1H'),
+    AlignmentRecord('TR3', 'CHR1', 1 << 20, '4=1X5=2P3M'),
+]
+
+
+def test_sam_round_trip(tmp_path):
+
+    filename = str(tmp_path / 'alignments.sam')
+    write_sam(RECORDS, filename)
+
+    assert is_sam_file(filename) and not is_bam_file(filename)
+    assert list(read_sam(filename)) == RECORDS
+    assert list(read_records(filename)) == RECORDS
+
+
+def test_compressed_sam_round_trip(tmp_path):
+
+    filename = str(tmp_path / 'alignments.sam')
+    write_sam(RECORDS, filename)
+    with open(filename, 'rb') as handle, open(filename + '.gz', 'wb') as compressed:
+        compressed.write(bgzf_compress(handle.read()))
+
+    assert list(read_records(filename + '.gz')) == RECORDS
+
+
+def test_bam_round_trip(tmp_path):
+
+    filename = str(tmp_path / 'alignments.bam')
+    write_bam(RECORDS, filename)
+
+    assert is_bam_file(filename) and not is_sam_file(filename)
+    assert list(read_bam(filename)) == RECORDS
+    assert list(read_records(filename)) == RECORDS
+
+
+def test_skipped_records(tmp_path):
+
+    # Unmapped, without CIGAR, secondary and supplementary records are skipped
+    filename = str(tmp_path / 'alignments.sam')
+    lines = ['@HD\tVN:1.6',
+             'TR1\t0\tCHR1\t4\t255\t5M\t*\t0\t0\t*\t*',
+             'TR2\t4\t*\t0\t0\t*\t*\t0\t0\t*\t*',
+             'TR3\t0\tCHR1\t10\t255\t*\t*\t0\t0\t*\t*',
+             'TR1\t256\tCHR2\t8\t255\t5M\t*\t0\t0\t*\t*',
+             'TR1\t2048\tCHR2\t8\t255\t5M\t*\t0\t0\t*\t*']
+    with open(filename, 'w') as handle:
+        handle.write('\n'.join(lines) + '\n')
+
+    assert list(read_sam(filename)) == [AlignmentRecord('TR1', 'CHR1', 3, '5M')]
+    assert len(list(read_sam(filename, primary_only=False))) == 3
+
+
+def test_bam_round_trip_over_several_bgzf_blocks(tmp_path):
+
+    records = [AlignmentRecord(f"TR{i}", f"CHR{i % 3}", 100 * i, f"{i % 50 + 1}M{i % 7}N3I{i % 11 + 1}M")
+               for i in range(20000)]
+    filename = str(tmp_path / 'alignments.bam')
+    write_bam(records, filename)
+
+    assert list(read_bam(filename)) == records
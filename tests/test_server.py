@@ -0,0 +1,95 @@
+# coding: utf-8
+
+# The mapping server, over a Unix socket : mapping, malformed requests and body size limit.
+
+import asyncio
+import json
+
+from transcript_to_genome.batch import AlignmentIndex
+from transcript_to_genome.cigar import Alignment
+from transcript_to_genome.server import MAX_BODY_SIZE, MappingServer
+
+
+ALIGNMENTS = [
+    ('TR1', 'CHR1', 3, '8M7D6M2I2M11D7M'),
+    ('TR2', 'CHR2', 10, '20M'),
+]
+
+
+async def send(path, request):
+
+    # Sends one raw request and returns the status and the JSON document of the response
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write(request)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    head, _, payload = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(payload)
+
+
+def get(query_string):
+
+    return f"GET /map?{query_string} HTTP/1.1\r\nConnection: close\r\n\r\n".encode()
+
+
+def post(document):
+
+    body = json.dumps(document).encode()
+    return (f"POST /map HTTP/1.1\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode() + body
+
+
+def exchange(tmp_path, *requests):
+
+    # Starts a server on a Unix socket, sends the requests concurrently and returns their responses
+    path = str(tmp_path / 'server.sock')
+
+    async def run():
+        index = AlignmentIndex(Alignment.from_cigar(*alignment) for alignment in ALIGNMENTS)
+        server = await MappingServer(index).start(path=path)
+        async with server:
+            return await asyncio.gather(*(send(path, request) for request in requests))
+
+    return asyncio.run(run())
+
+
+def test_get_and_post(tmp_path):
+
+    (get_status, get_document), (post_status, post_document) = exchange(
+        tmp_path, get('q=TR1:13&q=TR3:0'), post({'queries': [['TR2', 0], ['TR1', 15]]}))
+
+    assert get_status == post_status == 200
+    assert [(result['chromosome'], result['genome_index']) for result in get_document['results']] == [
+        ('CHR1', 23), (None, None)]
+    assert [(result['chromosome'], result['genome_index']) for result in post_document['results']] == [
+        ('CHR2', 10), ('CHR1', None)]
+
+
+def test_positions_must_be_integers(tmp_path):
+
+    requests = [get('q=TR1:4.5'), get('q=TR1:%2B4'), get('q=TR1:%204'), get('q=TR1:'),
+                post({'queries': [['TR1', 4.0]]}), post({'queries': [['TR1', True]]}),
+                post({'queries': [['TR1', '4']]}), post({'queries': [['TR1', 2 ** 63]]})]
+
+    assert [status for status, _ in exchange(tmp_path, *requests)] == [400] * len(requests)
+
+
+def test_malformed_request_does_not_fail_its_batch(tmp_path):
+
+    (bad_status, _), (status, document) = exchange(
+        tmp_path, post({'queries': [['TR1', False]]}), get('q=TR2:5'))
+
+    assert bad_status == 400
+    assert status == 200 and document['results'][0]['genome_index'] == 15
+
+
+def test_malformed_request_line_and_content_length(tmp_path):
+
+    responses = exchange(tmp_path,
+                         b"GET /map\r\n\r\n",
+                         b"POST /map HTTP/1.1\r\nContent-Length: ten\r\n\r\n",
+                         b"POST /map HTTP/1.1\r\nContent-Length: -1\r\n\r\n",
+                         f"POST /map HTTP/1.1\r\nContent-Length: {MAX_BODY_SIZE + 1}\r\n\r\n".encode())
+
+    assert [status for status, _ in responses] == [400, 400, 400, 413]
@@ -0,0 +1,67 @@
+# coding: utf-8
+
+# Optimized transcript to genome coordinate mapping.
+
+# The procedural (version_procedural_programming) and object-oriented
+# (version_oop) versions expand every CIGAR string into one character per
+# base. The modules of this package keep the alignments in a compact
+# run-length form instead, and answer the same queries with the same results.
+
+# Importing the package does no work : every name below is imported from its
+# module the first time it is used (PEP 562), so that NumPy and pandas are
+# only loaded by the code paths that need them. The functions and the class
+# of the two reference versions are available here as well.
+
+import importlib
+
+
+_EXPORTS = {
+    'cigar': ['Alignment', 'Cigar', 'CigarCache', 'cigar_cache', 'parse_cigar', 'read_alignments'],
+    'batch': ['AlignmentIndex', 'map_files', 'map_positions', 'map_queries', 'read_positions'],
+    'join': ['NameTable', 'PositionsTokenizer', 'Queries', 'read_interned_positions'],
+    'compression': ['iter_decompressed', 'open_input'],
+    'streaming': ['map_file_streaming'],
+    'parallel': ['map_file_parallel'],
+    'reverse': ['GenomeIndex', 'TranscriptHit'],
+    'intervals': ['BlockIndex', 'GenomeBlock', 'ProjectedBlocks', 'project_file', 'project_interval'],
+    'server': ['MappingServer'],
+    'sinks': ['open_sink', 'read_binary', 'write_results'],
+    'store': ['AlignmentStore', 'pack_cigar'],
+    'sam': ['AlignmentRecord', 'read_bam', 'read_records', 'read_sam'],
+    'incremental': ['map_files_incremental', 'update_index'],
+    'index_file': ['MappedAlignmentIndex', 'load_index', 'open_alignments', 'write_index'],
+    'instrument': ['Instrumentation', 'instrumented'],
+    'synthetic': ['write_workload'],
+    'benchmark': ['run_benchmark'],
+    'differential': ['compare_engines', 'read_output', 'write_edge_cases'],
+}
+
+_REFERENCE_EXPORTS = {
+    'load_procedural': ['transform_cigar', 'find_transcript_index', 'calculate_genome_position',
+                        'read_transcript_alignments', 'read_nucleotide_positions'],
+    'load_oop': ['transcriptToGenome'],
+}
+
+_modules = {name: module for module, names in _EXPORTS.items() for name in names}
+_reference_loaders = {name: loader for loader, names in _REFERENCE_EXPORTS.items() for name in names}
+
+__all__ = list(_modules) + list(_reference_loaders)
+
+
+def __getattr__(name):
+
+    if name in _modules:
+        value = getattr(importlib.import_module(f'.{_modules[name]}', __name__), name)
+    elif name in _reference_loaders:
+        reference = importlib.import_module('.reference', __name__)
+        value = getattr(getattr(reference, _reference_loaders[name])(), name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,473 @@
+# coding: utf-8
+
+# Vectorized mapping of many transcript positions at once.
+
+# The transcripts of the alignments file are laid end to end on a single
+# "transcript axis" : transcript i occupies the coordinates
+# [transcript_bases[i], transcript_bases[i] + transcript_lengths[i]).
+# The CIGAR blocks that consume transcript nucleotides (M, =, X, I and S) are stored in
+# the same order, as NumPy arrays of their first coordinate on that axis and of
+# their first genome position. Since the blocks of one transcript tile its
+# range exactly, a single np.searchsorted over all the blocks gives, for every
+# query, the block of its own transcript, and the genome positions follow by
+# vectorized arithmetic.
+
+from collections import Counter
+
+import numpy as np
+
+from .cigar import ALIGNED, CONSUMES_GENOME, CONSUMES_TRANSCRIPT, Alignment, cigar_cache, read_alignments
+from .instrument import current
+from .join import NameTable, intern_positions, outer_join, read_interned_positions
+from .store import OPERATION_CODES
+
+
+# Names of the output columns, as in output_genome_positions.txt
+OUTPUT_COLUMNS = ['transcript_name', 'transcript_index', 'chromosome', 'genome_index']
+
+# Value of the genome positions that could not be computed
+UNMAPPED = -1
+
+
+class AlignmentIndex:
+
+    '''
+    The alignments of many transcripts, flattened into NumPy arrays.
+
+    Parameters:
+    -----------
+    alignments : iterable of Alignment
+        The alignments to index. Transcript names must be unique.
+
+    Attributes:
+    -----------
+    transcript_names : numpy.ndarray of object
+        The name of each transcript; the position in this array is the transcript id.
+
+    chromosome_names : list of str
+        The distinct chromosome names, in order of first appearance.
+
+    chromosome_ids : numpy.ndarray of int32
+        For each transcript, the index of its chromosome in chromosome_names.
+
+    starts : numpy.ndarray of int64
+        For each transcript, the genome position of its first nucleotide.
+
+    transcript_lengths : numpy.ndarray of int64
+        For each transcript, the number of nucleotides described by its CIGAR string.
+
+    genome_lengths : numpy.ndarray of int64
+        For each transcript, the number of genome positions spanned by its alignment.
+
+    transcript_bases : numpy.ndarray of int64
+        For each transcript, its first coordinate on the concatenated transcript axis.
+
+    block_starts : numpy.ndarray of int64
+        For each block that consumes transcript nucleotides (M, =, X, I, S), its first
+        coordinate on the concatenated transcript axis.
+
+    block_genome_starts : numpy.ndarray of int64
+        For each aligned block (M, =, X), the genome position of its first nucleotide;
+        UNMAPPED for the insertions and soft clips.
+    '''
+
+    def __init__(self, alignments):
+
+        transcript_names = []
+        chromosome_table = {}
+        chromosome_ids = []
+        starts = []
+        transcript_lengths = []
+        genome_lengths = []
+        block_starts = []
+        block_genome_starts = []
+
+        transcript_base = 0
+
+        for alignment in alignments:
+            transcript_names.append(alignment.transcript_name)
+            chromosome_ids.append(chromosome_table.setdefault(alignment.chromosome, len(chromosome_table)))
+            starts.append(alignment.start)
+            transcript_lengths.append(alignment.transcript_length)
+            genome_lengths.append(alignment.genome_length)
+
+            for length, operation, transcript_offset, genome_offset in zip(
+                    alignment.lengths, alignment.operations,
+                    alignment.transcript_offsets, alignment.genome_offsets):
+                # Deletions, introns, hard clips, padding and empty blocks do not cover any transcript coordinate
+                if length == 0 or operation not in CONSUMES_TRANSCRIPT:
+                    continue
+                block_starts.append(transcript_base + transcript_offset)
+                block_genome_starts.append(alignment.start + genome_offset if operation in ALIGNED else UNMAPPED)
+
+            transcript_base += alignment.transcript_length
+
+        self.transcript_names = np.array(transcript_names, dtype=object)
+        self.chromosome_names = list(chromosome_table)
+        self.chromosome_ids = np.array(chromosome_ids, dtype=np.int32)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.transcript_lengths = np.array(transcript_lengths, dtype=np.int64)
+        self.genome_lengths = np.array(genome_lengths, dtype=np.int64)
+        self.transcript_bases = np.cumsum(self.transcript_lengths) - self.transcript_lengths
+        self.block_starts = np.array(block_starts, dtype=np.int64)
+        self.block_genome_starts = np.array(block_genome_starts, dtype=np.int64)
+
+        self._transcript_ids = {name: transcript_id for transcript_id, name in enumerate(transcript_names)}
+        if len(self._transcript_ids) != len(transcript_names):
+            duplicated = sorted(name for name, count in Counter(transcript_names).items() if count > 1)
+            raise ValueError(f"Duplicated transcript names in the alignments : {duplicated}")
+
+    @classmethod
+    def from_dataframe(cls, df):
+
+        '''
+        Builds the index from a DataFrame returned by read_transcript_alignments().
+        '''
+
+        return cls(Alignment.from_cigar(name, chromosome, start, cigar_string)
+                   for name, chromosome, start, cigar_string in zip(
+                       df['transcript_name'], df['chromosome'],
+                       df['start_transcript_on_genome'], df['cigar_string']))
+
+    @classmethod
+    def from_file(cls, filename):
+
+        '''
+        Builds the index from the file that contains the transcript alignments.
+        '''
+
+        return cls(read_alignments(filename).values())
+
+    @classmethod
+    def from_store(cls, store):
+
+        '''
+        Builds the index from an AlignmentStore, with array operations only.
+        '''
+
+        lengths, codes, transcript_offsets, genome_offsets = store.block_arrays()
+        owners = np.repeat(np.arange(len(store)), np.diff(store.offsets))
+
+        transcript_lengths = np.zeros(len(store), dtype=np.int64)
+        last = store.offsets[1:] > store.offsets[:-1]
+        consumed = np.where(np.isin(codes, [OPERATION_CODES[operation] for operation in CONSUMES_TRANSCRIPT]),
+                            lengths, 0)
+        transcript_lengths[last] = (transcript_offsets + consumed)[store.offsets[1:][last] - 1]
+        genome_lengths = np.zeros(len(store), dtype=np.int64)
+        spanned = np.where(np.isin(codes, [OPERATION_CODES[operation] for operation in CONSUMES_GENOME]), lengths, 0)
+        genome_lengths[last] = (genome_offsets + spanned)[store.offsets[1:][last] - 1]
+
+        index = cls(())
+        index.transcript_names = np.array(store.transcript_names, dtype=object)
+        index.chromosome_names = list(store.chromosome_names)
+        index.chromosome_ids = store.chromosome_ids.copy()
+        index.starts = store.starts.copy()
+        index.transcript_lengths = transcript_lengths
+        index.genome_lengths = genome_lengths
+        index.transcript_bases = np.cumsum(transcript_lengths) - transcript_lengths
+
+        # Deletions, introns, hard clips, padding and empty blocks do not cover any transcript coordinate
+        blocks = (consumed > 0)
+        aligned = np.isin(codes[blocks], [OPERATION_CODES[operation] for operation in ALIGNED])
+        index.block_starts = index.transcript_bases[owners[blocks]] + transcript_offsets[blocks]
+        index.block_genome_starts = np.where(aligned,
+                                             index.starts[owners[blocks]] + genome_offsets[blocks], UNMAPPED)
+
+        index._transcript_ids = dict(store._transcript_ids)
+        return index
+
+    def __len__(self):
+
+        return len(self.transcript_names)
+
+    def transcript_ids(self, transcript_names):
+
+        '''
+        Converts transcript names into transcript ids.
+
+        Parameters:
+        -----------
+        transcript_names : array-like of str
+            The names to look up.
+
+        Returns:
+        --------
+        numpy.ndarray of int64
+            The id of each transcript, or -1 for the names that are not in the index.
+        '''
+
+        transcript_ids = self._transcript_ids
+        return np.fromiter((transcript_ids.get(name, -1) for name in transcript_names),
+                           dtype=np.int64, count=len(transcript_names))
+
+    def records(self):
+
+        '''
+        Rebuilds the (transcript name, chromosome, start, CIGAR string) of every indexed alignment.
+
+        The index only keeps the blocks that cover transcript nucleotides and the genome
+        span of each transcript, so the rebuilt CIGAR strings are equivalent rather than
+        identical : every genome gap, between two aligned blocks or at either end of the
+        alignment, becomes a deletion (D), even if it was an intron (N), the unaligned
+        blocks at either end become soft clips (S), and the hard clips and padding are
+        dropped. The start and the genome span of every alignment are kept.
+
+        Yields:
+        -------
+        (str, str, int, str)
+            One record per transcript, in transcript id order.
+        '''
+
+        transcript_ends = self.transcript_bases + self.transcript_lengths
+        first_blocks = np.searchsorted(self.block_starts, self.transcript_bases, side='left')
+        last_blocks = np.searchsorted(self.block_starts, transcript_ends, side='left')
+
+        for transcript_name, chromosome_id, start, genome_length, first, last, transcript_end in zip(
+                self.transcript_names, self.chromosome_ids.tolist(), self.starts.tolist(),
+                self.genome_lengths.tolist(), first_blocks.tolist(), last_blocks.tolist(),
+                transcript_ends.tolist()):
+
+            block_starts = self.block_starts[first:last].tolist()
+            block_genome_starts = self.block_genome_starts[first:last].tolist()
+            lengths = [end - begin for begin, end in zip(block_starts, block_starts[1:] + [transcript_end])]
+
+            aligned = [block for block, genome_start in enumerate(block_genome_starts) if genome_start != UNMAPPED]
+            cigar = []
+            genome_end = start
+            trailing = []
+            for block, (length, genome_start) in enumerate(zip(lengths, block_genome_starts)):
+                if genome_start == UNMAPPED:
+                    inside = aligned and aligned[0] < block < aligned[-1]
+                    # The soft clips after the last aligned block follow the trailing gap
+                    (trailing if aligned and block > aligned[-1] else cigar).append(
+                        f"{length}{'I' if inside else 'S'}")
+                    continue
+                if genome_start > genome_end:
+                    cigar.append(f"{genome_start - genome_end}D")
+                cigar.append(f"{length}M")
+                genome_end = genome_start + length
+
+            if start + genome_length > genome_end:
+                cigar.append(f"{start + genome_length - genome_end}D")
+
+            yield (str(transcript_name), self.chromosome_names[chromosome_id], start,
+                   ''.join(cigar + trailing) or '0M')
+
+    def genome_positions(self, transcript_ids, transcript_positions):
+
+        '''
+        Calculates the genome positions of many (transcript id, 0-based position) queries.
+
+        Parameters:
+        -----------
+        transcript_ids : array-like of int
+            The transcript id of each query, as returned by transcript_ids(); -1 for unknown transcripts.
+
+        transcript_positions : array-like of int
+            The 0-based position of each query in its transcript.
+
+        Returns:
+        --------
+        numpy.ndarray of int64
+            The genome position of each query, or UNMAPPED when the transcript is unknown,
+            or the position falls in an insertion or outside of the transcript.
+        '''
+
+        transcript_ids = np.asarray(transcript_ids, dtype=np.int64)
+        transcript_positions = np.asarray(transcript_positions, dtype=np.int64)
+
+        genome_positions = np.full(len(transcript_ids), UNMAPPED, dtype=np.int64)
+
+        known = transcript_ids >= 0
+        valid = known.copy()
+        valid[known] = ((transcript_positions[known] >= 0)
+                        & (transcript_positions[known] < self.transcript_lengths[transcript_ids[known]]))
+
+        coordinates = self.transcript_bases[transcript_ids[valid]] + transcript_positions[valid]
+        blocks = np.searchsorted(self.block_starts, coordinates, side='right') - 1
+
+        block_genome_starts = self.block_genome_starts[blocks]
+        genome_positions[valid] = np.where(block_genome_starts == UNMAPPED, UNMAPPED,
+                                           block_genome_starts + coordinates - self.block_starts[blocks])
+
+        return genome_positions
+
+
+def read_positions(filename, chunksize=None):
+
+    '''
+    Reads the file that contains the nucleotide positions.
+
+    Parameters:
+    -----------
+    filename : str
+        The path of the positions file (columns transcript_name and transcript_coordinate),
+        plain or compressed (see compression.open_input()).
+
+    chunksize : int, optional
+        If given, the file is read lazily, chunksize rows at a time.
+
+    Returns:
+    --------
+    pandas.DataFrame, or an iterator of pandas.DataFrame if chunksize is given
+        A DataFrame with the columns transcript_name and transcript_index.
+    '''
+
+    import pandas as pd
+
+    from .compression import detect_compression, open_input
+
+    # pandas only recognizes compressed files by their extension
+    if detect_compression(filename) is not None:
+        filename = open_input(filename, 'rb')
+
+    return pd.read_csv(filename, sep='\t', header=0, names=['transcript_name', 'transcript_index'],
+                       dtype={'transcript_name': str, 'transcript_index': np.int64}, chunksize=chunksize)
+
+
+def map_positions(index, positions, outer=True):
+
+    '''
+    Maps all the nucleotide positions of a DataFrame at once.
+
+    The rows are returned in the order of pd.merge(alignments, positions, how='outer') :
+    sorted by transcript name, with the positions of each transcript in their input order,
+    followed by one row without position for every alignment that has no query.
+
+    Parameters:
+    -----------
+    index : AlignmentIndex
+        The indexed alignments.
+
+    positions : pandas.DataFrame
+        The queries, with the columns transcript_name and transcript_index (0-based).
+
+    outer : bool, optional
+        If False, the alignments without any query are left out of the result.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The columns transcript_name, transcript_index, chromosome and genome_index;
+        the genome index is missing (<NA>) for the positions that do not map.
+    '''
+
+    table = NameTable.for_index(index)
+    return map_queries(index, table, intern_positions(table, positions), outer=outer)
+
+
+def map_queries(index, table, queries, outer=True):
+
+    '''
+    Maps interned queries (see join.read_interned_positions()), as map_positions() does.
+
+    Parameters:
+    -----------
+    index : AlignmentIndex
+        The indexed alignments.
+
+    table : NameTable
+        The table of the query name ids; its first len(index) ids must be the transcript ids.
+
+    queries : join.Queries
+        The name id and the 0-based position of every query.
+
+    outer : bool, optional
+        If False, the alignments without any query are left out of the result.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The same columns as map_positions().
+    '''
+
+    import pandas as pd
+
+    instrumentation = current()
+
+    with instrumentation.stage('join'):
+        rows, name_ids = outer_join(table, len(index), queries.transcript_ids, outer=outer)
+        query_rows = rows >= 0
+
+        # Name ids past the alignments are the transcripts missing from the index
+        transcript_ids = np.where(name_ids < len(index), name_ids, -1)
+
+        transcript_positions = np.zeros(len(rows), dtype=np.int64)
+        transcript_positions[query_rows] = queries.transcript_positions[rows[query_rows]]
+
+    with instrumentation.stage('map'):
+        genome_positions = np.full(len(rows), UNMAPPED, dtype=np.int64)
+        genome_positions[query_rows] = index.genome_positions(transcript_ids[query_rows],
+                                                              transcript_positions[query_rows])
+
+    if instrumentation.enabled:
+        count_queries(instrumentation, index, transcript_ids[query_rows], transcript_positions[query_rows],
+                      genome_positions[query_rows])
+        instrumentation.count('unqueried_alignments', np.count_nonzero(~query_rows))
+
+    # The id -1 of unknown transcripts becomes a missing chromosome
+    chromosome_ids = np.append(index.chromosome_ids, -1)[transcript_ids]
+
+    return pd.DataFrame({
+        'transcript_name': pd.Categorical.from_codes(name_ids, categories=table.categories()),
+        'transcript_index': pd.arrays.IntegerArray(transcript_positions, ~query_rows),
+        'chromosome': pd.Categorical.from_codes(chromosome_ids, categories=index.chromosome_names),
+        'genome_index': pd.arrays.IntegerArray(genome_positions, genome_positions == UNMAPPED),
+    }, columns=OUTPUT_COLUMNS)
+
+
+def count_queries(instrumentation, index, transcript_ids, transcript_positions, genome_positions):
+
+    '''
+    Adds the counters of a batch of mapped queries to an instrumentation : queries,
+    unmapped, unknown_transcripts, out_of_range and insertion_hits (the positions
+    that fall in an insertion or a soft clip).
+    '''
+
+    known = transcript_ids >= 0
+    in_range = known.copy()
+    in_range[known] = ((transcript_positions[known] >= 0)
+                       & (transcript_positions[known] < index.transcript_lengths[transcript_ids[known]]))
+    unmapped = genome_positions == UNMAPPED
+
+    instrumentation.count('queries', len(transcript_ids))
+    instrumentation.count('unmapped', np.count_nonzero(unmapped))
+    instrumentation.count('unknown_transcripts', np.count_nonzero(~known))
+    instrumentation.count('out_of_range', np.count_nonzero(known & ~in_range))
+    instrumentation.count('insertion_hits', np.count_nonzero(in_range & unmapped))
+
+
+def map_files(alignments_filename, positions_filename, output_filename, format=None):
+
+    '''
+    Maps the positions file against the alignments file and writes the results.
+
+    The alignments can also be given as a binary index file written by write_index().
+    The output is a TSV file unless another format is given or guessed from its
+    extension (see sinks.open_sink()).
+    '''
+
+    from .index_file import open_alignments
+    from .sinks import write_results
+
+    instrumentation = current()
+
+    cache_info = cigar_cache.info()
+    with instrumentation.stage('build_index'):
+        index = open_alignments(alignments_filename)
+    instrumentation.count('alignments', len(index))
+    instrumentation.count('cigar_cache_hits', cigar_cache.hits - cache_info.hits)
+    instrumentation.count('cigar_cache_misses', cigar_cache.misses - cache_info.misses)
+
+    # The names of the positions are interned chunk by chunk : the queries are
+    # never held as a column of strings
+    with instrumentation.stage('read_positions'):
+        table = NameTable.for_index(index)
+        queries = read_interned_positions(positions_filename, table)
+
+    results = map_queries(index, table, queries)
+
+    with instrumentation.stage('write'):
+        write_results(results, output_filename, format=format)
+
+    return results
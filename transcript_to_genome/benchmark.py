@@ -0,0 +1,241 @@
+# coding: utf-8
+
+# Benchmark of the procedural, object-oriented and optimized versions.
+
+# A synthetic workload is generated with synthetic.write_workload(), then
+# every engine runs the whole pipeline on it : the time spent in each stage
+# (reading, merging, transform_cigar, find_transcript_index, ...) is
+# measured separately and written to a JSON report, so that the reports of
+# successive runs can be compared to track regressions.
+
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from .batch import map_files
+from .engines import BENCH_ENGINES
+from .instrument import instrumented
+from .reference import load_oop, load_procedural
+from .synthetic import write_workload
+
+
+# The settings of the streaming and parallel runs : small enough to exercise several chunks and tasks
+STREAMING_CHUNKSIZE = 10000
+PARALLEL_WORKERS = 2
+PARALLEL_TASKS = 4
+
+
+def run_procedural(alignments_filename, positions_filename, output_filename):
+
+    '''
+    Runs the pipeline of version_procedural_programming.py (run_pipeline()), timed by its own stages.
+    '''
+
+    with instrumented() as timer:
+        combined_data = load_procedural().run_pipeline(alignments_filename, positions_filename, output_filename)
+
+    return timer, len(combined_data)
+
+
+def run_oop(alignments_filename, positions_filename, output_filename):
+
+    '''
+    Runs the pipeline of version_OOP.py (run_pipeline()), timed by its own stages.
+    '''
+
+    with instrumented() as timer:
+        combined_data = load_oop().run_pipeline(alignments_filename, positions_filename, output_filename)
+
+    return timer, len(combined_data)
+
+
+def run_oop_batch(alignments_filename, positions_filename, output_filename):
+
+    '''
+    Runs the pipeline of version_OOP.py with the positions of each transcript mapped at once (map_positions()).
+    '''
+
+    with instrumented() as timer:
+        combined_data = load_oop().run_pipeline(alignments_filename, positions_filename, output_filename, batch=True)
+
+    return timer, len(combined_data)
+
+
+def run_optimized(alignments_filename, positions_filename, output_filename):
+
+    '''
+    Runs the NumPy batch pipeline of this package (map_files()), timed by its own stages.
+    '''
+
+    with instrumented() as timer:
+        results = map_files(alignments_filename, positions_filename, output_filename)
+
+    return timer, len(results)
+
+
+def _count_rows(filename):
+
+    with open(filename, 'rb') as handle:
+        return sum(1 for _ in handle) - 1
+
+
+def run_streaming(alignments_filename, positions_filename, output_filename, chunksize=STREAMING_CHUNKSIZE):
+
+    '''
+    Runs the streaming mode (map_file_streaming()), a few positions at a time.
+    '''
+
+    from .index_file import open_alignments
+    from .streaming import map_file_streaming
+
+    with instrumented() as timer:
+        with timer.stage('build_index'):
+            index = open_alignments(alignments_filename)
+        map_file_streaming(index, positions_filename, output_filename, chunksize=chunksize,
+                           temporary_directory=os.path.dirname(os.path.abspath(output_filename)))
+
+    return timer, _count_rows(output_filename)
+
+
+def run_parallel(alignments_filename, positions_filename, output_filename, workers=PARALLEL_WORKERS):
+
+    '''
+    Runs the multi-process mode (map_file_parallel()), with the positions file split into several tasks.
+    '''
+
+    from .index_file import open_alignments
+    from .parallel import map_file_parallel
+
+    with instrumented() as timer:
+        with timer.stage('build_index'):
+            index = open_alignments(alignments_filename)
+        map_file_parallel(index, positions_filename, output_filename, workers=workers,
+                          chunk_bytes=os.path.getsize(positions_filename) // PARALLEL_TASKS + 1,
+                          temporary_directory=os.path.dirname(os.path.abspath(output_filename)))
+
+    return timer, _count_rows(output_filename)
+
+
+def run_cached(alignments_filename, positions_filename, output_filename):
+
+    '''
+    Runs the incremental mode (map_files_incremental()) twice : the second run, timed, reads its results from the cache.
+    '''
+
+    from .incremental import map_files_incremental
+
+    with tempfile.TemporaryDirectory(prefix='transcript_to_genome_cache_') as cache_directory:
+        map_files_incremental(alignments_filename, positions_filename, output_filename, cache_directory)
+        with instrumented() as timer:
+            results, _ = map_files_incremental(alignments_filename, positions_filename, output_filename,
+                                               cache_directory)
+
+    return timer, len(results)
+
+
+def run_index_file(alignments_filename, positions_filename, output_filename):
+
+    '''
+    Runs map_files() on a binary index file written by write_index(); writing the index is not timed.
+    '''
+
+    from .index_file import open_alignments, write_index
+
+    with tempfile.TemporaryDirectory(prefix='transcript_to_genome_index_') as directory:
+        index_filename = os.path.join(directory, 'alignments.t2g')
+        write_index(open_alignments(alignments_filename), index_filename)
+        with instrumented() as timer:
+            results = map_files(index_filename, positions_filename, output_filename)
+
+    return timer, len(results)
+
+
+RUNNERS = {'procedural': run_procedural, 'oop': run_oop, 'oop_batch': run_oop_batch, 'optimized': run_optimized,
+           'streaming': run_streaming, 'parallel': run_parallel, 'cached': run_cached,
+           'index_file': run_index_file}
+
+
+def environment():
+
+    '''
+    Describes the machine and the library versions of a benchmark run.
+    '''
+
+    return {
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def run_benchmark(engines=BENCH_ENGINES, directory=None, report_filename=None, **workload):
+
+    '''
+    Generates a synthetic workload and times every stage of the selected engines on it.
+
+    Parameters:
+    -----------
+    engines : iterable of str, optional
+        The engines to run, among the keys of RUNNERS.
+
+    directory : str, optional
+        The directory of the generated files and of the outputs (by default, a temporary one).
+
+    report_filename : str, optional
+        If given, the JSON report is also written to this file.
+
+    **workload :
+        The parameters of synthetic.write_workload() (transcripts, operations, ...).
+
+    Returns:
+    --------
+    dict
+        The report : the workload, the environment, and the seconds per stage of each engine.
+    '''
+
+    with contextlib.ExitStack() as stack:
+        if directory is None:
+            directory = stack.enter_context(tempfile.TemporaryDirectory(prefix='transcript_to_genome_bench_'))
+
+        start = time.perf_counter()
+        alignments_filename, positions_filename = write_workload(directory, **workload)
+        generation_seconds = time.perf_counter() - start
+
+        report = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'workload': dict(workload, generation_seconds=generation_seconds,
+                             alignments_bytes=os.path.getsize(alignments_filename),
+                             positions_bytes=os.path.getsize(positions_filename)),
+            'environment': environment(),
+            'engines': {},
+        }
+
+        for engine in engines:
+            output_filename = os.path.join(directory, f"output_genome_positions_{engine}.txt")
+
+            # The reference versions print a message for every position that does not map
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                timer, rows = RUNNERS[engine](alignments_filename, positions_filename, output_filename)
+
+            report['engines'][engine] = {
+                'stages': timer.stages,
+                'total_seconds': timer.total,
+                'counters': timer.counters,
+                'rows': rows,
+            }
+
+    if report_filename is not None:
+        with open(report_filename, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+    return report
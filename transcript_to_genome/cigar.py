@@ -0,0 +1,384 @@
+# coding: utf-8
+
+# Run-length representation of a transcript alignment.
+
+# Instead of expanding the CIGAR string into one character per base (as
+# transform_cigar / transcriptToGenome.transformCigar do), every operation is
+# kept as a single block together with the number of transcript and genome
+# bases consumed before it :
+
+#    8M7D6M2I2M11D7M
+#
+#    block      : 8M   7D   6M   2I   2M   11D   7M
+#    transcript : 0    8    8    14   16   18    18
+#    genome     : 0    8    15   21   21   23    34
+
+# A transcript position is then resolved with a binary search over the
+# transcript offsets, in O(log number_of_operations), without walking the
+# alignment base by base.
+
+# All the operations of the SAM format are supported :
+#
+#    M = X    aligned nucleotides (match or mismatch) : transcript and genome
+#    I S      insertion, soft clip : transcript only
+#    D N      deletion, skipped region (intron) : genome only
+#    H P      hard clip, padding : neither
+#
+# As in SAM, the start of an alignment is the genome position of its first
+# aligned nucleotide, so a leading soft clip does not shift it.
+
+import re
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+
+from .compression import open_input
+
+
+CIGAR_PATTERN = re.compile(r'(\d+)([MIDNSHP=X])')
+CIGAR_FORMAT = re.compile(r'(?:\d+[MIDNSHP=X])+')
+
+# Operations that consume bases of the transcript and of the genome
+CONSUMES_TRANSCRIPT = frozenset('MIS=X')
+CONSUMES_GENOME = frozenset('MDN=X')
+
+# Operations whose transcript nucleotides are aligned to genome nucleotides
+ALIGNED = frozenset('M=X')
+
+
+def parse_cigar(cigar_string):
+
+    '''
+    Parses a CIGAR string into a list of (length, operation) blocks.
+
+    Unlike transform_cigar(), which skips the operations other than M, I and D,
+    every SAM operation is kept, and malformed strings are rejected.
+
+    Parameters:
+    -----------
+    cigar_string : str
+        The CIGAR string to be parsed (e.g. "8M7D6M2I2M11D7M").
+
+    Returns:
+    --------
+    list of (int, str)
+        One (length, operation) tuple per operation of the CIGAR string.
+
+    Raises:
+    -------
+    ValueError
+        If the string is not a sequence of length and operation pairs.
+
+    Example:
+    --------
+    >>> parse_cigar("8M7D6M2I2M11D7M")
+    [(8, 'M'), (7, 'D'), (6, 'M'), (2, 'I'), (2, 'M'), (11, 'D'), (7, 'M')]
+    '''
+
+    if not isinstance(cigar_string, str) or CIGAR_FORMAT.fullmatch(cigar_string) is None:
+        raise ValueError(f"Malformed CIGAR string {cigar_string!r}")
+
+    return [(int(length), operation) for length, operation in CIGAR_PATTERN.findall(cigar_string)]
+
+
+class Cigar:
+
+    '''
+    The blocks of a parsed CIGAR string, with their cumulative offsets.
+
+    A Cigar does not depend on where the transcript is aligned, so a single
+    (immutable) instance is shared by all the alignments with the same CIGAR string.
+
+    Parameters:
+    -----------
+    blocks : list of (int, str)
+        The (length, operation) blocks, as returned by parse_cigar().
+
+    Attributes:
+    -----------
+    transcript_offsets : tuple of int
+        For each block, the number of transcript nucleotides consumed before the block.
+
+    genome_offsets : tuple of int
+        For each block, the number of genome nucleotides consumed before the block.
+
+    transcript_length : int
+        The number of transcript nucleotides described by the CIGAR string.
+
+    genome_length : int
+        The number of genome nucleotides described by the CIGAR string.
+    '''
+
+    __slots__ = ('lengths', 'operations', 'transcript_offsets', 'genome_offsets',
+                 'transcript_length', 'genome_length')
+
+    def __init__(self, blocks):
+
+        lengths = []
+        operations = []
+        transcript_offsets = []
+        genome_offsets = []
+
+        transcript_offset = 0
+        genome_offset = 0
+
+        for length, operation in blocks:
+            lengths.append(length)
+            operations.append(operation)
+            transcript_offsets.append(transcript_offset)
+            genome_offsets.append(genome_offset)
+
+            if operation in CONSUMES_TRANSCRIPT:
+                transcript_offset += length
+            if operation in CONSUMES_GENOME:
+                genome_offset += length
+
+        self.lengths = tuple(lengths)
+        self.operations = tuple(operations)
+        self.transcript_offsets = tuple(transcript_offsets)
+        self.genome_offsets = tuple(genome_offsets)
+        self.transcript_length = transcript_offset
+        self.genome_length = genome_offset
+
+    @classmethod
+    def parse(cls, cigar_string):
+
+        return cls(parse_cigar(cigar_string))
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class CigarCache:
+
+    '''
+    A bounded cache of parsed CIGAR strings, with least recently used eviction.
+
+    Parameters:
+    -----------
+    maxsize : int, optional
+        The maximum number of CIGAR strings kept in the cache.
+
+    Attributes:
+    -----------
+    hits : int
+        The number of lookups answered from the cache.
+
+    misses : int
+        The number of lookups that had to parse the CIGAR string.
+    '''
+
+    def __init__(self, maxsize=65536):
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cigars = OrderedDict()
+
+    def __len__(self):
+
+        return len(self._cigars)
+
+    def get(self, cigar_string):
+
+        '''
+        Returns the Cigar of a CIGAR string, parsing it only if it is not in the cache.
+        '''
+
+        cigar = self._cigars.get(cigar_string)
+        if cigar is not None:
+            self.hits += 1
+            self._cigars.move_to_end(cigar_string)
+            return cigar
+
+        self.misses += 1
+        cigar = Cigar.parse(cigar_string)
+        if self.maxsize > 0:
+            self._cigars[cigar_string] = cigar
+            if len(self._cigars) > self.maxsize:
+                self._cigars.popitem(last=False)          # Evict the least recently used
+
+        return cigar
+
+    def info(self):
+
+        '''
+        Returns the hits, misses, maximum size and current size of the cache.
+        '''
+
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._cigars))
+
+    def clear(self):
+
+        self._cigars.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# The cache used by Alignment.from_cigar()
+cigar_cache = CigarCache()
+
+
+class Alignment:
+
+    '''
+    The alignment of one transcript on the genome, stored as run-length CIGAR blocks.
+
+    Parameters:
+    -----------
+    transcript_name : str
+        The name of the transcript.
+
+    chromosome : str
+        The chromosome on which the transcript is aligned.
+
+    start : int
+        The genome position that coincides with the first transcript nucleotide.
+
+    blocks : Cigar or list of (int, str)
+        The parsed CIGAR string, or its (length, operation) blocks as returned by parse_cigar().
+
+    The lengths, operations, offsets and lengths of the Cigar are available as
+    attributes of the alignment.
+    '''
+
+    __slots__ = ('transcript_name', 'chromosome', 'start', 'lengths', 'operations',
+                 'transcript_offsets', 'genome_offsets', 'transcript_length', 'genome_length')
+
+    def __init__(self, transcript_name, chromosome, start, blocks):
+
+        self.transcript_name = transcript_name
+        self.chromosome = chromosome
+        self.start = int(start)
+
+        cigar = blocks if isinstance(blocks, Cigar) else Cigar(blocks)
+
+        # References to the (shared) tuples of the Cigar, not copies
+        self.lengths = cigar.lengths
+        self.operations = cigar.operations
+        self.transcript_offsets = cigar.transcript_offsets
+        self.genome_offsets = cigar.genome_offsets
+        self.transcript_length = cigar.transcript_length
+        self.genome_length = cigar.genome_length
+
+    @classmethod
+    def from_cigar(cls, transcript_name, chromosome, start, cigar_string, cache=None):
+
+        '''
+        Builds an Alignment directly from a CIGAR string.
+
+        The CIGAR string is parsed through the cache (cigar_cache by default), so
+        that transcripts with the same CIGAR string share a single parsed Cigar.
+        '''
+
+        cache = cigar_cache if cache is None else cache
+        return cls(transcript_name, chromosome, start, cache.get(cigar_string))
+
+    def __repr__(self):
+
+        return (f"Alignment({self.transcript_name!r}, {self.chromosome!r}, {self.start}, "
+                f"{self.cigar_string!r})")
+
+    def __len__(self):
+
+        return len(self.lengths)
+
+    @property
+    def cigar_string(self):
+
+        '''
+        The CIGAR string rebuilt from the blocks.
+        '''
+
+        return ''.join(f"{length}{operation}" for length, operation in zip(self.lengths, self.operations))
+
+    def find_block(self, transcript_position):
+
+        '''
+        Finds the block that contains a 0-based transcript position.
+
+        The last block whose transcript offset is not larger than the position is
+        the one that contains it : the blocks that consume no transcript nucleotide
+        (deletions, introns, clips, padding and empty blocks) share the offset of
+        the following block and always come before it.
+
+        Parameters:
+        -----------
+        transcript_position : int
+            The 0-based position of the nucleotide in the transcript.
+
+        Returns:
+        --------
+        int
+            The index of the block, or -1 if the position is outside of the transcript.
+        '''
+
+        if transcript_position < 0 or transcript_position >= self.transcript_length:
+            return -1
+
+        return bisect_right(self.transcript_offsets, transcript_position) - 1
+
+    def genome_position(self, transcript_position):
+
+        '''
+        Calculates the genome position of a 0-based transcript position.
+
+        Parameters:
+        -----------
+        transcript_position : int
+            The 0-based position of the nucleotide in the transcript.
+
+        Returns:
+        --------
+        int or None
+            The genome position of the nucleotide, or None if it falls in an insertion,
+            a soft clip or outside of the transcript.
+
+        Example:
+        --------
+        >>> Alignment.from_cigar("TR1", "CHR1", 3, "8M7D6M2I2M11D7M").genome_position(13)
+        23
+        '''
+
+        block = self.find_block(transcript_position)
+        if block < 0 or self.operations[block] not in ALIGNED:
+            return None
+
+        return self.start + self.genome_offsets[block] + transcript_position - self.transcript_offsets[block]
+
+
+def read_alignments(filename):
+
+    '''
+    Reads the file that contains the transcript alignments into Alignment objects.
+
+    The file has the same 4 tab-separated columns (with a header line) as the
+    input of read_transcript_alignments() : transcript_name, chromosome,
+    transcript_start and cigar_string.
+
+    Parameters:
+    -----------
+    filename : str
+        The path of the alignments file, plain or compressed (see compression.open_input()).
+
+    Returns:
+    --------
+    dict
+        The Alignment of each transcript, keyed by transcript name.
+    '''
+
+    alignments = {}
+
+    with open_input(filename, 'rt') as handle:
+        next(handle, None)                        # Skip the header line
+        for line_number, line in enumerate(handle, start=2):
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            try:
+                transcript_name, chromosome, start, cigar_string = line.split('\t')[:4]
+                alignments[transcript_name] = Alignment.from_cigar(transcript_name, chromosome, int(start),
+                                                                   cigar_string)
+            except ValueError as error:
+                raise ValueError(f"{filename}, line {line_number} : {error}") from None
+
+    return alignments
@@ -0,0 +1,232 @@
+# coding: utf-8
+
+# Command line interface :
+#
+#    python -m transcript_to_genome map input_transcripts_alignments.txt input_transcripts_positions.txt output_genome_positions.txt
+#    python -m transcript_to_genome build-index input_transcripts_alignments.txt alignments.t2g
+#    python -m transcript_to_genome locate input_transcripts_alignments.txt CHR1:23
+#    python -m transcript_to_genome project input_transcripts_alignments.txt intervals.txt genome_blocks.txt
+#    python -m transcript_to_genome serve input_transcripts_alignments.txt --port 8080
+#    python -m transcript_to_genome bench --transcripts 1000 --queries-per-transcript 10 --report bench.json
+#    python -m transcript_to_genome compare --report compare.json
+
+# The modules of each command are imported when the command runs, so that
+# the interface starts without loading NumPy or pandas.
+
+import argparse
+import json
+
+from .engines import BENCH_ENGINES, CASES, ENGINES
+
+
+# The output formats of the map command (see sinks.open_sink)
+FORMATS = ('tsv', 'binary', 'arrow', 'parquet')
+
+
+def parse_arguments(argv=None):
+
+    parser = argparse.ArgumentParser(prog='python -m transcript_to_genome',
+                                     description='Maps transcript positions to genome positions.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    map_parser = subparsers.add_parser('map', help='map a positions file against an alignments file')
+    map_parser.add_argument('alignments', help='the transcript alignments file (4 columns, tab-separated), a SAM or '
+                                               'BAM file, or a binary index file written by build-index')
+    map_parser.add_argument('positions', help='the nucleotide positions file (2 columns, tab-separated)')
+    map_parser.add_argument('output', help='the output file (tab-separated)')
+    map_parser.add_argument('--chunksize', type=int, default=None,
+                            help='stream the positions file, mapping this many positions at a time')
+    map_parser.add_argument('--workers', type=int, default=1,
+                            help='map the positions file with this many worker processes')
+    map_parser.add_argument('--tmpdir', default=None,
+                            help='the directory of the temporary files written when streaming')
+    map_parser.add_argument('--format', choices=FORMATS, default=None,
+                            help='the format of the output file (by default, guessed from its extension: '
+                                 '.bin, .arrow, .parquet, otherwise tsv)')
+    map_parser.add_argument('--cache', default=None,
+                            help='keep the index and the results in this directory, and update them incrementally '
+                                 'when the alignments change')
+    map_parser.add_argument('--summary', default=None,
+                            help='write the JSON summary of the run (stage times and counters) to this file')
+    map_parser.add_argument('--profile', action='store_true',
+                            help='profile the run with cProfile and add the slowest functions to the summary')
+    map_parser.add_argument('--trace-memory', action='store_true',
+                            help='trace the allocations with tracemalloc and add the peak memory to the summary')
+
+    index_parser = subparsers.add_parser('build-index', help='write the binary index of an alignments file')
+    index_parser.add_argument('alignments', help='the transcript alignments file (4 columns, tab-separated), '
+                                                 'or a SAM or BAM file')
+    index_parser.add_argument('index', help='the binary index file to write')
+
+    locate_parser = subparsers.add_parser('locate', help='find the transcripts that cover genome positions')
+    locate_parser.add_argument('alignments', help='the transcript alignments file (4 columns, tab-separated), a SAM '
+                                                  'or BAM file, or a binary index file written by build-index')
+    locate_parser.add_argument('loci', nargs='+', help='the genome positions, as CHROMOSOME:POSITION')
+
+    project_parser = subparsers.add_parser('project', help='project transcript intervals onto genome blocks')
+    project_parser.add_argument('alignments', help='the transcript alignments file (4 columns, tab-separated), a SAM '
+                                                   'or BAM file, or a binary index file written by build-index')
+    project_parser.add_argument('intervals', help='the intervals file (columns transcript_name, start and end, '
+                                                  '0-based and half-open, tab-separated)')
+    project_parser.add_argument('output', help='the output file (tab-separated), one line per genome block')
+
+    serve_parser = subparsers.add_parser('serve', help='serve position lookups over HTTP, with an index kept in memory')
+    serve_parser.add_argument('alignments', help='the transcript alignments file (4 columns, tab-separated), a SAM or '
+                                                 'BAM file, or a binary index file written by build-index')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='the address to listen on')
+    serve_parser.add_argument('--port', type=int, default=8080, help='the port to listen on')
+    serve_parser.add_argument('--unix', default=None, help='listen on this Unix socket instead of a TCP port')
+    serve_parser.add_argument('--max-delay', type=float, default=1.0,
+                              help='the longest time, in milliseconds, a query waits for its batch')
+    serve_parser.add_argument('--max-batch-size', type=int, default=65536,
+                              help='the number of queries that triggers the mapping of a batch')
+
+    bench_parser = subparsers.add_parser('bench', help='time every stage of the versions on a synthetic workload')
+    bench_parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(BENCH_ENGINES),
+                              help='the versions to run')
+    bench_parser.add_argument('--transcripts', type=int, default=1000, help='the number of transcripts')
+    bench_parser.add_argument('--operations', type=int, default=9, help='the number of operations per CIGAR string')
+    bench_parser.add_argument('--match-length', type=int, default=100, help='the mean length of the match blocks')
+    bench_parser.add_argument('--indel-length', type=int, default=5, help='the maximum length of the indels')
+    bench_parser.add_argument('--intron-length', type=int, default=1000, help='the mean length of the introns')
+    bench_parser.add_argument('--intron-fraction', type=float, default=0.5, help='the fraction of gaps that are introns')
+    bench_parser.add_argument('--queries-per-transcript', type=int, default=10,
+                              help='the number of positions queried per transcript')
+    bench_parser.add_argument('--chromosomes', type=int, default=4, help='the number of chromosomes')
+    bench_parser.add_argument('--seed', type=int, default=0, help='the seed of the random number generator')
+    bench_parser.add_argument('--directory', default=None,
+                              help='keep the generated files and outputs in this directory')
+    bench_parser.add_argument('--report', default=None, help='write the JSON report to this file')
+
+    compare_parser = subparsers.add_parser('compare', help='check that the versions give the same genome positions, '
+                                                           'and compare their speed and memory')
+    compare_parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES),
+                                help='the versions to run; the outputs are compared with the one of the first')
+    compare_parser.add_argument('--cases', nargs='*', choices=CASES, default=list(CASES),
+                                help='the built-in inputs to run')
+    compare_parser.add_argument('--input', nargs=2, action='append', default=[], metavar=('ALIGNMENTS', 'POSITIONS'),
+                                help='also run these alignments and positions files (can be repeated)')
+    compare_parser.add_argument('--transcripts', type=int, default=200,
+                                help='the number of transcripts of the synthetic input')
+    compare_parser.add_argument('--queries-per-transcript', type=int, default=10,
+                                help='the number of positions queried per transcript of the synthetic input')
+    compare_parser.add_argument('--seed', type=int, default=0, help='the seed of the synthetic input')
+    compare_parser.add_argument('--no-memory', action='store_true',
+                                help='run every version once, without measuring its peak memory')
+    compare_parser.add_argument('--directory', default=None,
+                                help='keep the generated files and outputs in this directory')
+    compare_parser.add_argument('--report', default=None, help='write the JSON report to this file')
+
+    arguments = parser.parse_args(argv)
+
+    # The streaming and parallel modes merge sorted text runs into the output
+    if (arguments.command == 'map' and arguments.format not in (None, 'tsv')
+            and (arguments.chunksize or arguments.workers > 1)):
+        parser.error('--chunksize and --workers only write TSV output')
+
+    # The incremental mode updates results held in memory
+    if arguments.command == 'map' and arguments.cache and (arguments.chunksize or arguments.workers > 1):
+        parser.error('--cache cannot be combined with --chunksize or --workers')
+
+    return arguments
+
+
+def map_command(arguments):
+
+    from .index_file import open_alignments
+    from .instrument import current
+
+    if arguments.cache:
+        from .incremental import map_files_incremental
+
+        map_files_incremental(arguments.alignments, arguments.positions, arguments.output, arguments.cache,
+                              format=arguments.format)
+    elif arguments.workers > 1:
+        from .parallel import map_file_parallel
+
+        with current().stage('build_index'):
+            index = open_alignments(arguments.alignments)
+        map_file_parallel(index, arguments.positions, arguments.output,
+                          workers=arguments.workers, temporary_directory=arguments.tmpdir)
+    elif arguments.chunksize:
+        from .streaming import map_file_streaming
+
+        with current().stage('build_index'):
+            index = open_alignments(arguments.alignments)
+        map_file_streaming(index, arguments.positions, arguments.output,
+                           chunksize=arguments.chunksize, temporary_directory=arguments.tmpdir)
+    else:
+        from .batch import map_files
+
+        map_files(arguments.alignments, arguments.positions, arguments.output, format=arguments.format)
+
+
+def main(argv=None):
+
+    arguments = parse_arguments(argv)
+
+    if arguments.command == 'map':
+        if arguments.summary or arguments.profile or arguments.trace_memory:
+            from .instrument import instrumented
+
+            # Without --summary, the summary of --profile or --trace-memory goes to stderr
+            with instrumented(profile=arguments.profile, trace_memory=arguments.trace_memory) as instrumentation:
+                map_command(arguments)
+            instrumentation.write(arguments.summary, command='map', alignments=arguments.alignments,
+                                  positions=arguments.positions, output=arguments.output,
+                                  workers=arguments.workers, chunksize=arguments.chunksize, cache=arguments.cache)
+        else:
+            map_command(arguments)
+
+    elif arguments.command == 'build-index':
+        from .index_file import open_alignments, write_index
+
+        write_index(open_alignments(arguments.alignments), arguments.index)
+
+    elif arguments.command == 'bench':
+        from .benchmark import run_benchmark
+
+        report = run_benchmark(
+            engines=arguments.engines, directory=arguments.directory, report_filename=arguments.report,
+            transcripts=arguments.transcripts, operations=arguments.operations,
+            match_length=arguments.match_length, indel_length=arguments.indel_length,
+            intron_length=arguments.intron_length, intron_fraction=arguments.intron_fraction,
+            queries_per_transcript=arguments.queries_per_transcript, chromosomes=arguments.chromosomes,
+            seed=arguments.seed)
+        if arguments.report is None:
+            print(json.dumps(report, indent=2))
+
+    elif arguments.command == 'compare':
+        from .differential import compare_engines, format_report
+
+        report = compare_engines(
+            engines=arguments.engines, cases=arguments.cases, inputs=arguments.input,
+            directory=arguments.directory, report_filename=arguments.report,
+            trace_memory=not arguments.no_memory, transcripts=arguments.transcripts,
+            queries_per_transcript=arguments.queries_per_transcript, seed=arguments.seed)
+        print(format_report(report))
+        return 0 if report['passed'] else 1
+
+    elif arguments.command == 'serve':
+        from .index_file import open_alignments
+        from .server import serve
+
+        serve(open_alignments(arguments.alignments), host=arguments.host, port=arguments.port, path=arguments.unix,
+              max_delay=arguments.max_delay / 1000, max_batch_size=arguments.max_batch_size)
+
+    elif arguments.command == 'project':
+        from .intervals import project_file
+
+        project_file(arguments.alignments, arguments.intervals, arguments.output)
+
+    elif arguments.command == 'locate':
+        from .reverse import GenomeIndex
+
+        index = GenomeIndex.from_file(arguments.alignments)
+        print('locus\ttranscript_name\ttranscript_index\tkind')
+        for locus in arguments.loci:
+            for hit in index.locate(locus):
+                print(f"{locus}\t{hit.transcript_name}\t{hit.transcript_position}\t{hit.kind}")
+
+    return 0
+
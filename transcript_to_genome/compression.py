@@ -0,0 +1,297 @@
+# coding: utf-8
+
+# Reading of plain, gzip, BGZF and zstd-compressed input files.
+
+# The format is recognized from the first bytes of the file, not from its
+# extension. The decompressed data is produced as a series of bytes blocks :
+#
+#    plain   the file is read in blocks.
+#    gzip    a gzip stream can only be inflated from its start : one thread
+#            inflates it while the caller parses the previous blocks.
+#    BGZF    the gzip variant of BAM files and of bgzip : a series of
+#            independent gzip members of at most 64 KiB, each giving its own
+#            size in the BC extra subfield. Batches of members are inflated by a
+#            pool of threads, in parallel (zlib releases the GIL), and the
+#            blocks are produced in file order.
+#    zstd    inflated by one thread, as gzip; it needs the zstandard package.
+
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# The size of the blocks read from the file
+READ_SIZE = 4 * 1024 * 1024
+
+# The number of decompressed blocks a decompression thread runs ahead of the caller
+PREFETCH_BLOCKS = 4
+
+# A BGZF block holds at most 64 KiB; its header carries the block size in the BC extra subfield
+BGZF_BLOCK_DATA = 0xff00
+BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# The number of BGZF blocks inflated by one task of the thread pool (about 4 MiB)
+BGZF_BATCH_BLOCKS = 64
+
+
+def detect_compression(filename):
+
+    '''
+    Returns the compression of a file : 'bgzf', 'gzip', 'zstd' or None.
+    '''
+
+    with open(filename, 'rb') as handle:
+        header = handle.read(BGZF_HEADER.size)
+
+    if header.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    if not header.startswith(GZIP_MAGIC):
+        return None
+    if len(header) == BGZF_HEADER.size and _bgzf_block_size(header) is not None:
+        return 'bgzf'
+    return 'gzip'
+
+
+def _bgzf_block_size(header):
+
+    # The total size of the BGZF block that starts with header, or None if it is not a BGZF header
+    (id1, id2, method, flags, _, _, _, extra_length, subfield_1, subfield_2,
+     subfield_length, block_size) = BGZF_HEADER.unpack(header)
+    if (id1, id2, method) != (0x1f, 0x8b, 8) or not flags & 4 or extra_length != 6 \
+            or (subfield_1, subfield_2, subfield_length) != (66, 67, 2):
+        return None
+    return block_size + 1
+
+
+def _read_blocks(handle):
+
+    for block in iter(lambda: handle.read(READ_SIZE), b''):
+        yield block
+
+
+def _inflate_gzip(handle):
+
+    # Inflates the members of a gzip file one after the other
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    for block in _read_blocks(handle):
+        while block:
+            data = decompressor.decompress(block)
+            if data:
+                yield data
+            block = decompressor.unused_data
+            if decompressor.eof:
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            else:
+                block = b''
+
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def _inflate_zstd(handle):
+
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstandard is required to read zstd-compressed files") from None
+
+    reader = zstandard.ZstdDecompressor().stream_reader(handle, read_across_frames=True)
+    yield from _read_blocks(reader)
+
+
+def _inflate_bgzf_batch(raw_blocks):
+
+    # Inflates a batch of BGZF blocks (the raw deflate data of each block)
+    return b''.join(zlib.decompress(raw, -zlib.MAX_WBITS) for raw in raw_blocks)
+
+
+def _read_bgzf_batches(handle, filename):
+
+    # Yields the batches of raw deflate data of the BGZF blocks of a file
+
+    batch = []
+    while True:
+        header = handle.read(BGZF_HEADER.size)
+        if not header:
+            break
+        block_size = _bgzf_block_size(header) if len(header) == BGZF_HEADER.size else None
+        if block_size is None:
+            raise ValueError(f"{filename} : invalid BGZF block header")
+
+        # The deflate data is followed by the CRC32 and the size of the block
+        raw = handle.read(block_size - BGZF_HEADER.size)
+        if len(raw) != block_size - BGZF_HEADER.size:
+            raise ValueError(f"{filename} : truncated BGZF block")
+        batch.append(raw[:-8])
+
+        if len(batch) == BGZF_BATCH_BLOCKS:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def _inflate_bgzf(handle, filename, threads):
+
+    with ThreadPoolExecutor(threads) as executor:
+        pending = []
+        for batch in _read_bgzf_batches(handle, filename):
+            pending.append(executor.submit(_inflate_bgzf_batch, batch))
+            if len(pending) > 2 * threads:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def _prefetch(blocks):
+
+    # Runs a generator of blocks in a thread, PREFETCH_BLOCKS blocks ahead of the caller
+
+    prefetched = queue.Queue(PREFETCH_BLOCKS)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for block in blocks:
+                if stop.is_set():
+                    return
+                prefetched.put(block)
+            prefetched.put(done)
+        except BaseException as error:
+            prefetched.put(error)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = prefetched.get()
+            if block is done:
+                return
+            if isinstance(block, BaseException):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        # Unblocks the producer if it waits on a full queue
+        while thread.is_alive():
+            try:
+                prefetched.get(timeout=0.01)
+            except queue.Empty:
+                pass
+
+
+def iter_decompressed(filename, threads=None):
+
+    '''
+    Yields the decompressed content of a plain, gzip, BGZF or zstd-compressed file, as bytes blocks.
+
+    Parameters:
+    -----------
+    filename : str
+        The file.
+
+    threads : int, optional
+        The number of threads that inflate the blocks of a BGZF file (by default, the number of CPUs).
+
+    Yields:
+    -------
+    bytes
+        The blocks of the decompressed content, in order.
+    '''
+
+    compression = detect_compression(filename)
+    threads = threads or os.cpu_count() or 1
+
+    with open(filename, 'rb') as handle:
+        if compression is None:
+            yield from _read_blocks(handle)
+        elif compression == 'bgzf':
+            yield from _inflate_bgzf(handle, filename, threads)
+        elif compression == 'gzip':
+            yield from _prefetch(_inflate_gzip(handle))
+        else:
+            yield from _prefetch(_inflate_zstd(handle))
+
+
+class DecompressedReader(io.RawIOBase):
+
+    '''
+    A read-only binary file over the blocks of iter_decompressed(), for the code that reads files with read().
+    '''
+
+    def __init__(self, filename, threads=None):
+
+        self._blocks = iter_decompressed(filename, threads=threads)
+        self._block = b''
+        self._offset = 0
+
+    def readable(self):
+
+        return True
+
+    def readinto(self, buffer):
+
+        while self._offset == len(self._block):
+            self._block = next(self._blocks, None)
+            self._offset = 0
+            if self._block is None:
+                self._block = b''
+                return 0
+
+        size = min(len(buffer), len(self._block) - self._offset)
+        buffer[:size] = self._block[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def close(self):
+
+        self._blocks.close()
+        super().close()
+
+
+def open_input(filename, mode='rb', threads=None):
+
+    '''
+    Opens a plain or compressed input file for reading, in binary ('rb') or text ('rt') mode.
+
+    Plain files are opened as they are; compressed files are decompressed on the fly (see iter_decompressed()).
+    '''
+
+    if mode not in ('rb', 'rt'):
+        raise ValueError(f"invalid mode {mode!r} : input files are opened with 'rb' or 'rt'")
+
+    if detect_compression(filename) is None:
+        return open(filename, mode)
+
+    handle = io.BufferedReader(DecompressedReader(filename, threads=threads), buffer_size=READ_SIZE)
+    return io.TextIOWrapper(handle) if mode == 'rt' else handle
+
+
+def bgzf_compress(data, level=6):
+
+    '''
+    Compresses bytes into BGZF blocks, followed by the BGZF end-of-file block.
+    '''
+
+    blocks = []
+    for block_start in range(0, len(data), BGZF_BLOCK_DATA):
+        block = data[block_start:block_start + BGZF_BLOCK_DATA]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(block) + compressor.flush()
+        blocks.append(BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2,
+                                       BGZF_HEADER.size + len(deflated) + 8 - 1)
+                      + deflated + struct.pack('<II', zlib.crc32(block), len(block)))
+
+    blocks.append(BGZF_EOF)
+    return b''.join(blocks)
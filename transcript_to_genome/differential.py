@@ -0,0 +1,363 @@
+# coding: utf-8
+
+# Differential testing of the procedural, object-oriented and optimized versions.
+
+# Every engine of benchmark.RUNNERS runs on the same inputs, and its output
+# file is compared row by row with the one of a baseline engine (the
+# procedural version by default). The inputs are :
+#
+#    repository   the input files of the repository
+#    edge_cases   a few hand-made alignments, queried at every position from
+#                 -2 to two past their end : position 0, the last position,
+#                 insertions (leading, inner, trailing), the nucleotides around
+#                 the deletions, and out-of-range positions
+#    synthetic    a workload of synthetic.write_workload(), with some of the
+#                 queries past the end of their transcript
+#
+# The outputs are read back into the same columns and types before they are
+# compared : the reference versions write the positions as floats (e.g.
+# "13.0") as soon as one of them is missing, and the OOP version names its
+# last column genome_position. One difference is known and counted apart :
+# find_transcript_index() only converts the positions larger than 0 to
+# 0-based, so the reference versions map the position -1 as the position 0,
+# where the optimized engines return no genome position.
+
+# The reference versions only read the M, I and D operations, and raise a
+# TypeError on a position of a transcript missing from the alignments : the
+# generated inputs have neither. An engine that raises is reported as failed.
+
+# Each engine runs twice : once timed, once under tracemalloc for its peak
+# memory. The worker processes of the parallel engine are not traced.
+
+import contextlib
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from .batch import OUTPUT_COLUMNS
+from .benchmark import RUNNERS, environment
+from .engines import CASES, ENGINES, REFERENCE_ENGINES
+from .reference import REPOSITORY
+from .synthetic import ALIGNMENTS_HEADER, POSITIONS_HEADER, write_workload
+
+
+# The alignments of the edge cases : (transcript name, chromosome, start, CIGAR string)
+EDGE_CASE_ALIGNMENTS = [
+    ('TR1', 'CHR1', 3, '8M7D6M2I2M11D7M'),
+    ('TR2', 'CHR2', 10, '20M'),
+    ('TR3', 'CHR1', 0, '3I5M'),
+    ('TR4', 'CHR1', 100, '5M4I'),
+    ('TR5', 'CHR3', 0, '1M1D1M1I1M'),
+    ('TR6', 'CHR2', 50, '4M2D3M'),
+    ('TR7', 'CHR3', 20, '1M'),
+]
+
+# The transcripts of the edge cases that have no query, so that they get a row without position
+EDGE_CASE_UNQUERIED = frozenset(['TR6'])
+
+# The number of mismatching rows kept in the report of each comparison
+MAX_EXAMPLES = 10
+
+
+def write_edge_cases(directory, seed=0):
+
+    '''
+    Writes the alignments and the positions files of the edge cases.
+
+    Parameters:
+    -----------
+    directory : str
+        The directory in which input_transcripts_alignments.txt and
+        input_transcripts_positions.txt are written.
+
+    seed : int, optional
+        The seed of the shuffling of the queries.
+
+    Returns:
+    --------
+    (str, str)
+        The paths of the alignments file and of the positions file.
+    '''
+
+    from .cigar import Cigar
+
+    os.makedirs(directory, exist_ok=True)
+    alignments_filename = os.path.join(directory, 'input_transcripts_alignments.txt')
+    positions_filename = os.path.join(directory, 'input_transcripts_positions.txt')
+
+    queries = []
+    with open(alignments_filename, 'w') as handle:
+        handle.write(ALIGNMENTS_HEADER)
+        for transcript_name, chromosome, start, cigar_string in EDGE_CASE_ALIGNMENTS:
+            handle.write(f"{transcript_name}\t{chromosome}\t{start}\t{cigar_string}\n")
+            if transcript_name not in EDGE_CASE_UNQUERIED:
+                transcript_length = Cigar.parse(cigar_string).transcript_length
+                queries.extend((transcript_name, position) for position in range(-2, transcript_length + 2))
+
+    # Queries shuffled across transcripts, as in input_transcripts_positions.txt
+    order = np.random.default_rng(seed).permutation(len(queries))
+    with open(positions_filename, 'w') as handle:
+        handle.write(POSITIONS_HEADER)
+        for query in order:
+            handle.write(f"{queries[query][0]}\t{queries[query][1]}\n")
+
+    return alignments_filename, positions_filename
+
+
+def read_output(filename):
+
+    '''
+    Reads the output file of any engine into the columns of batch.OUTPUT_COLUMNS.
+
+    The positions are returned as pandas Int64 columns (missing values are <NA>),
+    whether the engine wrote them as integers or as floats.
+    '''
+
+    output = pd.read_csv(filename, sep='\t', header=0, names=OUTPUT_COLUMNS,
+                         dtype={'transcript_name': str, 'chromosome': str})
+
+    for column in ('transcript_index', 'genome_index'):
+        values = pd.to_numeric(output[column])
+        if values.dtype.kind == 'f' and not np.array_equal(values.dropna(), np.round(values.dropna())):
+            raise ValueError(f"{filename} : the column {column} holds non-integer values")
+        output[column] = values.astype('Int64')
+
+    return output
+
+
+def compare_outputs(expected, actual, known_negative_one=False):
+
+    '''
+    Compares two outputs read by read_output(), row by row.
+
+    Parameters:
+    -----------
+    expected, actual : pandas.DataFrame
+        The outputs to compare.
+
+    known_negative_one : bool, optional
+        If True, the rows of the position -1 whose genome positions differ are
+        counted as known divergences instead of mismatches.
+
+    Returns:
+    --------
+    dict
+        The number of rows of each output, the number of mismatching rows and of known
+        divergences, and the first MAX_EXAMPLES mismatching rows of both outputs.
+    '''
+
+    comparison = {'expected_rows': len(expected), 'actual_rows': len(actual)}
+
+    if len(expected) != len(actual):
+        comparison.update(mismatches=abs(len(expected) - len(actual)), known_divergences=0, examples=[])
+        return comparison
+
+    expected = expected.reset_index(drop=True)
+    actual = actual.reset_index(drop=True)
+
+    different = np.zeros(len(expected), dtype=bool)
+    for column in OUTPUT_COLUMNS:
+        equal = (expected[column] == actual[column]).fillna(False).to_numpy(dtype=bool)
+        different |= ~(equal | (expected[column].isna() & actual[column].isna()).to_numpy())
+
+    known = np.zeros(len(expected), dtype=bool)
+    if known_negative_one:
+        same_query = np.ones(len(expected), dtype=bool)
+        for column in ('transcript_name', 'transcript_index', 'chromosome'):
+            same_query &= (expected[column] == actual[column]).fillna(False).to_numpy(dtype=bool)
+        known = different & same_query & (expected['transcript_index'] == -1).fillna(False).to_numpy(dtype=bool)
+
+    mismatches = np.flatnonzero(different & ~known)
+    comparison.update(mismatches=len(mismatches), known_divergences=int(np.count_nonzero(known)), examples=[
+        {'row': int(row),
+         'expected': _json_row(expected.iloc[row]),
+         'actual': _json_row(actual.iloc[row])}
+        for row in mismatches[:MAX_EXAMPLES]])
+
+    return comparison
+
+
+def _json_row(row):
+
+    return {column: (None if pd.isna(value) else value.item() if hasattr(value, 'item') else value)
+            for column, value in row.items()}
+
+
+def run_engine(engine, alignments_filename, positions_filename, output_filename, trace_memory=True):
+
+    '''
+    Runs one engine, timed, then once more for its peak memory if trace_memory is True.
+
+    Returns:
+    --------
+    dict
+        The status of the run ('ok' or 'error' with the error message), its seconds,
+        its stage times and counters, the number of rows and the peak traced memory in bytes.
+    '''
+
+    runner = RUNNERS[engine]
+
+    # The reference versions print a message for every position that does not map
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            start = time.perf_counter()
+            timer, rows = runner(alignments_filename, positions_filename, output_filename)
+            seconds = time.perf_counter() - start
+        except Exception as error:
+            return {'status': 'error', 'error': f"{type(error).__name__}: {error}"}
+
+        peak_memory_bytes = None
+        if trace_memory and not tracemalloc.is_tracing():
+            with tempfile.TemporaryDirectory(prefix='transcript_to_genome_memory_') as directory:
+                tracemalloc.start()
+                try:
+                    runner(alignments_filename, positions_filename, os.path.join(directory, 'output.txt'))
+                    peak_memory_bytes = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+
+    return {
+        'status': 'ok',
+        'seconds': seconds,
+        'stages': timer.stages,
+        'counters': timer.counters,
+        'rows': int(rows),
+        'peak_memory_bytes': peak_memory_bytes,
+    }
+
+
+def _case_inputs(case, directory, workload):
+
+    if case == 'repository':
+        return (os.path.join(REPOSITORY, 'version_procedural_programming', 'input_transcripts_alignments.txt'),
+                os.path.join(REPOSITORY, 'version_procedural_programming', 'input_transcripts_positions.txt'))
+    if case == 'edge_cases':
+        return write_edge_cases(directory)
+    if case == 'synthetic':
+        return write_workload(directory, **dict({'out_of_range_fraction': 0.05}, **workload))
+
+    raise ValueError(f"Unknown case {case!r} : expected one of {', '.join(CASES)}")
+
+
+def compare_engines(engines=ENGINES, cases=CASES, inputs=(), directory=None, report_filename=None,
+                    trace_memory=True, **workload):
+
+    '''
+    Runs the engines on the same inputs and compares their outputs with the one of the first engine.
+
+    Parameters:
+    -----------
+    engines : iterable of str, optional
+        The engines to run, among the keys of benchmark.RUNNERS; the first one is the baseline.
+
+    cases : iterable of str, optional
+        The built-in inputs to run, among CASES.
+
+    inputs : iterable of (str, str), optional
+        Other (alignments file, positions file) pairs to run.
+
+    directory : str, optional
+        The directory of the generated files and of the outputs (by default, a temporary one).
+
+    report_filename : str, optional
+        If given, the JSON report is also written to this file.
+
+    trace_memory : bool, optional
+        If False, the engines run only once and their peak memory is not measured.
+
+    **workload :
+        The parameters of synthetic.write_workload() for the synthetic case.
+
+    Returns:
+    --------
+    dict
+        The report : for every input, the run of each engine (seconds, peak memory, rows,
+        counters) and its comparison with the baseline; 'passed' is True if every engine
+        ran and no output differs from the baseline except for the known divergences.
+    '''
+
+    engines = list(engines)
+    baseline = engines[0]
+
+    with contextlib.ExitStack() as stack:
+        if directory is None:
+            directory = stack.enter_context(tempfile.TemporaryDirectory(prefix='transcript_to_genome_compare_'))
+
+        runs = [(case, _case_inputs(case, os.path.join(directory, case), workload)) for case in cases]
+        runs += [(f"input_{number}", files) for number, files in enumerate(inputs, 1)]
+
+        report = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'environment': environment(),
+            'baseline': baseline,
+            'cases': {},
+        }
+
+        for case, (alignments_filename, positions_filename) in runs:
+            case_directory = os.path.join(directory, case)
+            os.makedirs(case_directory, exist_ok=True)
+
+            results = {'alignments': alignments_filename, 'positions': positions_filename,
+                       'engines': {}, 'comparisons': {}}
+            outputs = {}
+
+            for engine in engines:
+                output_filename = os.path.join(case_directory, f"output_genome_positions_{engine}.txt")
+                results['engines'][engine] = run_engine(engine, alignments_filename, positions_filename,
+                                                        output_filename, trace_memory=trace_memory)
+                if results['engines'][engine]['status'] == 'ok':
+                    outputs[engine] = read_output(output_filename)
+
+            if baseline in outputs:
+                for engine in engines[1:]:
+                    if engine in outputs:
+                        results['comparisons'][engine] = compare_outputs(
+                            outputs[baseline], outputs[engine],
+                            known_negative_one=(baseline in REFERENCE_ENGINES) != (engine in REFERENCE_ENGINES))
+
+            results['passed'] = (len(outputs) == len(engines)
+                                 and all(comparison['mismatches'] == 0
+                                         for comparison in results['comparisons'].values()))
+            report['cases'][case] = results
+
+    report['passed'] = all(results['passed'] for results in report['cases'].values())
+
+    if report_filename is not None:
+        with open(report_filename, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+    return report
+
+
+def format_report(report):
+
+    '''
+    Formats the report of compare_engines() as a table : one line per input and engine.
+    '''
+
+    lines = [f"{'input':<14}{'engine':<12}{'status':<10}{'seconds':>10}{'peak MiB':>10}"
+             f"{'rows':>10}{'mismatches':>12}{'known':>7}"]
+
+    for case, results in report['cases'].items():
+        for engine, run in results['engines'].items():
+            comparison = results['comparisons'].get(engine, {})
+            if run['status'] != 'ok':
+                status = 'error'
+            elif comparison.get('mismatches'):
+                status = 'DIFFERS'
+            else:
+                status = 'ok'
+            peak = '' if run.get('peak_memory_bytes') is None else f"{run['peak_memory_bytes'] / 2 ** 20:.1f}"
+            lines.append(f"{case:<14}{engine:<12}{status:<10}{run.get('seconds', float('nan')):>10.3f}{peak:>10}"
+                         f"{run.get('rows', ''):>10}{comparison.get('mismatches', ''):>12}"
+                         f"{comparison.get('known_divergences', ''):>7}")
+            if run['status'] != 'ok':
+                lines.append(f"    {run['error']}")
+
+    lines.append('passed' if report['passed'] else 'FAILED')
+    return '\n'.join(lines)
@@ -0,0 +1,22 @@
+# coding: utf-8
+
+# Names of the engines of the benchmark and of the differential harness, and
+# of the built-in inputs of the compare command.
+
+# They are defined here once, for benchmark.py, differential.py and the
+# command line interface. This module imports nothing, so that the interface
+# builds its argument parser without loading NumPy or pandas.
+
+
+# Every engine of benchmark.RUNNERS, in the order in which compare runs them by default;
+# the first one is the baseline of the comparisons
+ENGINES = ('procedural', 'oop', 'oop_batch', 'optimized', 'streaming', 'parallel', 'cached', 'index_file')
+
+# The engines timed by the bench command by default
+BENCH_ENGINES = ('procedural', 'oop', 'optimized')
+
+# The engines that follow the reference semantics of find_transcript_index()
+REFERENCE_ENGINES = frozenset(['procedural', 'oop', 'oop_batch'])
+
+# The built-in inputs of the compare command (see differential._case_inputs())
+CASES = ('repository', 'edge_cases', 'synthetic')
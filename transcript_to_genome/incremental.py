@@ -0,0 +1,472 @@
+# coding: utf-8
+
+# Incremental mapping when the alignments change between releases.
+
+# A release of the annotation changes a few hundred transcripts out of
+# hundreds of thousands. The cache directory of the previous run keeps :
+#
+#    index.t2g      the AlignmentIndex, as written by write_index()
+#    digests.npy    uint64, a digest of the chromosome, start and CIGAR string
+#                   of every transcript, in transcript id order
+#    results.bin    the results of the run, in the binary output format
+#    state.json     the version of the cache and a digest of the positions file
+#
+# The new alignments file is read line by line and only digested. The
+# transcripts whose digest is unchanged keep the blocks of the cached index,
+# copied with array operations; only the added and changed transcripts are
+# parsed and indexed. The result is identical to an index built from scratch.
+#
+# If the positions file is unchanged, the output rows of the unaffected
+# transcripts are taken from the cached results. The cached rows of the
+# affected transcripts (added, changed or removed) carry their queries, so
+# these are mapped again without reading the positions file : the work is
+# proportional to the number of changes, not to the size of the inputs.
+
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from .batch import OUTPUT_COLUMNS, UNMAPPED, AlignmentIndex, map_queries
+from .cigar import Alignment
+from .instrument import current
+from .join import NameTable, read_interned_positions
+
+
+CACHE_VERSION = 2
+
+INDEX_FILENAME = 'index.t2g'
+DIGESTS_FILENAME = 'digests.npy'
+RESULTS_FILENAME = 'results.bin'
+STATE_FILENAME = 'state.json'
+
+# Size of the blocks in which the positions file is digested
+DIGEST_BLOCK_SIZE = 1 << 20
+
+AlignmentDiff = namedtuple('AlignmentDiff', ['added', 'removed', 'changed'])
+AlignmentDiff.__doc__ = '''
+The transcript names added, removed and changed (same name, other chromosome,
+start or CIGAR string) between two sets of alignments, each sorted.
+'''
+
+CachedRun = namedtuple('CachedRun', ['index', 'digests', 'results', 'positions_digest'])
+CachedRun.__doc__ = '''
+The index, the alignment digests, the results and the digest of the positions file of a previous run.
+'''
+
+
+def alignment_digest(chromosome, start, cigar_string):
+
+    '''
+    Returns a 64-bit digest of the alignment of a transcript.
+
+    Example:
+    --------
+    >>> alignment_digest('CHR1', 3, '8M7D6M2I2M11D7M') == alignment_digest('CHR1', 3, '8M7D6M2I2M11D7M')
+    True
+    '''
+
+    data = f"{chromosome}\t{start}\t{cigar_string}".encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+def file_digest(filename):
+
+    '''
+    Returns the hexadecimal digest of the content of a file.
+    '''
+
+    digest = hashlib.blake2b()
+    with open(filename, 'rb') as handle:
+        for block in iter(lambda: handle.read(DIGEST_BLOCK_SIZE), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def read_alignment_records(filename):
+
+    '''
+    Reads the alignments of a 4-column alignments file, or of a SAM or BAM file.
+
+    Returns:
+    --------
+    dict
+        The (chromosome, start, CIGAR string) of each transcript, keyed by transcript
+        name, in file order. As with read_alignments(), the last line of a name wins.
+    '''
+
+    from .compression import open_input
+    from .index_file import is_index_file
+    from .sam import is_bam_file, is_sam_file, read_records
+
+    if is_index_file(filename):
+        raise ValueError(f"{filename} is a binary index file : the incremental mode needs the alignments")
+
+    if is_bam_file(filename) or is_sam_file(filename):
+        return {record.transcript_name: (record.chromosome, record.start, record.cigar_string)
+                for record in read_records(filename)}
+
+    records = {}
+    with open_input(filename, 'rt') as handle:
+        next(handle, None)                        # Skip the header line
+        for line in handle:
+            line = line.rstrip('\r\n')
+            if line:
+                transcript_name, chromosome, start, cigar_string = line.split('\t')[:4]
+                records[transcript_name] = (chromosome, int(start), cigar_string)
+
+    return records
+
+
+def diff_alignments(old_names, old_digests, new_names, new_digests):
+
+    '''
+    Compares two sets of alignments by transcript name and digest.
+
+    Parameters:
+    -----------
+    old_names, new_names : sequence of str
+        The transcript names of each set.
+
+    old_digests, new_digests : sequence of int
+        The alignment_digest() of each transcript, in the order of the names.
+
+    Returns:
+    --------
+    AlignmentDiff
+    '''
+
+    old = dict(zip(old_names, np.asarray(old_digests).tolist()))
+    new = dict(zip(new_names, np.asarray(new_digests).tolist()))
+
+    return AlignmentDiff(sorted(new.keys() - old.keys()), sorted(old.keys() - new.keys()),
+                         sorted(name for name, digest in new.items() if name in old and old[name] != digest))
+
+
+def update_index(index, digests, records):
+
+    '''
+    Builds the index of new alignments, reusing the blocks of the unchanged transcripts of an old index.
+
+    Parameters:
+    -----------
+    index : AlignmentIndex
+        The index of the old alignments (possibly an empty AlignmentIndex(())).
+
+    digests : numpy.ndarray of uint64
+        The alignment_digest() of each transcript of the old index, in transcript id order.
+
+    records : dict
+        The new alignments, as returned by read_alignment_records().
+
+    Returns:
+    --------
+    (AlignmentIndex, numpy.ndarray)
+        The index of the new alignments, in the order of the records, identical to
+        the one built from scratch, and the digest of each of its transcripts.
+    '''
+
+    instrumentation = current()
+
+    names = list(records)
+    new_digests = np.fromiter((alignment_digest(*record) for record in records.values()),
+                              dtype=np.uint64, count=len(names))
+
+    old_ids = {name: transcript_id for transcript_id, name in enumerate(index.transcript_names)}
+    transcript_ids = np.fromiter((old_ids.get(name, -1) for name in names), dtype=np.int64, count=len(names))
+    reused = transcript_ids >= 0
+    reused[reused] = digests[transcript_ids[reused]] == new_digests[reused]
+
+    # Only the added and changed transcripts are parsed
+    fresh_names = [name for name, keep in zip(names, reused.tolist()) if not keep]
+    fresh = AlignmentIndex(Alignment.from_cigar(name, *records[name]) for name in fresh_names)
+    instrumentation.count('reused_alignments', np.count_nonzero(reused))
+    instrumentation.count('indexed_alignments', len(fresh_names))
+
+    # The blocks of the old and of the fresh transcripts, on one transcript axis
+    old_total = int(index.transcript_lengths.sum())
+    pool_lengths = np.concatenate((index.transcript_lengths, fresh.transcript_lengths))
+    pool_genome_lengths = np.concatenate((index.genome_lengths, fresh.genome_lengths))
+    pool_bases = np.concatenate((index.transcript_bases, fresh.transcript_bases + old_total))
+    pool_block_starts = np.concatenate((index.block_starts, fresh.block_starts + old_total))
+    pool_block_genome_starts = np.concatenate((index.block_genome_starts, fresh.block_genome_starts))
+
+    pool_ids = transcript_ids.copy()
+    pool_ids[~reused] = len(index) + np.arange(len(fresh_names))
+
+    # The blocks of a transcript are the ones that start in its range of the axis
+    first_blocks = np.searchsorted(pool_block_starts, pool_bases[pool_ids])
+    block_counts = np.searchsorted(pool_block_starts, pool_bases[pool_ids] + pool_lengths[pool_ids]) - first_blocks
+    block_ids = (np.repeat(first_blocks - (np.cumsum(block_counts) - block_counts), block_counts)
+                 + np.arange(block_counts.sum()))
+
+    chromosome_table = {}
+    chromosome_ids = [chromosome_table.setdefault(chromosome, len(chromosome_table))
+                      for chromosome, _, _ in records.values()]
+
+    updated = AlignmentIndex(())
+    updated.transcript_names = np.array(names, dtype=object)
+    updated.chromosome_names = list(chromosome_table)
+    updated.chromosome_ids = np.array(chromosome_ids, dtype=np.int32)
+    updated.starts = np.array([start for _, start, _ in records.values()], dtype=np.int64)
+    updated.transcript_lengths = pool_lengths[pool_ids]
+    updated.genome_lengths = pool_genome_lengths[pool_ids]
+    updated.transcript_bases = np.cumsum(updated.transcript_lengths) - updated.transcript_lengths
+    updated.block_starts = (pool_block_starts[block_ids]
+                            - np.repeat(pool_bases[pool_ids] - updated.transcript_bases, block_counts))
+    updated.block_genome_starts = pool_block_genome_starts[block_ids]
+    updated._transcript_ids = {name: transcript_id for transcript_id, name in enumerate(names)}
+
+    return updated, new_digests
+
+
+def load_cache(directory):
+
+    '''
+    Loads the cached run of a cache directory.
+
+    Returns:
+    --------
+    CachedRun or None
+        None if the directory holds no complete cache of this version.
+    '''
+
+    from .index_file import load_index
+    from .sinks import read_binary
+
+    try:
+        with open(os.path.join(directory, STATE_FILENAME)) as handle:
+            state = json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+    if state.get('version') != CACHE_VERSION:
+        return None
+
+    return CachedRun(load_index(os.path.join(directory, INDEX_FILENAME)),
+                     np.load(os.path.join(directory, DIGESTS_FILENAME)),
+                     read_binary(os.path.join(directory, RESULTS_FILENAME)),
+                     state['positions_digest'])
+
+
+def save_cache(directory, index, digests, results, positions_digest):
+
+    '''
+    Writes a run into a cache directory, for the next call of map_files_incremental().
+    '''
+
+    from .index_file import write_index
+    from .sinks import write_results
+
+    os.makedirs(directory, exist_ok=True)
+
+    # The state is written last : an interrupted update leaves no cache. Every
+    # file is replaced, never rewritten in place, since the cached index of the
+    # current run may still be memory-mapped from the old file.
+    state_filename = os.path.join(directory, STATE_FILENAME)
+    if os.path.exists(state_filename):
+        os.remove(state_filename)
+
+    def replace(filename, write):
+        path = os.path.join(directory, filename)
+        write(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def write_digests(path):
+        with open(path, 'wb') as handle:
+            np.save(handle, digests)
+
+    def write_state(path):
+        with open(path, 'w') as handle:
+            json.dump({'version': CACHE_VERSION, 'positions_digest': positions_digest}, handle)
+
+    replace(INDEX_FILENAME, lambda path: write_index(index, path))
+    replace(DIGESTS_FILENAME, write_digests)
+    replace(RESULTS_FILENAME, lambda path: write_results(results, path, format='binary'))
+    replace(STATE_FILENAME, write_state)
+
+
+def _insertion_rows(names, inserted_names):
+
+    # The rows, in the merged order, of sorted names inserted among other sorted
+    # names; no name is in both arrays
+    return np.searchsorted(names, inserted_names) + np.arange(len(inserted_names))
+
+
+def _merge_rows(kept, inserted):
+
+    # Merges two DataFrames of results, each sorted by transcript name
+
+    import pandas as pd
+
+    kept_names = np.asarray(kept['transcript_name'], dtype=object)
+    inserted_names = np.asarray(inserted['transcript_name'], dtype=object)
+
+    inserted_rows = np.zeros(len(kept_names) + len(inserted_names), dtype=bool)
+    inserted_rows[_insertion_rows(kept_names, inserted_names)] = True
+    order = np.empty(len(inserted_rows), dtype=np.int64)
+    order[~inserted_rows] = np.arange(len(kept_names))
+    order[inserted_rows] = len(kept_names) + np.arange(len(inserted_names))
+
+    columns = {}
+    for column in OUTPUT_COLUMNS:
+        if column in ('transcript_name', 'chromosome'):
+            table = NameTable(kept[column].cat.categories)
+            codes = np.concatenate((kept[column].cat.codes.to_numpy(),
+                                    _category_codes(table, inserted[column])))
+            columns[column] = pd.Categorical.from_codes(codes[order], categories=table.names)
+        else:
+            columns[column] = pd.concat((kept[column], inserted[column]), ignore_index=True).array[order]
+
+    return pd.DataFrame(columns, columns=OUTPUT_COLUMNS)
+
+
+def _category_codes(table, column):
+
+    # The codes of a categorical column in a NameTable (-1 if missing)
+    codes = column.cat.codes.to_numpy()
+    return np.append(table.intern(column.cat.categories), -1)[codes]
+
+
+def remap_affected(index, results, affected):
+
+    '''
+    Updates cached results for a new index : only the rows of the affected transcripts are mapped again.
+
+    Parameters:
+    -----------
+    index : AlignmentIndex
+        The index of the new alignments.
+
+    results : pandas.DataFrame
+        The results of the previous run, for the same positions.
+
+    affected : set of str
+        The transcript names added, removed or changed since the previous run.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The results of the positions against the new index, as map_positions() would return them.
+    '''
+
+    import pandas as pd
+
+    names = results['transcript_name']
+    affected_categories = np.array([name in affected for name in names.cat.categories] + [False])
+    affected_rows = affected_categories[names.cat.codes.to_numpy()]
+    query_rows = affected_rows & results['transcript_index'].notna().to_numpy()
+
+    # The cached rows are sorted by name, with the queries of each name in input order
+    query_names = np.asarray(names[query_rows], dtype=object)
+    unqueried_names = np.array(sorted(affected - set(query_names.tolist())), dtype=object)
+    unqueried_names = unqueried_names[index.transcript_ids(unqueried_names) >= 0]
+    row_names = np.empty(len(query_names) + len(unqueried_names), dtype=object)
+    unqueried_rows = np.zeros(len(row_names), dtype=bool)
+    unqueried_rows[_insertion_rows(query_names, unqueried_names)] = True
+    row_names[~unqueried_rows] = query_names
+    row_names[unqueried_rows] = unqueried_names
+
+    transcript_positions = np.zeros(len(row_names), dtype=np.int64)
+    transcript_positions[~unqueried_rows] = results['transcript_index'].to_numpy(dtype=np.int64,
+                                                                                 na_value=0)[query_rows]
+
+    transcript_ids = index.transcript_ids(row_names)
+    genome_positions = np.full(len(row_names), UNMAPPED, dtype=np.int64)
+    genome_positions[~unqueried_rows] = index.genome_positions(transcript_ids[~unqueried_rows],
+                                                               transcript_positions[~unqueried_rows])
+    chromosome_ids = np.append(index.chromosome_ids, -1)[transcript_ids]
+
+    current().count('remapped_rows', len(row_names))
+
+    remapped = pd.DataFrame({
+        'transcript_name': pd.Categorical(row_names),
+        'transcript_index': pd.arrays.IntegerArray(transcript_positions, unqueried_rows),
+        'chromosome': pd.Categorical.from_codes(chromosome_ids, categories=index.chromosome_names),
+        'genome_index': pd.arrays.IntegerArray(genome_positions, genome_positions == UNMAPPED),
+    }, columns=OUTPUT_COLUMNS)
+
+    return _merge_rows(results[~affected_rows].reset_index(drop=True), remapped)
+
+
+def map_files_incremental(alignments_filename, positions_filename, output_filename, cache_directory,
+                          format=None):
+
+    '''
+    Maps the positions file against the alignments file, reusing the previous run kept in a cache directory.
+
+    The output is the same as the one of map_files(). The index is updated
+    incrementally (see update_index()); if the positions file has not changed
+    since the previous run, only the rows of the transcripts added, removed or
+    changed are mapped again. The cache is then updated for the next run.
+
+    Parameters:
+    -----------
+    alignments_filename : str
+        The alignments file (4 columns), or a SAM or BAM file.
+
+    positions_filename : str
+        The positions file (columns transcript_name and transcript_coordinate).
+
+    output_filename : str
+        The output file.
+
+    cache_directory : str
+        The cache directory; it is created by the first run.
+
+    format : str, optional
+        The format of the output file (see sinks.open_sink()).
+
+    Returns:
+    --------
+    (pandas.DataFrame, AlignmentDiff)
+        The results, and the changes of the alignments since the cached run
+        (everything is added if there was no cache).
+    '''
+
+    from .sinks import write_results
+
+    instrumentation = current()
+
+    with instrumentation.stage('read_cache'):
+        cached = load_cache(cache_directory)
+
+    with instrumentation.stage('diff_alignments'):
+        records = read_alignment_records(alignments_filename)
+        positions_digest = file_digest(positions_filename)
+
+    if cached is None:
+        cached_index, cached_digests = AlignmentIndex(()), np.zeros(0, dtype=np.uint64)
+    else:
+        cached_index, cached_digests = cached.index, cached.digests
+
+    with instrumentation.stage('build_index'):
+        try:
+            index, digests = update_index(cached_index, cached_digests, records)
+        except ValueError as error:
+            raise ValueError(f"{alignments_filename} : {error}") from None
+        diff = diff_alignments(cached_index.transcript_names, cached_digests, index.transcript_names, digests)
+
+    instrumentation.count('added_alignments', len(diff.added))
+    instrumentation.count('removed_alignments', len(diff.removed))
+    instrumentation.count('changed_alignments', len(diff.changed))
+
+    if cached is not None and cached.positions_digest == positions_digest:
+        with instrumentation.stage('map'):
+            results = remap_affected(index, cached.results, set(diff.added + diff.removed + diff.changed))
+    else:
+        with instrumentation.stage('read_positions'):
+            table = NameTable.for_index(index)
+            queries = read_interned_positions(positions_filename, table)
+        results = map_queries(index, table, queries)
+
+    with instrumentation.stage('write'):
+        write_results(results, output_filename, format=format)
+
+    with instrumentation.stage('write_cache'):
+        save_cache(cache_directory, index, digests, results, positions_digest)
+
+    return results, diff
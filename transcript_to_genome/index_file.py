@@ -0,0 +1,233 @@
+# coding: utf-8
+
+# Binary alignment index file, loaded with mmap.
+
+# build-index parses the alignments file once and writes the arrays of its
+# AlignmentIndex into a single file. Loading the file maps it in memory and
+# wraps the arrays around the mapped pages with np.frombuffer, without
+# parsing or copying anything : jobs start in milliseconds, and concurrent
+# processes share the same pages through the OS cache.
+
+# Layout (little-endian) :
+#
+#    magic                 8 bytes      b'T2GIDX\x00\x02'
+#    header                5 x int64    transcripts, blocks, chromosomes,
+#                                       name width, chromosome name width
+#    arrays                one after the other, each aligned on 8 bytes :
+#        transcript_names        S<name width>[transcripts]   in transcript id order
+#        sorted_names            S<name width>[transcripts]   in name order
+#        sorted_name_ids         int64[transcripts]           transcript id of each sorted name
+#        chromosome_names        S<chromosome width>[chromosomes]
+#        chromosome_ids          int32[transcripts]
+#        starts                  int64[transcripts]
+#        transcript_lengths      int64[transcripts]
+#        genome_lengths          int64[transcripts]
+#        transcript_bases        int64[transcripts]
+#        block_starts            int64[blocks]
+#        block_genome_starts     int64[blocks]
+
+import mmap
+import struct
+
+import numpy as np
+
+from .batch import AlignmentIndex
+
+
+MAGIC = b'T2GIDX\x00\x02'
+HEADER = struct.Struct('<5q')
+
+
+def _layout(transcripts, blocks, chromosomes, name_width, chromosome_width):
+
+    # The (attribute, dtype, count) of every array of the file, in file order
+
+    return [
+        ('transcript_names', np.dtype(f'S{name_width}'), transcripts),
+        ('sorted_names', np.dtype(f'S{name_width}'), transcripts),
+        ('sorted_name_ids', np.dtype('<i8'), transcripts),
+        ('chromosome_names', np.dtype(f'S{chromosome_width}'), chromosomes),
+        ('chromosome_ids', np.dtype('<i4'), transcripts),
+        ('starts', np.dtype('<i8'), transcripts),
+        ('transcript_lengths', np.dtype('<i8'), transcripts),
+        ('genome_lengths', np.dtype('<i8'), transcripts),
+        ('transcript_bases', np.dtype('<i8'), transcripts),
+        ('block_starts', np.dtype('<i8'), blocks),
+        ('block_genome_starts', np.dtype('<i8'), blocks),
+    ]
+
+
+def _aligned(offset):
+
+    return (offset + 7) & ~7
+
+
+def _encode(names):
+
+    # Fixed-width UTF-8 byte strings; the width is at least 1, as numpy requires
+    encoded = [name.encode('utf-8') for name in names]
+    width = max((len(name) for name in encoded), default=0) or 1
+    return np.array(encoded, dtype=f'S{width}'), width
+
+
+def write_index(index, filename):
+
+    '''
+    Writes an AlignmentIndex to a binary index file.
+
+    Parameters:
+    -----------
+    index : AlignmentIndex
+        The indexed alignments.
+
+    filename : str
+        The path of the index file.
+    '''
+
+    transcript_names, name_width = _encode(index.transcript_names)
+    chromosome_names, chromosome_width = _encode(index.chromosome_names)
+    sorted_name_ids = np.argsort(transcript_names, kind='stable').astype(np.int64)
+
+    arrays = {
+        'transcript_names': transcript_names,
+        'sorted_names': transcript_names[sorted_name_ids],
+        'sorted_name_ids': sorted_name_ids,
+        'chromosome_names': chromosome_names,
+        'chromosome_ids': index.chromosome_ids,
+        'starts': index.starts,
+        'transcript_lengths': index.transcript_lengths,
+        'genome_lengths': index.genome_lengths,
+        'transcript_bases': index.transcript_bases,
+        'block_starts': index.block_starts,
+        'block_genome_starts': index.block_genome_starts,
+    }
+
+    counts = (len(index), len(index.block_starts), len(index.chromosome_names), name_width, chromosome_width)
+
+    with open(filename, 'wb') as handle:
+        handle.write(MAGIC)
+        handle.write(HEADER.pack(*counts))
+        offset = len(MAGIC) + HEADER.size
+
+        for attribute, dtype, count in _layout(*counts):
+            padding = _aligned(offset) - offset
+            handle.write(b'\x00' * padding)
+            data = np.ascontiguousarray(arrays[attribute], dtype=dtype).tobytes()
+            handle.write(data)
+            offset += padding + len(data)
+
+
+def is_index_file(filename):
+
+    '''
+    Tells whether a file is a binary index file written by write_index().
+    '''
+
+    with open(filename, 'rb') as handle:
+        return handle.read(len(MAGIC)) == MAGIC
+
+
+class MappedAlignmentIndex(AlignmentIndex):
+
+    '''
+    An AlignmentIndex whose arrays are read directly from a memory-mapped index file.
+
+    Parameters:
+    -----------
+    filename : str
+        The path of an index file written by write_index().
+    '''
+
+    def __init__(self, filename):
+
+        with open(filename, 'rb') as handle:
+            self._mmap = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{filename} is not a transcript_to_genome index file")
+
+        counts = HEADER.unpack_from(self._mmap, len(MAGIC))
+        offset = len(MAGIC) + HEADER.size
+
+        for attribute, dtype, count in _layout(*counts):
+            offset = _aligned(offset)
+            array = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset)
+            offset += array.nbytes
+            setattr(self, '_' + attribute if attribute in ('transcript_names', 'chromosome_names') else attribute, array)
+
+        self.chromosome_names = [name.decode('utf-8') for name in self._chromosome_names]
+        self._decoded_names = None
+
+    @property
+    def transcript_names(self):
+
+        # Decoded on first use only : mapping positions does not need the Python strings
+        if self._decoded_names is None:
+            self._decoded_names = np.array([name.decode('utf-8') for name in self._transcript_names], dtype=object)
+        return self._decoded_names
+
+    def __len__(self):
+
+        return len(self._transcript_names)
+
+    def __getstate__(self):
+
+        # A memory map cannot be pickled : processes that do not inherit the
+        # index by fork receive plain copies of its arrays
+        state = self.__dict__.copy()
+        del state['_mmap']
+        for attribute, value in state.items():
+            if isinstance(value, np.ndarray):
+                state[attribute] = value.copy()
+        return state
+
+    def transcript_ids(self, transcript_names):
+
+        '''
+        Converts transcript names into transcript ids, with a binary search over the sorted names.
+        '''
+
+        encoded = [name.encode('utf-8') for name in transcript_names]
+        transcript_ids = np.full(len(encoded), -1, dtype=np.int64)
+        if len(encoded) == 0 or len(self.sorted_names) == 0:
+            return transcript_ids
+
+        # Names longer than the ones of the index would be truncated by the comparison
+        width = self.sorted_names.dtype.itemsize
+        fits = np.flatnonzero([len(name) <= width for name in encoded])
+        encoded = np.array([encoded[i] for i in fits], dtype=f'S{width}')
+
+        positions = np.minimum(np.searchsorted(self.sorted_names, encoded), len(self.sorted_names) - 1)
+        found = self.sorted_names[positions] == encoded
+        transcript_ids[fits[found]] = self.sorted_name_ids[positions[found]]
+
+        return transcript_ids
+
+
+def load_index(filename):
+
+    '''
+    Loads an index file written by write_index(), with mmap.
+    '''
+
+    return MappedAlignmentIndex(filename)
+
+
+def open_alignments(filename):
+
+    '''
+    Loads the alignments from a binary index file, a SAM or BAM file, or the 4-column alignments file.
+
+    The records of SAM and BAM files are streamed into an AlignmentStore, from which the index is built.
+    '''
+
+    from .sam import is_bam_file, is_sam_file, read_records
+    from .store import AlignmentStore
+
+    if is_index_file(filename):
+        return load_index(filename)
+
+    if is_bam_file(filename) or is_sam_file(filename):
+        return AlignmentIndex.from_store(AlignmentStore(read_records(filename)))
+
+    return AlignmentIndex.from_file(filename)
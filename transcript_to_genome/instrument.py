@@ -0,0 +1,268 @@
+# coding: utf-8
+
+# Instrumentation of the mapping pipeline : stage timers, counters, and
+# optional cProfile and tracemalloc captures, summarized as JSON.
+
+# The code of the pipeline asks current() for the active instrumentation and
+# wraps its stages in current().stage(name). Outside of instrumented(), the
+# active instrumentation is DISABLED, whose stage() returns one shared
+# null context and whose count() does nothing; counters that need extra work
+# to compute (e.g. the queries that fall in insertions) are only computed
+# when current().enabled is True. Counters are added once per batch, never
+# per query, so an enabled instrumentation is cheap as well.
+
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+
+# Number of functions and of allocation sites kept in the summary
+PROFILE_TOP = 25
+MEMORY_TOP = 10
+
+
+class StageTimer:
+
+    '''
+    Accumulates the time spent in each stage of a pipeline, in seconds.
+    '''
+
+    def __init__(self):
+
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @property
+    def total(self):
+
+        return sum(self.stages.values())
+
+
+class Instrumentation(StageTimer):
+
+    '''
+    Stage timers and counters of one run, with optional profiling.
+
+    Parameters:
+    -----------
+    profile : bool, optional
+        If True, the run is profiled with cProfile, and the functions with the
+        largest cumulative time are added to the summary.
+
+    trace_memory : bool, optional
+        If True, the allocations are traced with tracemalloc, and the peak memory
+        and the largest allocation sites are added to the summary.
+    '''
+
+    enabled = True
+
+    def __init__(self, profile=False, trace_memory=False):
+
+        super().__init__()
+        self.counters = {}
+        self.profile = profile
+        self.trace_memory = trace_memory
+
+        self.profile_summary = None
+        self.memory_summary = None
+        self._profiler = None
+        self._started = None
+        self._elapsed = None
+
+    def count(self, name, value=1):
+
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def start(self):
+
+        self._started = time.perf_counter()
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop(self):
+
+        if self._profiler is not None:
+            self._profiler.disable()
+            stats = pstats.Stats(self._profiler).stats
+            top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+            self.profile_summary = [{
+                'function': f"{os.path.basename(filename)}:{line}({function})",
+                'calls': calls,
+                'total_seconds': total_seconds,
+                'cumulative_seconds': cumulative_seconds,
+            } for (filename, line, function), (_, calls, total_seconds, cumulative_seconds, _) in top]
+            self._profiler = None
+
+        if self.trace_memory and tracemalloc.is_tracing():
+            current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            statistics = tracemalloc.take_snapshot().statistics('lineno')[:MEMORY_TOP]
+            tracemalloc.stop()
+            self.memory_summary = {
+                'current_bytes': current_bytes,
+                'peak_bytes': peak_bytes,
+                'top': [{'location': f"{statistic.traceback[0].filename}:{statistic.traceback[0].lineno}",
+                         'size_bytes': statistic.size, 'count': statistic.count} for statistic in statistics],
+            }
+
+        if self._started is not None:
+            self._elapsed = time.perf_counter() - self._started
+
+    def summary(self, **metadata):
+
+        '''
+        Returns the JSON-serializable summary of the run, with extra metadata fields.
+        '''
+
+        summary = dict(metadata)
+        summary.update({
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'stages': self.stages,
+            'total_seconds': self.total,
+            'elapsed_seconds': self._elapsed,
+            'counters': self.counters,
+        })
+        if self.profile_summary is not None:
+            summary['profile'] = self.profile_summary
+        if self.memory_summary is not None:
+            summary['memory'] = self.memory_summary
+
+        return summary
+
+    def write(self, filename=None, **metadata):
+
+        '''
+        Writes the summary as JSON to a file, or to stderr if filename is None.
+        '''
+
+        if filename is None:
+            json.dump(self.summary(**metadata), sys.stderr, indent=2)
+            sys.stderr.write('\n')
+        else:
+            with open(filename, 'w') as handle:
+                json.dump(self.summary(**metadata), handle, indent=2)
+
+
+class DisabledInstrumentation:
+
+    '''
+    The instrumentation that does nothing, active outside of instrumented().
+    '''
+
+    enabled = False
+
+    _null_context = contextlib.nullcontext()
+
+    def stage(self, name):
+
+        return self._null_context
+
+    def add(self, name, seconds):
+
+        pass
+
+    def count(self, name, value=1):
+
+        pass
+
+
+DISABLED = DisabledInstrumentation()
+
+
+def count_queries(instrumentation, positions, transformed_strings, genome_positions):
+
+    '''
+    Adds the counters of the rows mapped by a reference version to an instrumentation.
+
+    The counters are queries, unmapped, out_of_range and insertion_hits : the in-range
+    positions that do not map, for which find_transcript_index() (or findTranscriptIndex())
+    prints "Most likely, it maps to an insertion".
+
+    Parameters:
+    -----------
+    positions : pandas.Series
+        The 0-based position of every row of the merged data frame (missing for the alignments without query).
+
+    transformed_strings : pandas.Series
+        The expanded CIGAR string of every row (missing for the queries without alignment).
+
+    genome_positions : pandas.Series
+        The genome position of every row (missing for the rows that do not map).
+    '''
+
+    queried = positions.notna()
+    lengths = transformed_strings.map(lambda string: len(string) - string.count('-') if isinstance(string, str) else 0)
+
+    # find_transcript_index() looks up the position -1 as the position 0
+    in_range = queried & (positions >= -1) & (positions < lengths)
+    unmapped = queried & genome_positions.isna()
+
+    instrumentation.count('queries', queried.sum())
+    instrumentation.count('unmapped', unmapped.sum())
+    instrumentation.count('out_of_range', (queried & ~in_range).sum())
+    instrumentation.count('insertion_hits', (in_range & unmapped).sum())
+
+_current = DISABLED
+
+
+def current():
+
+    '''
+    Returns the active instrumentation (DISABLED outside of instrumented()).
+    '''
+
+    return _current
+
+
+@contextlib.contextmanager
+def instrumented(instrumentation=None, **options):
+
+    '''
+    Activates an instrumentation for the duration of a with block.
+
+    Parameters:
+    -----------
+    instrumentation : Instrumentation, optional
+        The instrumentation to activate; by default, a new one built with the options.
+
+    **options :
+        The options of Instrumentation (profile, trace_memory).
+
+    Example:
+    --------
+    >>> with instrumented(trace_memory=True) as instrumentation:
+    ...     map_files('input_transcripts_alignments.txt', 'input_transcripts_positions.txt', 'output.txt')
+    >>> instrumentation.write('summary.json')
+    '''
+
+    global _current
+
+    if instrumentation is None:
+        instrumentation = Instrumentation(**options)
+
+    previous, _current = _current, instrumentation
+    instrumentation.start()
+    try:
+        yield instrumentation
+    finally:
+        instrumentation.stop()
+        _current = previous
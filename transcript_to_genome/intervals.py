@@ -0,0 +1,348 @@
+# coding: utf-8
+
+# Projection of transcript intervals onto the genome.
+
+# A feature of a transcript (an ORF, a domain, a probe) is a half-open
+# interval [start, end) of transcript positions. Instead of mapping its
+# positions one by one, the interval is cut along the CIGAR blocks it
+# overlaps :
+#
+#    8M7D6M2I2M11D7M, start 3, interval [5, 20)
+#
+#    transcript : [5, 8)    [8, 14)    [14, 16)   [16, 18)   [18, 20)
+#    genome     : [8, 11)   [18, 24)   24         [24, 26)   [37, 39)
+#    kind       : match     match      insertion  match      match
+#
+# Aligned blocks that follow each other on the genome (M, = and X without
+# anything between them) are merged into one genome block, so the blocks are
+# split at the deletions and the introns only. The transcript nucleotides that
+# are not on the genome (insertions and soft clips) are reported as blocks of
+# their own, with an empty genome range at the position where they are
+# inserted. The first block is found with a binary search, and the blocks are
+# then walked up to the end of the interval : O(log number_of_operations +
+# number_of_blocks).
+
+# The vectorized version lays the transcripts end to end on a transcript axis,
+# as AlignmentIndex does, and finds the first and the last block of every
+# interval with two np.searchsorted calls over all the blocks.
+
+from bisect import bisect_right
+from collections import namedtuple
+
+import numpy as np
+
+from .cigar import ALIGNED, CONSUMES_TRANSCRIPT
+from .reverse import MATCH
+from .store import OPERATION_CODES, AlignmentStore
+
+
+# The kind of a projected block : transcript nucleotides aligned to the genome
+# (M, =, X), or inserted between two genome positions (I, S)
+INSERTION = 'insertion'
+SOFT_CLIP = 'soft_clip'
+
+# The kinds of the blocks returned by BlockIndex.project(), by code
+KINDS = (MATCH, INSERTION, SOFT_CLIP)
+
+# The columns of the file written by project_file()
+PROJECTION_COLUMNS = ['transcript_name', 'start', 'end', 'chromosome', 'genome_start', 'genome_end', 'kind']
+
+GenomeBlock = namedtuple('GenomeBlock', ['transcript_start', 'transcript_end', 'genome_start', 'genome_end', 'kind'])
+GenomeBlock.__doc__ = '''
+A piece of a transcript interval and the genome range it covers, both half-open.
+
+For an insertion or a soft clip, the genome range is empty : genome_start is the
+genome position before which the transcript nucleotides are inserted.
+'''
+
+ProjectedBlocks = namedtuple('ProjectedBlocks', ['intervals', 'transcript_starts', 'transcript_ends',
+                                                 'genome_starts', 'genome_ends', 'kinds'])
+ProjectedBlocks.__doc__ = '''
+The genome blocks of many intervals, as NumPy arrays : the row of the interval
+each block belongs to, then the fields of GenomeBlock, with the kinds as codes
+into KINDS. The blocks of each interval are contiguous and in transcript order.
+'''
+
+
+def project_interval(alignment, start, end):
+
+    '''
+    Projects a transcript interval onto the genome.
+
+    Parameters:
+    -----------
+    alignment : Alignment
+        The alignment of the transcript.
+
+    start, end : int
+        The 0-based half-open interval [start, end) of transcript positions; the part
+        of the interval outside of the transcript is ignored.
+
+    Returns:
+    --------
+    list of GenomeBlock
+        The blocks covered by the interval, in transcript order; empty if the interval
+        does not overlap the transcript.
+
+    Example:
+    --------
+    >>> project_interval(Alignment.from_cigar("TR1", "CHR1", 3, "8M7D6M2I2M11D7M"), 12, 17)
+    [GenomeBlock(transcript_start=12, transcript_end=14, genome_start=22, genome_end=24, kind='match'),
+     GenomeBlock(transcript_start=14, transcript_end=16, genome_start=24, genome_end=24, kind='insertion'),
+     GenomeBlock(transcript_start=16, transcript_end=17, genome_start=24, genome_end=25, kind='match')]
+    '''
+
+    start = max(start, 0)
+    end = min(end, alignment.transcript_length)
+    if start >= end:
+        return []
+
+    lengths = alignment.lengths
+    operations = alignment.operations
+    transcript_offsets = alignment.transcript_offsets
+    genome_offsets = alignment.genome_offsets
+
+    blocks = []
+    block = bisect_right(transcript_offsets, start) - 1
+
+    while block < len(operations) and transcript_offsets[block] < end:
+        operation = operations[block]
+
+        # Deletions, introns, hard clips, padding and empty blocks only separate the blocks around them
+        if lengths[block] > 0 and operation in CONSUMES_TRANSCRIPT:
+            transcript_start = max(start, transcript_offsets[block])
+            transcript_end = min(end, transcript_offsets[block] + lengths[block])
+            genome_start = alignment.start + genome_offsets[block]
+
+            if operation not in ALIGNED:
+                blocks.append(GenomeBlock(transcript_start, transcript_end, genome_start, genome_start,
+                                          SOFT_CLIP if operation == 'S' else INSERTION))
+            else:
+                genome_start += transcript_start - transcript_offsets[block]
+                genome_end = genome_start + transcript_end - transcript_start
+                if blocks and blocks[-1].kind == MATCH and blocks[-1].genome_end == genome_start:
+                    blocks[-1] = blocks[-1]._replace(transcript_end=transcript_end, genome_end=genome_end)
+                else:
+                    blocks.append(GenomeBlock(transcript_start, transcript_end, genome_start, genome_end, MATCH))
+
+        block += 1
+
+    return blocks
+
+
+class BlockIndex:
+
+    '''
+    The CIGAR blocks of many transcripts, flattened into NumPy arrays, for the projection of intervals.
+
+    Unlike AlignmentIndex, it keeps the genome position of the insertions and soft
+    clips, and the kind of every block.
+
+    Parameters:
+    -----------
+    store : AlignmentStore
+        The alignments to index.
+
+    Attributes:
+    -----------
+    transcript_names, chromosome_names, chromosome_ids :
+        As in AlignmentStore.
+
+    transcript_lengths, transcript_bases, block_starts :
+        As in AlignmentIndex.
+
+    block_genome_starts : numpy.ndarray of int64
+        For each block, the genome position of its first nucleotide; for an insertion
+        or a soft clip, the genome position before which it is inserted.
+
+    block_kinds : numpy.ndarray of uint8
+        For each block, the code of its kind in KINDS.
+    '''
+
+    def __init__(self, store):
+
+        lengths, codes, transcript_offsets, genome_offsets = store.block_arrays()
+        owners = np.repeat(np.arange(len(store)), np.diff(store.offsets))
+
+        consumed = np.where(np.isin(codes, [OPERATION_CODES[operation] for operation in CONSUMES_TRANSCRIPT]),
+                            lengths, 0)
+        transcript_lengths = np.bincount(owners, weights=consumed, minlength=len(store)).astype(np.int64)
+
+        self.transcript_names = store.transcript_names
+        self.chromosome_names = store.chromosome_names
+        self.chromosome_ids = store.chromosome_ids
+        self.transcript_lengths = transcript_lengths
+        self.transcript_bases = np.cumsum(transcript_lengths) - transcript_lengths
+
+        # Deletions, introns, hard clips, padding and empty blocks do not cover any transcript coordinate
+        blocks = consumed > 0
+        codes = codes[blocks]
+        self.block_starts = self.transcript_bases[owners[blocks]] + transcript_offsets[blocks]
+        self.block_genome_starts = store.starts[owners[blocks]] + genome_offsets[blocks]
+        self.block_kinds = np.where(np.isin(codes, [OPERATION_CODES[operation] for operation in ALIGNED]),
+                                    KINDS.index(MATCH),
+                                    np.where(codes == OPERATION_CODES['S'], KINDS.index(SOFT_CLIP),
+                                             KINDS.index(INSERTION))).astype(np.uint8)
+
+        self._transcript_ids = store._transcript_ids
+
+    @classmethod
+    def from_file(cls, filename):
+
+        '''
+        Builds the index from a 4-column alignments file, a SAM or BAM file, or a binary index file.
+        '''
+
+        from .index_file import is_index_file, load_index
+        from .sam import is_bam_file, is_sam_file, read_records
+
+        if is_index_file(filename):
+            return cls(AlignmentStore(load_index(filename).records()))
+        if is_bam_file(filename) or is_sam_file(filename):
+            return cls(AlignmentStore((record.transcript_name, record.chromosome, record.start, record.cigar_string)
+                                      for record in read_records(filename)))
+
+        return cls(AlignmentStore.from_file(filename))
+
+    def __len__(self):
+
+        return len(self.transcript_names)
+
+    def transcript_ids(self, transcript_names):
+
+        '''
+        Converts transcript names into transcript ids, -1 for the names that are not in the index.
+        '''
+
+        transcript_ids = self._transcript_ids
+        return np.fromiter((transcript_ids.get(name, -1) for name in transcript_names),
+                           dtype=np.int64, count=len(transcript_names))
+
+    def project(self, transcript_ids, starts, ends):
+
+        '''
+        Projects many transcript intervals onto the genome, as project_interval() does.
+
+        Parameters:
+        -----------
+        transcript_ids : array-like of int
+            The transcript id of each interval, as returned by transcript_ids(); -1 for unknown transcripts.
+
+        starts, ends : array-like of int
+            The 0-based half-open interval [start, end) of each query.
+
+        Returns:
+        --------
+        ProjectedBlocks
+            The blocks of all the intervals; the intervals of unknown transcripts, and
+            those that do not overlap their transcript, have no block.
+        '''
+
+        transcript_ids = np.asarray(transcript_ids, dtype=np.int64)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+
+        known = transcript_ids >= 0
+        transcript_lengths = np.zeros(len(transcript_ids), dtype=np.int64)
+        transcript_lengths[known] = self.transcript_lengths[transcript_ids[known]]
+        bases = np.zeros(len(transcript_ids), dtype=np.int64)
+        bases[known] = self.transcript_bases[transcript_ids[known]]
+
+        # The intervals, clipped to their transcript, on the transcript axis
+        lower = bases + np.maximum(starts, 0)
+        upper = bases + np.minimum(ends, transcript_lengths)
+        valid = known & (lower < upper)
+
+        first = np.searchsorted(self.block_starts, lower, side='right') - 1
+        last = np.searchsorted(self.block_starts, upper, side='left') - 1
+        counts = np.where(valid, last - first + 1, 0)
+
+        # One row per (interval, block) pair
+        intervals = np.repeat(np.arange(len(transcript_ids)), counts)
+        if len(intervals) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return ProjectedBlocks(empty, empty, empty, empty, empty, np.zeros(0, dtype=np.uint8))
+        blocks =np.arange(len(intervals)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+
+        block_starts = self.block_starts[blocks]
+        block_ends = np.append(self.block_starts[1:], self.transcript_bases[-1:] + self.transcript_lengths[-1:])[blocks]
+        transcript_starts = np.maximum(block_starts, lower[intervals])
+        transcript_ends = np.minimum(block_ends, upper[intervals])
+
+        kinds = self.block_kinds[blocks]
+        aligned = kinds == KINDS.index(MATCH)
+        genome_starts = self.block_genome_starts[blocks] + np.where(aligned, transcript_starts - block_starts, 0)
+        genome_ends = genome_starts + np.where(aligned, transcript_ends - transcript_starts, 0)
+
+        # Aligned blocks that follow each other on the genome are merged into the first one
+        merged = np.zeros(len(intervals), dtype=bool)
+        merged[1:] = (aligned[1:] & aligned[:-1] & (intervals[1:] == intervals[:-1])
+                      & (genome_starts[1:] == genome_ends[:-1]))
+        heads = np.flatnonzero(~merged)
+        tails = np.append(heads[1:], len(intervals)) - 1
+
+        intervals = intervals[heads]
+        return ProjectedBlocks(intervals, transcript_starts[heads] - bases[intervals],
+                               transcript_ends[tails] - bases[intervals],
+                               genome_starts[heads], genome_ends[tails], kinds[heads])
+
+
+def project_file(alignments_filename, intervals_filename, output_filename):
+
+    '''
+    Projects the intervals of a file and writes their genome blocks to a TSV file.
+
+    Parameters:
+    -----------
+    alignments_filename : str
+        The alignments file (4 columns), or a SAM or BAM file.
+
+    intervals_filename : str
+        The intervals file : tab-separated, with a header line and the columns
+        transcript_name, start and end (0-based, half-open), plain or compressed.
+
+    output_filename : str
+        The output file, with the columns of PROJECTION_COLUMNS : one line per genome
+        block, in the order of the intervals. An interval without any block (unknown
+        transcript, or outside of its transcript) gets one line with empty genome fields.
+    '''
+
+    import pandas as pd
+
+    from .compression import open_input
+
+    index = BlockIndex.from_file(alignments_filename)
+
+    with open_input(intervals_filename, 'rb') as handle:
+        intervals = pd.read_csv(handle, sep='\t', header=0, names=['transcript_name', 'start', 'end'],
+                                dtype={'transcript_name': str, 'start': np.int64, 'end': np.int64})
+
+    transcript_ids = index.transcript_ids(intervals['transcript_name'].to_numpy())
+    projected = index.project(transcript_ids, intervals['start'].to_numpy(), intervals['end'].to_numpy())
+
+    # The intervals without block come back as rows without genome block, in their place
+    empty = np.setdiff1d(np.arange(len(intervals)), projected.intervals)
+    rows = np.concatenate((projected.intervals, empty))
+    order = np.argsort(rows, kind='stable')
+    has_block = np.arange(len(rows)) < len(projected.intervals)
+
+    def column(values, fill):
+        return np.concatenate((values, np.full(len(empty), fill, dtype=values.dtype)))[order]
+
+    rows = rows[order]
+    has_block = has_block[order]
+    chromosome_ids = np.append(index.chromosome_ids, -1)[transcript_ids[rows]]
+
+    output = pd.DataFrame({
+        'transcript_name': intervals['transcript_name'].to_numpy()[rows],
+        'start': np.where(has_block, column(projected.transcript_starts, 0), intervals['start'].to_numpy()[rows]),
+        'end': np.where(has_block, column(projected.transcript_ends, 0), intervals['end'].to_numpy()[rows]),
+        'chromosome': pd.Categorical.from_codes(np.where(has_block, chromosome_ids, -1),
+                                                categories=index.chromosome_names),
+        'genome_start': pd.arrays.IntegerArray(column(projected.genome_starts, 0), ~has_block),
+        'genome_end': pd.arrays.IntegerArray(column(projected.genome_ends, 0), ~has_block),
+        'kind': pd.Categorical.from_codes(column(projected.kinds.astype(np.int8), -1), categories=list(KINDS)),
+    }, columns=PROJECTION_COLUMNS)
+
+    output.to_csv(output_filename, sep='\t', index=False, na_rep='')
+    return output
@@ -0,0 +1,244 @@
+# coding: utf-8
+
+# Multi-core mapping of a positions file with a process pool.
+
+# The positions file is split into byte ranges that end on line boundaries.
+# Every task reads its own range, maps it against the alignment index and
+# writes the results, sorted by transcript name, into one run file per name
+# partition. Only the (filename, start, end) of a range travels to a worker :
+# the index is handed to the workers once, when the pool starts. With the
+# "fork" start method (the default on Linux) it is inherited from the parent
+# process without being copied or pickled. So is the table of the interned
+# transcript names, with the alphabetical ranks of the names already
+# computed : the tasks only intern the names of their own range.
+
+# The partitions split the sorted transcript names into ranges of similar
+# size, so that the runs of each partition can also be merged in parallel.
+# Runs are merged in task order, and the merged partitions are concatenated
+# in name order : the output is identical to the one of map_files().
+
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .batch import OUTPUT_COLUMNS, map_queries
+from .compression import detect_compression
+from .instrument import current
+from .join import NameTable, intern_positions
+from .sinks import write_tsv
+from .streaming import merge_runs, merge_runs_in_passes, unqueried_alignments
+
+
+DEFAULT_CHUNK_BYTES = 32 * 1024 * 1024
+
+# State of the worker processes, set once by _initialize_worker()
+_worker_index = None
+_worker_table = None
+_worker_boundaries = None
+
+
+def _initialize_worker(index, table, boundaries):
+
+    global _worker_index, _worker_table, _worker_boundaries
+    _worker_index = index
+    _worker_table = table
+    _worker_boundaries = boundaries
+
+
+def split_positions_file(filename, chunk_bytes=DEFAULT_CHUNK_BYTES):
+
+    '''
+    Splits a positions file into byte ranges that start and end on line boundaries.
+
+    Parameters:
+    -----------
+    filename : str
+        The positions file; its header line is not part of any range.
+
+    chunk_bytes : int, optional
+        The approximate size of each range.
+
+    Returns:
+    --------
+    list of (int, int)
+        The (start, end) byte offsets of the ranges, in file order.
+    '''
+
+    size = os.path.getsize(filename)
+    ranges = []
+
+    with open(filename, 'rb') as handle:
+        handle.readline()                         # Skip the header line
+        start = handle.tell()
+
+        while start < size:
+            end = start + chunk_bytes - 1
+            if end >= size:
+                end = size
+            else:
+                handle.seek(end)
+                handle.readline()                 # Move to the end of the current line
+                end = handle.tell()
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+def partition_boundaries(index, partitions):
+
+    '''
+    Chooses the transcript names that split the output into partitions of similar size.
+
+    Returns:
+    --------
+    numpy.ndarray of object
+        partitions - 1 sorted names; a name belongs to partition
+        np.searchsorted(boundaries, name, side='right').
+    '''
+
+    names = np.sort(index.transcript_names)
+    if len(names) == 0 or partitions <= 1:
+        return np.array([], dtype=object)
+
+    return np.unique(names[np.linspace(0, len(names), partitions, endpoint=False, dtype=np.int64)[1:]])
+
+
+def write_partitions(results, boundaries, run_filenames):
+
+    '''
+    Writes rows sorted by transcript name into one run file per partition.
+    '''
+
+    names = np.asarray(results['transcript_name'], dtype=object)
+    partitions = np.searchsorted(boundaries, names, side='right')
+
+    # Since the rows are sorted, the rows of each partition are contiguous
+    ends = np.searchsorted(partitions, np.arange(len(run_filenames)), side='right')
+    start = 0
+    for run_filename, end in zip(run_filenames, ends):
+        write_tsv(results.iloc[start:end], run_filename, header=False)
+        start = end
+
+
+def _map_range(task):
+
+    # Maps the positions of one byte range; returns the ids of the queried transcripts
+
+    positions_filename, start, end, run_filenames = task
+
+    with open(positions_filename, 'rb') as handle:
+        handle.seek(start)
+        data = handle.read(end - start)
+
+    chunk = pd.read_csv(io.BytesIO(data), sep='\t', header=None, names=['transcript_name', 'transcript_index'],
+                        dtype={'transcript_name': str, 'transcript_index': np.int64})
+
+    queries = intern_positions(_worker_table, chunk)
+    write_partitions(map_queries(_worker_index, _worker_table, queries, outer=False), _worker_boundaries, run_filenames)
+
+    # The name ids below len(index) are the transcript ids
+    return np.unique(queries.transcript_ids[queries.transcript_ids < len(_worker_index)])
+
+
+def _merge_partition(task):
+
+    run_filenames, directory, output_filename = task
+
+    run_filenames = merge_runs_in_passes(run_filenames, directory)
+    with open(output_filename, 'w') as output:
+        merge_runs(run_filenames, output)
+
+
+def map_file_parallel(index, positions_filename, output_filename, workers=None,
+                      chunk_bytes=DEFAULT_CHUNK_BYTES, temporary_directory=None):
+
+    '''
+    Maps a positions file with a pool of worker processes and writes the results to a TSV file.
+
+    Parameters:
+    -----------
+    index : AlignmentIndex
+        The indexed alignments, shared with the workers.
+
+    positions_filename : str
+        The positions file (columns transcript_name and transcript_coordinate).
+
+    output_filename : str
+        The output file; it has the same content as the one written by map_files().
+
+    workers : int, optional
+        The number of worker processes (by default, the number of CPUs).
+
+    chunk_bytes : int, optional
+        The approximate number of bytes of the positions file mapped by each task.
+
+    temporary_directory : str, optional
+        The directory in which the sorted runs are written (by default, the system one).
+    '''
+
+    # The tasks seek to byte offsets of the positions file
+    if detect_compression(positions_filename) is not None:
+        raise ValueError(f"{positions_filename} is compressed : the parallel mode needs an uncompressed positions file")
+
+    workers = workers or os.cpu_count() or 1
+    boundaries = partition_boundaries(index, workers)
+    partitions = len(boundaries) + 1
+
+    ranges = split_positions_file(positions_filename, chunk_bytes)
+
+    # Built once here rather than in every task : interning and sorting the names takes O(transcripts)
+    table = NameTable.for_index(index)
+    table.ranks()
+    table.categories()
+
+    # Sharing the index by inheritance needs fork; other start methods pickle it once per worker
+    start_methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in start_methods else None)
+
+    directory = tempfile.mkdtemp(prefix='transcript_to_genome_', dir=temporary_directory)
+    try:
+        partition_directories = [os.path.join(directory, f"partition_{partition}") for partition in range(partitions)]
+        for partition_directory in partition_directories:
+            os.mkdir(partition_directory)
+
+        def run_filenames(run):
+            return [os.path.join(partition_directory, f"run_{run}.tsv") for partition_directory in partition_directories]
+
+        tasks = [(positions_filename, start, end, run_filenames(run)) for run, (start, end) in enumerate(ranges)]
+
+        # The workers run in other processes : only the stages seen from this one are timed
+        instrumentation = current()
+
+        with context.Pool(workers, initializer=_initialize_worker, initargs=(index, table, boundaries)) as pool:
+            with instrumentation.stage('map_workers'):
+                queried = np.zeros(len(index), dtype=bool)
+                for transcript_ids in pool.imap(_map_range, tasks):
+                    queried[transcript_ids] = True
+
+                # The alignments without query come last : their names never appear in the other runs
+                write_partitions(unqueried_alignments(index, queried), boundaries, run_filenames(len(tasks)))
+
+            with instrumentation.stage('merge_runs'):
+                merged_filenames = [os.path.join(directory, f"merged_{partition}.tsv")
+                                    for partition in range(partitions)]
+                pool.map(_merge_partition, [
+                    ([task[3][partition] for task in tasks] + [run_filenames(len(tasks))[partition]],
+                     partition_directories[partition], merged_filenames[partition])
+                    for partition in range(partitions)])
+
+        instrumentation.count('tasks', len(tasks))
+        instrumentation.count('unqueried_alignments', np.count_nonzero(~queried))
+
+        with instrumentation.stage('write'), open(output_filename, 'w') as output:
+            output.write('\t'.join(OUTPUT_COLUMNS) + '\n')
+            for merged_filename in merged_filenames:
+                with open(merged_filename) as merged:
+                    shutil.copyfileobj(merged, output)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,47 @@
+# coding: utf-8
+
+# Access to the reference implementations of the repository :
+# version_procedural_programming/version_procedural_programming.py and
+# version_oop/version_OOP.py. They are scripts, not modules of this
+# package, so they are loaded from their file paths; both only run their
+# pipeline under __main__, so loading them has no side effect.
+
+import importlib.util
+import os
+
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROCEDURAL_SCRIPT = os.path.join(REPOSITORY, 'version_procedural_programming', 'version_procedural_programming.py')
+OOP_SCRIPT = os.path.join(REPOSITORY, 'version_oop', 'version_OOP.py')
+
+_modules = {}
+
+
+def _load(name, path):
+
+    if name not in _modules:
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[name] = module
+
+    return _modules[name]
+
+
+def load_procedural():
+
+    '''
+    Returns the module of the procedural version (transform_cigar, find_transcript_index, ...).
+    '''
+
+    return _load('version_procedural_programming', PROCEDURAL_SCRIPT)
+
+
+def load_oop():
+
+    '''
+    Returns the module of the object-oriented version (transcriptToGenome).
+    '''
+
+    return _load('version_OOP', OOP_SCRIPT)
@@ -0,0 +1,256 @@
+# coding: utf-8
+
+# Reverse mapping : from a genome position to the transcripts that cover it.
+
+# The genome span of every transcript, [start, start + genome_length), is
+# stored per chromosome in an implicit augmented interval tree (the layout of
+# cgranges) : the spans are sorted by start, the array index of a span gives
+# its place in a balanced binary tree, and each node keeps the largest end of
+# its subtree. A query visits O(log number_of_transcripts + hits) nodes.
+# Inside each overlapping transcript, the block that contains the position is
+# then found with a binary search over the genome offsets of its CIGAR blocks.
+
+from bisect import bisect_right
+from collections import namedtuple
+
+from .cigar import ALIGNED, Alignment, read_alignments
+
+
+# The kind of a hit : the genome position is aligned to a transcript
+# nucleotide (M, =, X), or lies in a deletion (D) or an intron (N) of the transcript
+MATCH = 'match'
+DELETION = 'deletion'
+INTRON = 'intron'
+
+TranscriptHit = namedtuple('TranscriptHit', ['transcript_name', 'transcript_position', 'kind'])
+TranscriptHit.__doc__ = '''
+A transcript that covers a genome position.
+
+transcript_position is the 0-based position of the aligned nucleotide for a
+match; for a deletion or an intron, it is the position of the first transcript
+nucleotide after it.
+'''
+
+
+class IntervalTree:
+
+    '''
+    A static interval tree over half-open intervals [start, end), stored in flat lists.
+
+    Parameters:
+    -----------
+    intervals : iterable of (int, int, object)
+        The (start, end, value) of every interval.
+    '''
+
+    def __init__(self, intervals):
+
+        intervals = sorted(intervals, key=lambda interval: interval[0])
+
+        self.starts = [interval[0] for interval in intervals]
+        self.ends = [interval[1] for interval in intervals]
+        self.values = [interval[2] for interval in intervals]
+        self.max_ends = list(self.ends)
+        self.max_level = self._index()
+
+    def __len__(self):
+
+        return len(self.starts)
+
+    def _index(self):
+
+        # Computes the largest end of every subtree, bottom-up. Leaves are the
+        # even indexes; a node at level k has the children i - 2**(k-1) and
+        # i + 2**(k-1). A right child past the end of the array stands for the
+        # rightmost existing subtree, whose largest end is kept in last.
+
+        n = len(self.starts)
+        if n == 0:
+            return -1
+
+        max_ends = self.max_ends
+        last_i = (n - 1) & ~1
+        last = max_ends[last_i]
+
+        k = 1
+        while 1 << k <= n:
+            x = 1 << (k - 1)
+            for i in range((x << 1) - 1, n, x << 2):
+                right = max_ends[i + x] if i + x < n else last
+                max_ends[i] = max(self.ends[i], max_ends[i - x], right)
+            last_i = last_i - x if (last_i >> k) & 1 else last_i + x
+            if last_i < n and max_ends[last_i] > last:
+                last = max_ends[last_i]
+            k += 1
+
+        return k - 1
+
+    def overlapping(self, start, end):
+
+        '''
+        Returns the values of the intervals that overlap [start, end), sorted by interval start.
+        '''
+
+        n = len(self.starts)
+        if n == 0:
+            return []
+
+        starts, ends, max_ends = self.starts, self.ends, self.max_ends
+        found = []
+
+        # Stack of (node, level, left child already visited)
+        stack = [((1 << self.max_level) - 1, self.max_level, False)]
+        while stack:
+            node, level, left_done = stack.pop()
+
+            if level <= 3:
+                # Small subtree : scan its nodes in order
+                first = node >> level << level
+                last = min(first + (1 << (level + 1)) - 1, n)
+                for i in range(first, last):
+                    if starts[i] >= end:
+                        break
+                    if start < ends[i]:
+                        found.append(self.values[i])
+            elif not left_done:
+                stack.append((node, level, True))
+                left = node - (1 << (level - 1))
+                if left >= n or max_ends[left] > start:
+                    stack.append((left, level - 1, False))
+            elif node < n and starts[node] < end:
+                if start < ends[node]:
+                    found.append(self.values[node])
+                stack.append((node + (1 << (level - 1)), level - 1, False))
+
+        return found
+
+
+class GenomeIndex:
+
+    '''
+    Index of the alignments by genome position, for genome to transcript queries.
+
+    Parameters:
+    -----------
+    alignments : iterable of Alignment
+        The alignments to index.
+    '''
+
+    def __init__(self, alignments):
+
+        self.alignments = list(alignments)
+
+        spans = {}
+        for alignment in self.alignments:
+            spans.setdefault(alignment.chromosome, []).append(
+                (alignment.start, alignment.start + alignment.genome_length, alignment))
+
+        self.trees = {chromosome: IntervalTree(intervals) for chromosome, intervals in spans.items()}
+
+    @classmethod
+    def from_file(cls, filename):
+
+        '''
+        Builds the index from a 4-column alignments file, a SAM or BAM file, or a binary index file.
+
+        A binary index does not tell deletions from introns : its genome gaps are
+        all reported as deletions (see AlignmentIndex.records()).
+        '''
+
+        from .index_file import is_index_file, load_index
+        from .sam import is_bam_file, is_sam_file, read_records
+
+        if is_index_file(filename):
+            records = load_index(filename).records()
+        elif is_bam_file(filename) or is_sam_file(filename):
+            records = read_records(filename)
+        else:
+            return cls(read_alignments(filename).values())
+
+        return cls(Alignment.from_cigar(transcript_name, chromosome, start, cigar_string)
+                   for transcript_name, chromosome, start, cigar_string in records)
+
+    def transcripts_at(self, chromosome, genome_position):
+
+        '''
+        Finds every transcript that covers a genome position.
+
+        Parameters:
+        -----------
+        chromosome : str
+            The chromosome name.
+
+        genome_position : int
+            The genome position, in the coordinates returned by the forward mapping.
+
+        Returns:
+        --------
+        list of TranscriptHit
+            One hit per transcript whose alignment spans the position, either on an
+            aligned nucleotide (MATCH) or inside a deletion (DELETION) or an intron (INTRON).
+
+        Example:
+        --------
+        >>> index = GenomeIndex.from_file('input_transcripts_alignments.txt')
+        >>> index.transcripts_at('CHR1', 23)
+        [TranscriptHit(transcript_name='TR1', transcript_position=13, kind='match')]
+        '''
+
+        tree = self.trees.get(chromosome)
+        if tree is None:
+            return []
+
+        hits = []
+        for alignment in tree.overlapping(genome_position, genome_position + 1):
+            hit = genome_to_transcript(alignment, genome_position)
+            if hit is not None:
+                hits.append(hit)
+
+        return hits
+
+    def locate(self, locus):
+
+        '''
+        Finds every transcript that covers a locus written as "CHROMOSOME:POSITION" (e.g. "CHR1:23").
+        '''
+
+        chromosome, _, genome_position = locus.rpartition(':')
+        if not chromosome:
+            raise ValueError(f"The locus {locus!r} is not of the form CHROMOSOME:POSITION")
+
+        return self.transcripts_at(chromosome, int(genome_position.replace(',', '')))
+
+
+def genome_to_transcript(alignment, genome_position):
+
+    '''
+    Maps a genome position back to one transcript.
+
+    Parameters:
+    -----------
+    alignment : Alignment
+        The alignment of the transcript.
+
+    genome_position : int
+        The genome position.
+
+    Returns:
+    --------
+    TranscriptHit or None
+        The hit, or None if the position is outside of the genome span of the alignment.
+    '''
+
+    genome_offset = genome_position - alignment.start
+    if genome_offset < 0 or genome_offset >= alignment.genome_length:
+        return None
+
+    # Insertions, clips, padding and empty blocks share the genome offset of the following block
+    block = bisect_right(alignment.genome_offsets, genome_offset) - 1
+    transcript_position = alignment.transcript_offsets[block]
+    operation = alignment.operations[block]
+
+    if operation in ALIGNED:
+        return TranscriptHit(alignment.transcript_name,
+                             transcript_position + genome_offset - alignment.genome_offsets[block], MATCH)
+
+    return TranscriptHit(alignment.transcript_name, transcript_position, INTRON if operation == 'N' else DELETION)
@@ -0,0 +1,254 @@
+# coding: utf-8
+
+# Streaming readers of SAM and BAM files, the output of the aligners.
+
+# Every alignment record is reduced to the 4 columns of the alignments file :
+# the read name (the transcript name), the reference name (the chromosome),
+# the position and the CIGAR string. The records are yielded one at a time,
+# so an AlignmentStore (and from it an AlignmentIndex) can be built while the
+# file is read, without converting it to the 4-column text file first and
+# without holding it in memory.
+#
+#    SAM   text, plain or compressed (gzip, BGZF, zstd); POS is 1-based and
+#          converted to the 0-based position of the first aligned nucleotide.
+#    BAM   BGZF-compressed binary. Its blocks are inflated by a pool of
+#          threads (see compression.py); the records are then decoded with struct.
+#
+# Unmapped records, records without CIGAR, and secondary or supplementary
+# alignments are skipped (a transcript keeps its primary alignment only).
+# CIGAR strings too long for the BAM record (more than 65535 operations,
+# stored in the CG tag) are not supported.
+
+import struct
+import zlib
+from collections import namedtuple
+
+from .cigar import CONSUMES_GENOME, parse_cigar
+from .compression import bgzf_compress, detect_compression, open_input
+from .store import OPERATION_BITS, OPERATION_MASK, OPERATIONS, pack_cigar
+
+
+AlignmentRecord = namedtuple('AlignmentRecord', ['transcript_name', 'chromosome', 'start', 'cigar_string'])
+AlignmentRecord.__doc__ = '''
+One alignment, as a line of the alignments file : the start is the 0-based
+genome position of the first aligned nucleotide.
+'''
+
+# Flags of the records that are skipped : unmapped, secondary, supplementary
+FLAG_UNMAPPED = 0x4
+FLAG_SECONDARY = 0x100
+FLAG_SUPPLEMENTARY = 0x800
+
+BAM_MAGIC = b'BAM\x01'
+
+# The fixed part of a BAM record, after its block_size :
+# refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen
+BAM_RECORD = struct.Struct('<iiBBHHHiiii')
+
+
+def _skipped(flag, chromosome, cigar, primary_only):
+
+    if flag & FLAG_UNMAPPED or chromosome == '*' or cigar == '*':
+        return True
+    return primary_only and flag & (FLAG_SECONDARY | FLAG_SUPPLEMENTARY)
+
+
+def read_sam(filename, primary_only=True):
+
+    '''
+    Yields the AlignmentRecord of every mapped record of a SAM file (plain or compressed).
+
+    Parameters:
+    -----------
+    filename : str
+        The SAM file.
+
+    primary_only : bool, optional
+        If False, the secondary and supplementary alignments are yielded as well.
+
+    Yields:
+    -------
+    AlignmentRecord
+    '''
+
+    with open_input(filename, 'rt') as handle:
+        for line_number, line in enumerate(handle, start=1):
+            if line.startswith('@') or not line.strip():
+                continue
+
+            fields = line.rstrip('\r\n').split('\t', 6)
+            if len(fields) < 6:
+                raise ValueError(f"{filename}, line {line_number} : expected at least 6 columns")
+
+            transcript_name, flag, chromosome, position, _, cigar_string = fields[:6]
+            if _skipped(int(flag), chromosome, cigar_string, primary_only):
+                continue
+
+            yield AlignmentRecord(transcript_name, chromosome, int(position) - 1, cigar_string)
+
+
+def _read_exactly(handle, size):
+
+    data = handle.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated BAM file')
+    return data
+
+
+def read_bam(filename, primary_only=True):
+
+    '''
+    Yields the AlignmentRecord of every mapped record of a BAM file.
+
+    Parameters:
+    -----------
+    filename : str
+        The BAM file.
+
+    primary_only : bool, optional
+        If False, the secondary and supplementary alignments are yielded as well.
+
+    Yields:
+    -------
+    AlignmentRecord
+    '''
+
+    with open_input(filename, 'rb') as handle:
+        if handle.read(4) != BAM_MAGIC:
+            raise ValueError(f"{filename} is not a BAM file")
+
+        text_length, = struct.unpack('<i', _read_exactly(handle, 4))
+        _read_exactly(handle, text_length)                # The SAM header text
+
+        reference_count, = struct.unpack('<i', _read_exactly(handle, 4))
+        references = []
+        for _ in range(reference_count):
+            name_length, = struct.unpack('<i', _read_exactly(handle, 4))
+            references.append(_read_exactly(handle, name_length).rstrip(b'\x00').decode())
+            _read_exactly(handle, 4)                      # The reference length
+
+        while True:
+            size = handle.read(4)
+            if not size:
+                break
+            block_size, = struct.unpack('<i', size)
+            record = _read_exactly(handle, block_size)
+
+            (reference_id, position, name_length, _, _, operation_count, flag,
+             _, _, _, _) = BAM_RECORD.unpack_from(record)
+
+            chromosome = references[reference_id] if reference_id >= 0 else '*'
+            if _skipped(flag, chromosome, '*' if operation_count == 0 else None, primary_only):
+                continue
+
+            name_end = BAM_RECORD.size + name_length
+            transcript_name = record[BAM_RECORD.size:name_end - 1].decode()
+            operations = struct.unpack_from(f'<{operation_count}I', record, name_end)
+
+            yield AlignmentRecord(transcript_name, chromosome, position,
+                                  ''.join(f"{value >> OPERATION_BITS}{OPERATIONS[value & OPERATION_MASK]}"
+                                          for value in operations))
+
+
+def is_bam_file(filename):
+
+    '''
+    Tells whether a file is a BAM file (gzip-compressed, starting with the BAM magic number).
+    '''
+
+    if detect_compression(filename) not in ('bgzf', 'gzip'):
+        return False
+
+    try:
+        with open_input(filename, 'rb', threads=1) as handle:
+            return handle.read(4) == BAM_MAGIC
+    except (OSError, EOFError, ValueError, zlib.error):
+        return False
+
+
+def is_sam_file(filename):
+
+    '''
+    Tells whether a file is a SAM file : a .sam or .sam.gz file, or a file whose first line is a SAM header line.
+    '''
+
+    if filename.endswith(('.sam', '.sam.gz')):
+        return True
+
+    try:
+        with open_input(filename, 'rt', threads=1) as handle:
+            return handle.read(4) in ('@HD\t', '@SQ\t')
+    except (OSError, EOFError, ImportError, UnicodeDecodeError, ValueError, zlib.error):
+        return False
+
+
+def read_records(filename, primary_only=True):
+
+    '''
+    Yields the AlignmentRecord of a SAM or BAM file, whichever filename is.
+    '''
+
+    if is_bam_file(filename):
+        return read_bam(filename, primary_only=primary_only)
+
+    return read_sam(filename, primary_only=primary_only)
+
+
+def write_sam(records, filename):
+
+    '''
+    Writes AlignmentRecords as a minimal SAM file (e.g. to test the readers).
+    '''
+
+    records = list(records)
+    chromosomes = list(dict.fromkeys(record.chromosome for record in records))
+
+    with open(filename, 'w') as handle:
+        handle.write('@HD\tVN:1.6\n')
+        for chromosome in chromosomes:
+            handle.write(f"@SQ\tSN:{chromosome}\tLN:{2 ** 31 - 1}\n")
+        for record in records:
+            handle.write(f"{record.transcript_name}\t0\t{record.chromosome}\t{record.start + 1}\t255\t"
+                         f"{record.cigar_string}\t*\t0\t0\t*\t*\n")
+
+
+def _region_bin(start, end):
+
+    # The BAM bin of the region [start, end), as reg2bin() of the SAM specification
+
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if start >> shift == end >> shift:
+            return offset + (start >> shift)
+    return 0
+
+
+def write_bam(records, filename):
+
+    '''
+    Writes AlignmentRecords as a minimal BGZF-compressed BAM file (e.g. to test the readers).
+    '''
+
+    records = list(records)
+    chromosomes = list(dict.fromkeys(record.chromosome for record in records))
+    chromosome_ids = {chromosome: chromosome_id for chromosome_id, chromosome in enumerate(chromosomes)}
+
+    text = b'@HD\tVN:1.6\n'
+    data = [BAM_MAGIC, struct.pack('<i', len(text)), text, struct.pack('<i', len(chromosomes))]
+    for chromosome in chromosomes:
+        name = chromosome.encode() + b'\x00'
+        data.append(struct.pack('<i', len(name)) + name + struct.pack('<i', 2 ** 31 - 1))
+
+    for record in records:
+        name = record.transcript_name.encode() + b'\x00'
+        operations = pack_cigar(record.cigar_string)
+        genome_length = sum(length for length, operation in parse_cigar(record.cigar_string)
+                            if operation in CONSUMES_GENOME)
+        region_bin = _region_bin(record.start, record.start + max(genome_length, 1))
+        body = (BAM_RECORD.pack(chromosome_ids[record.chromosome], record.start, len(name), 255, region_bin,
+                                len(operations), 0, 0, -1, -1, 0)
+                + name + struct.pack(f'<{len(operations)}I', *operations))
+        data.append(struct.pack('<i', len(body)) + body)
+
+    with open(filename, 'wb') as handle:
+        handle.write(bgzf_compress(b''.join(data)))
@@ -0,0 +1,405 @@
+# coding: utf-8
+
+# Mapping service for online lookups (e.g. the backend of a genome browser).
+
+# The alignment index is loaded once and kept in memory by an asyncio server,
+# which speaks a minimal HTTP/1.1 over TCP or over a Unix socket :
+#
+#    GET  /map?q=TR1:4&q=TR2:0
+#    POST /map        {"queries": [["TR1", 4], ["TR2", 0]]}
+#    GET  /stats
+#
+# Each request only holds a few positions, so calling NumPy per request
+# would mostly cost the call overhead. The queries of the requests that
+# arrive within max_delay seconds of each other are therefore coalesced into
+# one micro-batch, mapped by a single AlignmentIndex.genome_positions() call,
+# and the results are handed back to every request. The latency of each
+# request (from its arrival to its response) is recorded, and /stats reports
+# the p50 and p99 of the recent requests.
+
+import asyncio
+import collections
+import json
+import re
+import time
+import urllib.parse
+
+import numpy as np
+
+from .batch import UNMAPPED
+
+
+DEFAULT_MAX_DELAY = 0.001
+DEFAULT_MAX_BATCH_SIZE = 65536
+LATENCY_WINDOW = 10000
+
+# Positions outside of this range do not fit in the int64 arrays of the index
+POSITION_MIN, POSITION_MAX = np.iinfo(np.int64).min, np.iinfo(np.int64).max
+
+# The positions of the GET queries : decimal digits, with an optional minus sign
+POSITION_PATTERN = re.compile(r'-?[0-9]+')
+
+# Requests with a larger body are refused with 413, before the body is read
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large'}
+
+
+class LatencyRecorder:
+
+    '''
+    Keeps the latencies of the last requests, in seconds, and their percentiles.
+
+    Parameters:
+    -----------
+    window : int, optional
+        The number of recent requests over which the percentiles are computed.
+    '''
+
+    def __init__(self, window=LATENCY_WINDOW):
+
+        self.latencies = collections.deque(maxlen=window)
+        self.count = 0
+
+    def add(self, seconds):
+
+        self.latencies.append(seconds)
+        self.count += 1
+
+    def percentile(self, percent):
+
+        '''
+        Returns the given percentile of the recent latencies, in seconds (None before any request).
+        '''
+
+        if not self.latencies:
+            return None
+        return float(np.percentile(np.fromiter(self.latencies, dtype=np.float64), percent))
+
+
+class MicroBatcher:
+
+    '''
+    Coalesces the queries of concurrent requests into batches for the vectorized mapper.
+
+    Parameters:
+    -----------
+    index : AlignmentIndex
+        The indexed alignments.
+
+    max_delay : float, optional
+        The longest time, in seconds, that a query waits for other queries to join its batch.
+
+    max_batch_size : int, optional
+        A batch is mapped as soon as it holds this many queries.
+    '''
+
+    def __init__(self, index, max_delay=DEFAULT_MAX_DELAY, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+
+        self.index = index
+        self.max_delay = max_delay
+        self.max_batch_size = max_batch_size
+
+        self.batches = 0
+        self.queries = 0
+
+        self._pending = []
+        self._pending_size = 0
+        self._timer = None
+
+    async def genome_positions(self, transcript_ids, transcript_positions):
+
+        '''
+        Maps (transcript id, 0-based position) queries within the next batch.
+
+        The queries are converted before they join the batch, so that a malformed
+        request fails on its own instead of failing the requests batched with it.
+
+        Raises:
+        -------
+        ValueError
+            If the queries cannot be held as int64 arrays of the same length.
+
+        Returns:
+        --------
+        numpy.ndarray of int64
+            The genome position of each query, or UNMAPPED.
+        '''
+
+        try:
+            transcript_ids = np.asarray(transcript_ids, dtype=np.int64)
+            transcript_positions = np.asarray(transcript_positions, dtype=np.int64)
+        except OverflowError as error:
+            raise ValueError(str(error)) from None
+        if transcript_ids.shape != transcript_positions.shape or transcript_ids.ndim != 1:
+            raise ValueError("Expected as many transcript ids as transcript positions")
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((transcript_ids, transcript_positions, future))
+        self._pending_size += len(transcript_ids)
+
+        if self._pending_size >= self.max_batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self.flush)
+
+        return await future
+
+    def flush(self):
+
+        '''
+        Maps all the pending queries at once and resolves their requests.
+        '''
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        pending, self._pending, self._pending_size = self._pending, [], 0
+        if not pending:
+            return
+
+        sizes = [len(transcript_ids) for transcript_ids, _, _ in pending]
+        try:
+            genome_positions = self.index.genome_positions(
+                np.concatenate([transcript_ids for transcript_ids, _, _ in pending]),
+                np.concatenate([transcript_positions for _, transcript_positions, _ in pending]))
+        except Exception as error:
+            for _, _, future in pending:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        self.batches += 1
+        self.queries += len(genome_positions)
+
+        for (_, _, future), results in zip(pending, np.split(genome_positions, np.cumsum(sizes)[:-1])):
+            if not future.done():
+                future.set_result(results)
+
+
+def parse_queries(method, query_string, body):
+
+    '''
+    Extracts the (transcript name, 0-based position) queries of a /map request.
+
+    The positions must be integers : JSON numbers without fraction or exponent (not
+    booleans) in a POST body, decimal digits with an optional '-' in a GET query.
+
+    Returns:
+    --------
+    (list of str, numpy.ndarray of int64)
+        The transcript name and the position of every query.
+
+    Raises:
+    -------
+    ValueError
+        If the queries are malformed, or a position does not fit in an int64.
+    '''
+
+    transcript_names, transcript_positions = [], []
+
+    if method == 'GET':
+        for query in urllib.parse.parse_qs(query_string).get('q', []):
+            transcript_name, separator, position = query.rpartition(':')
+            if not separator or not POSITION_PATTERN.fullmatch(position):
+                raise ValueError(f"Expected TRANSCRIPT:POSITION, got {query!r}")
+            transcript_names.append(transcript_name)
+            transcript_positions.append(int(position))
+    else:
+        for transcript_name, position in json.loads(body or b'{}').get('queries', []):
+            # bool is a subclass of int : true and false are not positions
+            if type(position) is not int:
+                raise ValueError(f"Expected an integer position, got {position!r}")
+            transcript_names.append(str(transcript_name))
+            transcript_positions.append(position)
+
+    for position in transcript_positions:
+        if not POSITION_MIN <= position <= POSITION_MAX:
+            raise ValueError(f"Position out of range : {position}")
+
+    return transcript_names, np.array(transcript_positions, dtype=np.int64)
+
+
+class MappingServer:
+
+    '''
+    Asyncio server that maps transcript positions against an index kept in memory.
+
+    Parameters:
+    -----------
+    index : AlignmentIndex
+        The indexed alignments (e.g. from index_file.open_alignments()).
+
+    max_delay, max_batch_size :
+        The batching parameters, see MicroBatcher.
+    '''
+
+    def __init__(self, index, max_delay=DEFAULT_MAX_DELAY, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+
+        self.index = index
+        self.batcher = MicroBatcher(index, max_delay=max_delay, max_batch_size=max_batch_size)
+        self.latency = LatencyRecorder()
+
+    async def start(self, host='127.0.0.1', port=8080, path=None):
+
+        '''
+        Starts listening on a Unix socket if path is given, otherwise on host:port.
+
+        Returns:
+        --------
+        asyncio.Server
+        '''
+
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle_connection, path=path)
+        return await asyncio.start_server(self.handle_connection, host=host, port=port)
+
+    async def serve_forever(self, host='127.0.0.1', port=8080, path=None):
+
+        server = await self.start(host=host, port=port, path=path)
+        async with server:
+            await server.serve_forever()
+
+    def stats(self):
+
+        '''
+        Returns the counters of the server and the p50 / p99 latencies, in milliseconds.
+        '''
+
+        def milliseconds(seconds):
+            return None if seconds is None else seconds * 1000
+
+        return {
+            'requests': self.latency.count,
+            'batches': self.batcher.batches,
+            'queries': self.batcher.queries,
+            'latency_ms': {
+                'p50': milliseconds(self.latency.percentile(50)),
+                'p99': milliseconds(self.latency.percentile(99)),
+            },
+        }
+
+    async def map_queries(self, transcript_names, transcript_positions):
+
+        '''
+        Maps queries through the batcher and formats their results as JSON objects.
+        '''
+
+        index = self.index
+        transcript_ids = index.transcript_ids(transcript_names)
+        genome_positions = await self.batcher.genome_positions(transcript_ids, transcript_positions)
+
+        results = []
+        for transcript_name, position, transcript_id, genome_position in zip(
+                transcript_names, np.asarray(transcript_positions).tolist(), transcript_ids.tolist(),
+                genome_positions.tolist()):
+            results.append({
+                'transcript_name': transcript_name,
+                'transcript_index': position,
+                'chromosome': index.chromosome_names[index.chromosome_ids[transcript_id]] if transcript_id >= 0 else None,
+                'genome_index': None if genome_position == UNMAPPED else genome_position,
+            })
+
+        return results
+
+    async def respond(self, method, target, body):
+
+        '''
+        Returns the (status, JSON document) of one request.
+        '''
+
+        path, _, query_string = target.partition('?')
+
+        if path == '/stats':
+            return 200, self.stats()
+
+        if path != '/map':
+            return 404, {'error': f"Unknown path {path}"}
+        if method not in ('GET', 'POST'):
+            return 405, {'error': f"Unsupported method {method}"}
+
+        try:
+            transcript_names, transcript_positions = parse_queries(method, query_string, body)
+            results = await self.map_queries(transcript_names, transcript_positions)
+        except (ValueError, TypeError, AttributeError) as error:
+            return 400, {'error': str(error)}
+
+        return 200, {'results': results}
+
+    async def handle_connection(self, reader, writer):
+
+        '''
+        Serves the HTTP/1.1 requests of one connection (kept alive between requests).
+
+        A request whose request line or Content-Length cannot be parsed is answered
+        with 400, and one whose body is larger than MAX_BODY_SIZE with 413; the
+        connection is then closed.
+        '''
+
+        def write_response(status, document, keep_alive):
+            payload = json.dumps(document).encode()
+            writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                         f"Content-Type: application/json\r\n"
+                         f"Content-Length: {len(payload)}\r\n"
+                         f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + payload)
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                arrival = time.perf_counter()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError(f"Negative Content-Length : {length}")
+                except ValueError as error:
+                    write_response(400, {'error': f"Malformed request : {error}"}, keep_alive=False)
+                    await writer.drain()
+                    break
+                if length > MAX_BODY_SIZE:
+                    write_response(413, {'error': f"Request body larger than {MAX_BODY_SIZE} bytes"}, keep_alive=False)
+                    await writer.drain()
+                    break
+
+                body = await reader.readexactly(length) if length else b''
+
+                status, document = await self.respond(method, target, body)
+
+                keep_alive = (headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1')
+                write_response(status, document, keep_alive)
+                await writer.drain()
+
+                if target.startswith('/map'):
+                    self.latency.add(time.perf_counter() - arrival)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def serve(index, host='127.0.0.1', port=8080, path=None, max_delay=DEFAULT_MAX_DELAY,
+          max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+
+    '''
+    Runs a MappingServer until it is interrupted.
+    '''
+
+    server = MappingServer(index, max_delay=max_delay, max_batch_size=max_batch_size)
+    try:
+        asyncio.run(server.serve_forever(host=host, port=port, path=path))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,285 @@
+# coding: utf-8
+
+# Output sinks for the mapped positions.
+
+# The results are written chunk by chunk through a sink :
+#
+#    tsv      the text format of output_genome_positions.txt. The chunks are
+#             formatted column by column (the names and chromosomes come from
+#             the categories of their Categorical columns) and joined into
+#             one string, written to a large buffered file.
+#    binary   a compact fixed-width format : a magic number, one 24-byte
+#             record per row (transcript id, chromosome id, transcript index,
+#             genome index), then the table of the transcript names and the
+#             table of the chromosome names, and a trailer locating them.
+#             Missing values are MISSING (ids : -1).
+#    arrow    an Arrow IPC file, one record batch per chunk (needs pyarrow).
+#    parquet  a Parquet file, one row group per chunk (needs pyarrow).
+
+import json
+import struct
+
+import numpy as np
+
+from .batch import OUTPUT_COLUMNS
+
+
+DEFAULT_CHUNK_ROWS = 1 << 18
+BUFFER_SIZE = 1 << 22
+
+BINARY_MAGIC = b'T2GOUT\x00\x01'
+BINARY_TRAILER = struct.Struct('<3q')
+BINARY_RECORD = np.dtype([('transcript_id', '<i4'), ('chromosome_id', '<i4'),
+                          ('transcript_index', '<i8'), ('genome_index', '<i8')])
+
+# Missing transcript or genome index in the binary format
+MISSING = np.iinfo(np.int64).min
+
+# Output format of each file extension; other files are written as TSV
+EXTENSIONS = {'.bin': 'binary', '.arrow': 'arrow', '.feather': 'arrow', '.parquet': 'parquet'}
+
+
+def _column_strings(column):
+
+    '''
+    Formats a column as an array of str, with '' for the missing values.
+    '''
+
+    import pandas as pd
+
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        categories = np.asarray(column.cat.categories.astype(str), dtype=object)
+        return np.append(categories, '')[column.cat.codes.to_numpy()]
+
+    missing = column.isna().to_numpy()
+    if pd.api.types.is_integer_dtype(column.dtype):
+        values = column.to_numpy(dtype=np.int64, na_value=0).tolist()
+    else:
+        values = column.tolist()
+
+    strings = np.array(list(map(str, values)), dtype=object)
+    strings[missing] = ''
+    return strings
+
+
+def _category_ids(column, table):
+
+    '''
+    Interns the values of a column into a name table (a dict) and returns their ids (-1 if missing).
+    '''
+
+    import pandas as pd
+
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        codes = column.cat.codes.to_numpy()
+        values = column.cat.categories
+    else:
+        codes, values = pd.factorize(column)
+
+    # Only the values used by the chunk are interned : a chunk of a large result
+    # set uses a small part of the categories of its transcript names
+    used = np.flatnonzero(np.bincount(codes[codes >= 0], minlength=len(values)))
+    ids = np.full(len(values) + 1, -1, dtype=np.int32)
+    ids[used] = [table.setdefault(value, len(table)) for value in values[used]]
+    return ids[codes]
+
+
+class TsvSink:
+
+    '''
+    Writes the results as a tab-separated text file, as DataFrame.to_csv() does.
+
+    Parameters:
+    -----------
+    filename : str
+        The output file.
+
+    header : bool, optional
+        If False, the line of the column names is left out (e.g. for the runs of the streaming mode).
+
+    buffer_size : int, optional
+        The size of the write buffer, in bytes.
+    '''
+
+    def __init__(self, filename, header=True, buffer_size=BUFFER_SIZE):
+
+        self.handle = open(filename, 'w', buffering=buffer_size)
+        if header:
+            self.handle.write('\t'.join(OUTPUT_COLUMNS) + '\n')
+
+    def write(self, chunk):
+
+        if len(chunk):
+            columns = [_column_strings(chunk[column]) for column in OUTPUT_COLUMNS]
+            self.handle.write('\n'.join(map('\t'.join, zip(*columns))) + '\n')
+
+    def close(self):
+
+        self.handle.close()
+
+
+class BinarySink:
+
+    '''
+    Writes the results as fixed-width binary records (see read_binary()).
+    '''
+
+    def __init__(self, filename):
+
+        self.handle = open(filename, 'wb', buffering=BUFFER_SIZE)
+        self.handle.write(BINARY_MAGIC)
+        self.transcript_names = {}
+        self.chromosome_names = {}
+        self.rows = 0
+
+    def write(self, chunk):
+
+        records = np.empty(len(chunk), dtype=BINARY_RECORD)
+        records['transcript_id'] = _category_ids(chunk['transcript_name'], self.transcript_names)
+        records['chromosome_id'] = _category_ids(chunk['chromosome'], self.chromosome_names)
+        for column in ('transcript_index', 'genome_index'):
+            records[column] = chunk[column].to_numpy(dtype=np.int64, na_value=MISSING)
+
+        self.handle.write(records.tobytes())
+        self.rows += len(records)
+
+    def close(self):
+
+        tables = json.dumps({'transcript_names': list(self.transcript_names),
+                             'chromosome_names': list(self.chromosome_names)}).encode()
+        tables_offset = len(BINARY_MAGIC) + self.rows * BINARY_RECORD.itemsize
+
+        self.handle.write(tables)
+        self.handle.write(BINARY_TRAILER.pack(self.rows, tables_offset, len(tables)))
+        self.handle.close()
+
+
+class ArrowSink:
+
+    '''
+    Writes the results as an Arrow IPC file (format='arrow') or a Parquet file (format='parquet').
+    '''
+
+    def __init__(self, filename, format='arrow'):
+
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError(f"pyarrow is required to write the {format} output format") from None
+
+        self.pyarrow = pyarrow
+        self.filename = filename
+        self.format = format
+        self.writer = None
+
+    def write(self, chunk):
+
+        table = self.pyarrow.Table.from_pandas(chunk[OUTPUT_COLUMNS], preserve_index=False)
+
+        if self.writer is None:
+            if self.format == 'parquet':
+                import pyarrow.parquet
+
+                self.writer = pyarrow.parquet.ParquetWriter(self.filename, table.schema)
+            else:
+                import pyarrow.ipc
+
+                self.writer = pyarrow.ipc.new_file(self.filename, table.schema)
+
+        self.writer.write_table(table)
+
+    def close(self):
+
+        if self.writer is not None:
+            self.writer.close()
+
+
+def open_sink(filename, format=None):
+
+    '''
+    Opens the sink of an output file.
+
+    Parameters:
+    -----------
+    filename : str
+        The output file.
+
+    format : str, optional
+        'tsv', 'binary', 'arrow' or 'parquet'; by default, guessed from the extension of filename.
+
+    Returns:
+    --------
+    TsvSink, BinarySink or ArrowSink
+        An object with the methods write(chunk) and close().
+    '''
+
+    if format is None:
+        format = next((format for extension, format in EXTENSIONS.items() if filename.endswith(extension)), 'tsv')
+
+    if format == 'tsv':
+        return TsvSink(filename)
+    if format == 'binary':
+        return BinarySink(filename)
+    if format in ('arrow', 'parquet'):
+        return ArrowSink(filename, format=format)
+
+    raise ValueError(f"Unknown output format {format!r}")
+
+
+def write_chunks(sink, results, chunk_rows=DEFAULT_CHUNK_ROWS):
+
+    '''
+    Writes a DataFrame of results (see batch.map_positions()) to a sink chunk by chunk, then closes the sink.
+    '''
+
+    try:
+        # An empty DataFrame is still written once, for the formats that store a schema
+        for chunk_start in range(0, max(len(results), 1), chunk_rows):
+            sink.write(results.iloc[chunk_start:chunk_start + chunk_rows])
+    finally:
+        sink.close()
+
+
+def write_results(results, filename, format=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+
+    '''
+    Writes a DataFrame of results to a file, in the format given or guessed by open_sink().
+    '''
+
+    write_chunks(open_sink(filename, format=format), results, chunk_rows=chunk_rows)
+
+
+def write_tsv(results, filename, header=True, chunk_rows=DEFAULT_CHUNK_ROWS):
+
+    '''
+    Writes a DataFrame of results as a TSV file, with or without the line of the column names.
+    '''
+
+    write_chunks(TsvSink(filename, header=header), results, chunk_rows=chunk_rows)
+
+
+def read_binary(filename):
+
+    '''
+    Reads a file written by BinarySink into a DataFrame like the one of batch.map_positions().
+    '''
+
+    import pandas as pd
+
+    with open(filename, 'rb') as handle:
+        data = handle.read()
+
+    if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError(f"{filename} is not a binary output file")
+
+    rows, tables_offset, tables_length = BINARY_TRAILER.unpack_from(data, len(data) - BINARY_TRAILER.size)
+    records = np.frombuffer(data, dtype=BINARY_RECORD, count=rows, offset=len(BINARY_MAGIC))
+    tables = json.loads(data[tables_offset:tables_offset + tables_length])
+
+    return pd.DataFrame({
+        'transcript_name': pd.Categorical.from_codes(records['transcript_id'], categories=tables['transcript_names']),
+        'transcript_index': pd.arrays.IntegerArray(records['transcript_index'].copy(),
+                                                   records['transcript_index'] == MISSING),
+        'chromosome': pd.Categorical.from_codes(records['chromosome_id'], categories=tables['chromosome_names']),
+        'genome_index': pd.arrays.IntegerArray(records['genome_index'].copy(), records['genome_index'] == MISSING),
+    }, columns=OUTPUT_COLUMNS)
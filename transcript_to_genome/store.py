@@ -0,0 +1,269 @@
+# coding: utf-8
+
+# Compact, array-backed store of transcript alignments.
+
+# A DataFrame of alignments holds three Python strings per transcript (name,
+# chromosome, CIGAR string), plus the expanded CIGAR string of the reference
+# versions, one character per base. The store keeps instead :
+#
+#    transcript_names   one str per transcript
+#    chromosome_ids     int32, into a small table of the distinct chromosome names
+#    starts             int64
+#    operations         uint32, all the CIGAR operations of all the transcripts,
+#                       end to end, each packed as length << 4 | code
+#    offsets            int64, the operations of transcript i are
+#                       operations[offsets[i]:offsets[i + 1]]
+#
+# The codes are the ones of the BAM format (M=0, I=1, D=2, N=3, S=4, H=5,
+# P=6, '='=7, X=8), so the lengths are limited to 2**28 - 1. A transcript is
+# read back as a StoredAlignment, a two-slot view on the store.
+
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from .cigar import CONSUMES_GENOME, CONSUMES_TRANSCRIPT, parse_cigar
+from .compression import open_input
+
+
+# The operation of each code, as in the BAM format
+OPERATIONS = 'MIDNSHP=X'
+OPERATION_CODES = {operation: code for code, operation in enumerate(OPERATIONS)}
+
+OPERATION_BITS = 4
+OPERATION_MASK = (1 << OPERATION_BITS) - 1
+MAX_OPERATION_LENGTH = (1 << (32 - OPERATION_BITS)) - 1
+
+
+def pack_cigar(cigar_string):
+
+    '''
+    Packs the operations of a CIGAR string into a list of length << 4 | code integers.
+
+    Raises ValueError if the CIGAR string is malformed (see parse_cigar()) or if an
+    operation is longer than MAX_OPERATION_LENGTH.
+
+    Example:
+    --------
+    >>> pack_cigar("8M7D6M")
+    [128, 114, 96]
+    '''
+
+    packed = []
+    for length, operation in parse_cigar(cigar_string):
+        if length > MAX_OPERATION_LENGTH:
+            raise ValueError(f"CIGAR operation {length}{operation} is longer than {MAX_OPERATION_LENGTH}")
+        packed.append(length << OPERATION_BITS | OPERATION_CODES[operation])
+
+    return packed
+
+
+class StoredAlignment:
+
+    '''
+    One transcript of an AlignmentStore.
+
+    It can be used where a row of the alignments DataFrame is expected : the keys
+    'transcript_name', 'chromosome', 'start_transcript_on_genome' and 'cigar_string'
+    are available, and the blocks of the CIGAR string are decoded from the store
+    without any parsing.
+    '''
+
+    __slots__ = ('store', 'transcript_id')
+
+    def __init__(self, store, transcript_id):
+
+        self.store = store
+        self.transcript_id = transcript_id
+
+    def __repr__(self):
+
+        return f"StoredAlignment({self.transcript_name!r}, {self.chromosome!r}, {self.start}, {self.cigar_string!r})"
+
+    def __getitem__(self, key):
+
+        if key == 'start_transcript_on_genome':
+            return self.start
+        if key in ('transcript_name', 'chromosome', 'cigar_string'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    @property
+    def transcript_name(self):
+
+        return self.store.transcript_names[self.transcript_id]
+
+    @property
+    def chromosome(self):
+
+        return self.store.chromosome_names[self.store.chromosome_ids[self.transcript_id]]
+
+    @property
+    def start(self):
+
+        return int(self.store.starts[self.transcript_id])
+
+    @property
+    def blocks(self):
+
+        '''
+        The (length, operation) blocks of the CIGAR string.
+        '''
+
+        store = self.store
+        packed = store.operations[store.offsets[self.transcript_id]:store.offsets[self.transcript_id + 1]]
+        return [(value >> OPERATION_BITS, OPERATIONS[value & OPERATION_MASK]) for value in packed.tolist()]
+
+    @property
+    def cigar_string(self):
+
+        return ''.join(f"{length}{operation}" for length, operation in self.blocks)
+
+
+class AlignmentStore:
+
+    '''
+    The alignments of many transcripts, in a few contiguous arrays.
+
+    Parameters:
+    -----------
+    records : iterable of (str, str, int, str)
+        The (transcript name, chromosome, start, CIGAR string) of each transcript.
+        Transcript names must be unique.
+
+    Attributes:
+    -----------
+    transcript_names : list of str
+        The name of each transcript; the position in this list is the transcript id.
+
+    chromosome_names : list of str
+        The distinct chromosome names, in order of first appearance.
+
+    chromosome_ids : numpy.ndarray of int32
+        For each transcript, the index of its chromosome in chromosome_names.
+
+    starts : numpy.ndarray of int64
+        For each transcript, the genome position of its first nucleotide.
+
+    operations : numpy.ndarray of uint32
+        The packed CIGAR operations of all the transcripts (length << 4 | code).
+
+    offsets : numpy.ndarray of int64
+        The operations of transcript i are operations[offsets[i]:offsets[i + 1]].
+    '''
+
+    def __init__(self, records):
+
+        transcript_names = []
+        chromosome_table = {}
+        chromosome_ids = array('i')
+        starts = array('q')
+        operations = array('I')
+        offsets = array('q', [0])
+
+        for transcript_name, chromosome, start, cigar_string in records:
+            transcript_names.append(transcript_name)
+            chromosome_ids.append(chromosome_table.setdefault(chromosome, len(chromosome_table)))
+            starts.append(int(start))
+            operations.extend(pack_cigar(cigar_string))
+            offsets.append(len(operations))
+
+        self.transcript_names = transcript_names
+        self.chromosome_names = list(chromosome_table)
+        self.chromosome_ids = np.frombuffer(chromosome_ids, dtype=np.int32) if chromosome_ids else np.zeros(0, np.int32)
+        self.starts = np.frombuffer(starts, dtype=np.int64) if starts else np.zeros(0, np.int64)
+        self.operations = np.frombuffer(operations, dtype=np.uint32) if operations else np.zeros(0, np.uint32)
+        self.offsets = np.frombuffer(offsets, dtype=np.int64)
+
+        self._transcript_ids = {name: transcript_id for transcript_id, name in enumerate(transcript_names)}
+        if len(self._transcript_ids) != len(transcript_names):
+            duplicated = sorted(name for name, count in Counter(transcript_names).items() if count > 1)
+            raise ValueError(f"Duplicated transcript names in the alignments : {duplicated}")
+
+    @classmethod
+    def from_dataframe(cls, df):
+
+        '''
+        Builds the store from a DataFrame returned by read_transcript_alignments().
+        '''
+
+        return cls(zip(df['transcript_name'], df['chromosome'], df['start_transcript_on_genome'], df['cigar_string']))
+
+    @classmethod
+    def from_file(cls, filename):
+
+        '''
+        Builds the store from the file that contains the transcript alignments, line by line.
+        '''
+
+        def records():
+            with open_input(filename, 'rt') as handle:
+                next(handle, None)                        # Skip the header line
+                for line in handle:
+                    line = line.rstrip('\r\n')
+                    if line:
+                        transcript_name, chromosome, start, cigar_string = line.split('\t')[:4]
+                        yield transcript_name, chromosome, int(start), cigar_string
+
+        try:
+            return cls(records())
+        except ValueError as error:
+            raise ValueError(f"{filename} : {error}") from None
+
+    def __len__(self):
+
+        return len(self.transcript_names)
+
+    def __contains__(self, transcript_name):
+
+        return transcript_name in self._transcript_ids
+
+    def __getitem__(self, transcript_name):
+
+        '''
+        Returns the StoredAlignment of a transcript name (KeyError if it is not in the store).
+        '''
+
+        return StoredAlignment(self, self._transcript_ids[transcript_name])
+
+    def __iter__(self):
+
+        return (StoredAlignment(self, transcript_id) for transcript_id in range(len(self)))
+
+    @property
+    def nbytes(self):
+
+        '''
+        The memory used by the arrays of the store, in bytes (the names are not included).
+        '''
+
+        return self.chromosome_ids.nbytes + self.starts.nbytes + self.operations.nbytes + self.offsets.nbytes
+
+    def block_arrays(self):
+
+        '''
+        Decodes the packed operations into NumPy arrays, for vectorized processing.
+
+        Returns:
+        --------
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray)
+            For every operation : its length, its code, and the number of transcript
+            and of genome nucleotides consumed before it in its own transcript.
+        '''
+
+        lengths = (self.operations >> OPERATION_BITS).astype(np.int64)
+        codes = (self.operations & OPERATION_MASK).astype(np.uint8)
+
+        transcript_codes = [OPERATION_CODES[operation] for operation in CONSUMES_TRANSCRIPT]
+        genome_codes = [OPERATION_CODES[operation] for operation in CONSUMES_GENOME]
+
+        offsets = []
+        for consumed in (np.where(np.isin(codes, transcript_codes), lengths, 0),
+                         np.where(np.isin(codes, genome_codes), lengths, 0)):
+            # Exclusive cumulative sum over all the transcripts, minus the one at the first operation of each
+            cumulative = np.concatenate(([0], np.cumsum(consumed)))
+            first = np.repeat(cumulative[self.offsets[:-1]], np.diff(self.offsets))
+            offsets.append(cumulative[:-1] - first)
+
+        return lengths, codes, offsets[0], offsets[1]
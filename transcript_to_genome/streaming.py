@@ -0,0 +1,212 @@
+# coding: utf-8
+
+# Constant-memory mapping of positions files that do not fit in memory.
+
+# The alignment index is loaded once, then the positions file is read in
+# chunks. The names of the index are interned into a NameTable once for the
+# whole file; each chunk only interns its own names, is mapped with
+# map_queries() and written, sorted by transcript name, to a temporary "run"
+# file. The runs are finally merged into the output file with a k-way merge.
+# heapq.merge() keeps the rows of the earlier runs first when names are
+# equal, so the output has exactly the order of pd.merge(alignments,
+# positions, how='outer') : transcripts sorted by name, and the positions of
+# each transcript in their input order.
+
+# Peak memory depends on the size of the index, on the number of distinct
+# names of the positions file and on the chunk size only.
+
+import heapq
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .batch import OUTPUT_COLUMNS, map_queries, read_positions
+from .instrument import current
+from .join import NameTable, intern_positions
+from .sinks import write_tsv
+
+
+DEFAULT_CHUNKSIZE = 1_000_000
+
+# Maximum number of run files that are merged at the same time
+MAX_OPEN_RUNS = 64
+
+
+def _transcript_name(line):
+
+    return line[:line.index('\t')]
+
+
+def merge_runs(run_filenames, output_handle):
+
+    '''
+    Merges sorted run files into an open output file.
+
+    Parameters:
+    -----------
+    run_filenames : list of str
+        The run files, each sorted by transcript name, in input order.
+
+    output_handle : file object
+        The file to which the merged lines are written.
+    '''
+
+    handles = [open(filename) for filename in run_filenames]
+    try:
+        output_handle.writelines(heapq.merge(*handles, key=_transcript_name))
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+def merge_runs_in_passes(run_filenames, directory):
+
+    '''
+    Merges groups of at most MAX_OPEN_RUNS consecutive runs until at most
+    MAX_OPEN_RUNS runs are left, to stay below the limit of open files.
+    Groups are made of consecutive runs, so that equal names keep the input order.
+
+    Returns:
+    --------
+    list of str
+        The remaining run files, to be merged with merge_runs().
+    '''
+
+    generation = 0
+    while len(run_filenames) > MAX_OPEN_RUNS:
+        merged_filenames = []
+        for group_start in range(0, len(run_filenames), MAX_OPEN_RUNS):
+            merged_filename = os.path.join(directory, f"merged_{generation}_{len(merged_filenames)}.tsv")
+            with open(merged_filename, 'w') as merged:
+                merge_runs(run_filenames[group_start:group_start + MAX_OPEN_RUNS], merged)
+            for filename in run_filenames[group_start:group_start + MAX_OPEN_RUNS]:
+                os.remove(filename)
+            merged_filenames.append(merged_filename)
+        run_filenames = merged_filenames
+        generation += 1
+
+    return run_filenames
+
+
+def unqueried_alignments(index, queried):
+
+    '''
+    Builds the output rows of the alignments that have no query, sorted by transcript name.
+
+    Parameters:
+    -----------
+    index : AlignmentIndex
+        The indexed alignments.
+
+    queried : numpy.ndarray of bool
+        For each transcript id, whether at least one position referred to it.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        One row per alignment without query, with missing transcript and genome indexes.
+    '''
+
+    transcript_ids = np.flatnonzero(~queried)
+    transcript_ids = transcript_ids[np.argsort(index.transcript_names[transcript_ids], kind='stable')]
+
+    return pd.DataFrame({
+        'transcript_name': index.transcript_names[transcript_ids],
+        'transcript_index': pd.array([pd.NA] * len(transcript_ids), dtype='Int64'),
+        'chromosome': pd.Categorical.from_codes(index.chromosome_ids[transcript_ids],
+                                                categories=index.chromosome_names),
+        'genome_index': pd.array([pd.NA] * len(transcript_ids), dtype='Int64'),
+    }, columns=OUTPUT_COLUMNS)
+
+
+def map_chunks(index, chunks, output_filename, temporary_directory=None):
+
+    '''
+    Maps an iterator of positions DataFrames and writes the results to a TSV file.
+
+    Parameters:
+    -----------
+    index : AlignmentIndex
+        The indexed alignments.
+
+    chunks : iterable of pandas.DataFrame
+        The queries, with the columns transcript_name and transcript_index, in input order.
+
+    output_filename : str
+        The output file; it has the same content as the one written by map_files().
+
+    temporary_directory : str, optional
+        The directory in which the sorted runs are written (by default, the system one).
+    '''
+
+    queried = np.zeros(len(index), dtype=bool)
+    instrumentation = current()
+    table = NameTable.for_index(index)
+
+    directory = tempfile.mkdtemp(prefix='transcript_to_genome_', dir=temporary_directory)
+    try:
+        run_filenames = []
+
+        chunks = iter(chunks)
+        while True:
+            with instrumentation.stage('read_positions'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+
+            queries = intern_positions(table, chunk)
+            queried[queries.transcript_ids[queries.transcript_ids < len(index)]] = True
+
+            run_filename = os.path.join(directory, f"run_{len(run_filenames)}.tsv")
+            results = map_queries(index, table, queries, outer=False)
+            with instrumentation.stage('write_runs'):
+                write_tsv(results, run_filename, header=False)
+            run_filenames.append(run_filename)
+
+        # The alignments without query come last : their names never appear in the other runs
+        run_filename = os.path.join(directory, f"run_{len(run_filenames)}.tsv")
+        write_tsv(unqueried_alignments(index, queried), run_filename, header=False)
+        run_filenames.append(run_filename)
+
+        instrumentation.count('runs', len(run_filenames))
+        instrumentation.count('unqueried_alignments', np.count_nonzero(~queried))
+
+        with instrumentation.stage('merge_runs'):
+            run_filenames = merge_runs_in_passes(run_filenames, directory)
+
+        with instrumentation.stage('merge_runs'), open(output_filename, 'w') as output:
+            output.write('\t'.join(OUTPUT_COLUMNS) + '\n')
+            merge_runs(run_filenames, output)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def map_file_streaming(index, positions_filename, output_filename, chunksize=DEFAULT_CHUNKSIZE,
+                       temporary_directory=None):
+
+    '''
+    Maps a positions file chunk by chunk and writes the results to a TSV file.
+
+    Parameters:
+    -----------
+    index : AlignmentIndex
+        The indexed alignments, loaded once for the whole file.
+
+    positions_filename : str
+        The positions file (columns transcript_name and transcript_coordinate).
+
+    output_filename : str
+        The output file.
+
+    chunksize : int, optional
+        The number of positions read and mapped at a time.
+
+    temporary_directory : str, optional
+        The directory in which the sorted runs are written (by default, the system one).
+    '''
+
+    map_chunks(index, read_positions(positions_filename, chunksize=chunksize), output_filename,
+               temporary_directory=temporary_directory)
@@ -0,0 +1,146 @@
+# coding: utf-8
+
+# Generator of synthetic alignment and position files, at any scale.
+
+# Every transcript alignment alternates match blocks with gaps :
+#
+#    M  gap  M  gap  ...  M
+#
+# where a gap is either an intron (a long deletion), or a short insertion or
+# deletion. The positions file then holds a number of random queries per
+# transcript, shuffled across transcripts as in input_transcripts_positions.txt.
+
+import os
+
+import numpy as np
+
+from .cigar import Cigar
+
+
+ALIGNMENTS_HEADER = 'transcript_name\tchromosome\ttranscript_start\tcigar_string\n'
+POSITIONS_HEADER = 'transcript_name\ttranscript_coordinate\n'
+
+
+def generate_cigar(rng, operations, match_length, indel_length, intron_length, intron_fraction):
+
+    '''
+    Generates one random CIGAR string.
+
+    Parameters:
+    -----------
+    rng : numpy.random.Generator
+        The random number generator.
+
+    operations : int
+        The number of operations of the CIGAR string (made odd, so that it starts and ends with M).
+
+    match_length : int
+        The mean length of the match blocks.
+
+    indel_length : int
+        The maximum length of the short insertions and deletions.
+
+    intron_length : int
+        The mean length of the introns.
+
+    intron_fraction : float
+        The fraction of the gaps that are introns.
+
+    Returns:
+    --------
+    str
+        The CIGAR string.
+    '''
+
+    blocks = max(1, (operations + 1) // 2)
+
+    matches = rng.integers(1, 2 * match_length, size=blocks)
+    introns = rng.random(blocks - 1) < intron_fraction
+    intron_lengths = rng.integers(max(1, intron_length // 2), intron_length * 3 // 2 + 2, size=blocks - 1)
+    indel_lengths = rng.integers(1, indel_length + 1, size=blocks - 1)
+    insertions = rng.random(blocks - 1) < 0.5
+
+    cigar = [f"{matches[0]}M"]
+    for gap in range(blocks - 1):
+        if introns[gap]:
+            cigar.append(f"{intron_lengths[gap]}D")
+        else:
+            cigar.append(f"{indel_lengths[gap]}{'I' if insertions[gap] else 'D'}")
+        cigar.append(f"{matches[gap + 1]}M")
+
+    return ''.join(cigar)
+
+
+def write_workload(directory, transcripts=1000, operations=9, match_length=100, indel_length=5,
+                   intron_length=1000, intron_fraction=0.5, queries_per_transcript=10,
+                   chromosomes=4, out_of_range_fraction=0.0, seed=0):
+
+    '''
+    Writes a synthetic alignments file and a synthetic positions file.
+
+    Parameters:
+    -----------
+    directory : str
+        The directory in which input_transcripts_alignments.txt and
+        input_transcripts_positions.txt are written.
+
+    transcripts : int, optional
+        The number of transcripts.
+
+    operations, match_length, indel_length, intron_length, intron_fraction :
+        The shape of the CIGAR strings, see generate_cigar().
+
+    queries_per_transcript : int, optional
+        The number of positions queried on each transcript.
+
+    chromosomes : int, optional
+        The number of chromosomes on which the transcripts are spread.
+
+    out_of_range_fraction : float, optional
+        The fraction of the queries placed past the end of their transcript.
+
+    seed : int, optional
+        The seed of the random number generator.
+
+    Returns:
+    --------
+    (str, str)
+        The paths of the alignments file and of the positions file.
+    '''
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    alignments_filename = os.path.join(directory, 'input_transcripts_alignments.txt')
+    positions_filename = os.path.join(directory, 'input_transcripts_positions.txt')
+
+    names = np.array([f"TR{transcript + 1}" for transcript in range(transcripts)], dtype=object)
+    lengths = np.zeros(transcripts, dtype=np.int64)
+    next_starts = np.ones(chromosomes, dtype=np.int64)
+
+    with open(alignments_filename, 'w') as handle:
+        handle.write(ALIGNMENTS_HEADER)
+        for transcript in range(transcripts):
+            cigar_string = generate_cigar(rng, operations, match_length, indel_length, intron_length, intron_fraction)
+            cigar = Cigar.parse(cigar_string)
+            lengths[transcript] = cigar.transcript_length
+
+            chromosome = transcript % chromosomes
+            start = next_starts[chromosome] + rng.integers(0, 10 * match_length)
+            next_starts[chromosome] = start + cigar.genome_length
+
+            handle.write(f"{names[transcript]}\tCHR{chromosome + 1}\t{start}\t{cigar_string}\n")
+
+    # Queries of every transcript, shuffled across transcripts
+    query_transcripts = rng.permutation(np.repeat(np.arange(transcripts), queries_per_transcript))
+    query_positions = (rng.random(len(query_transcripts)) * lengths[query_transcripts]).astype(np.int64)
+
+    out_of_range = rng.random(len(query_transcripts)) < out_of_range_fraction
+    query_positions[out_of_range] = lengths[query_transcripts[out_of_range]] + rng.integers(0, 10, out_of_range.sum())
+
+    with open(positions_filename, 'w') as handle:
+        handle.write(POSITIONS_HEADER)
+        for name, position in zip(names[query_transcripts], query_positions):
+            handle.write(f"{name}\t{position}\n")
+
+    return alignments_filename, positions_filename
@@ -12,10 +12,25 @@
 
 # that operate on the input data.         
 
+import os
 import re
-import pandas as pd
+import sys
+import time
 from dataclasses import dataclass
 
+# The stages of the pipeline are timed by the instrumentation of the
+# transcript_to_genome package when it is active (e.g. by its benchmark),
+# and do nothing otherwise. When the script runs from its own directory, the
+# package is found in the parent directory; its instrument module only needs
+# the standard library.
+
+try:
+    from transcript_to_genome.instrument import count_queries, current
+except ImportError:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from transcript_to_genome.instrument import count_queries, current
+
+
 @dataclass
 class transcriptToGenome:
 
@@ -131,33 +146,172 @@ class transcriptToGenome:
 
         return None
 
+    def map_positions(self, alignment, positions):
+        '''
+        Calculates the genome positions of many nucleotide positions of the same transcript at once.
 
-if __name__ == "__main__":
+        The result of each position is the one of findTranscriptIndex() followed by
+        calculateGenomePosition(), as in the main loop below. The positions are sorted,
+        then resolved in a single forward sweep over the blocks of the CIGAR string,
+        instead of scanning the transformed string from its start for every position.
 
+        Parameters:
+        -----------
+        alignment : mapping
+            The alignment of the transcript, with the keys 'cigar_string' and
+            'start_transcript_on_genome' (e.g. a row of the merged data frame).
+            If it also has a blocks attribute (as the records of an AlignmentStore),
+            its (length, operation) blocks are used instead of parsing the CIGAR string.
 
-    # Read file 1 
-    filename1 = 'input_transcripts_alignments.txt'
-    df1 = pd.read_csv(filename1, sep='\t', header=0, names=['transcript_name', 'chromosome', 'transcript_start', 'cigar_string'])
+        positions : sequence of int
+            The 0-based positions of the nucleotides in the transcript.
+
+        Returns:
+        --------
+        list of int or None
+            The genome position of each nucleotide, in the order of positions; None for
+            the nucleotides that fall in an insertion or outside of the transcript.
+        '''
+        position_start_transcript_on_genome = alignment['start_transcript_on_genome']
+
+        # findTranscriptIndex() looks up the nucleotide number position + 1, minus 1 if it is positive :
+        # the position -1 is therefore looked up as the position 0
+        offsets = [0 if position == -1 else position for position in positions]
+        order = sorted(range(len(offsets)), key=offsets.__getitem__)
+
+        genome_positions = [None] * len(offsets)
+
+        # Start of the current block in the transcript and in the genome
+        transcript_offset = 0
+        genome_offset = 0
+        query = 0
+
+        # Queries before the start of the transcript do not map
+        while query < len(order) and offsets[order[query]] < 0:
+            query += 1
+
+        blocks = getattr(alignment, 'blocks', None)
+        if blocks is None:
+            blocks = [(int(length), operation) for length, operation in re.findall(r'(\d+)([MID])', alignment['cigar_string'])]
+
+        for length, operation in blocks:
+            if query == len(order):
+                break
+
+            # The blocks of a store may hold any SAM operation : D and N only consume
+            # the genome, H and P consume nothing, S is not aligned (as I), = and X are (as M)
+            if operation not in ('M', 'I', 'S', '=', 'X'):
+                if operation in ('D', 'N'):
+                    genome_offset += length
+                continue
+
+            # Every query that falls in this block
+            while query < len(order) and offsets[order[query]] < transcript_offset + length:
+                if operation in ('M', '=', 'X'):
+                    genome_positions[order[query]] = (position_start_transcript_on_genome + genome_offset
+                                                      + offsets[order[query]] - transcript_offset)
+                query += 1
+
+            transcript_offset += length
+            if operation in ('M', '=', 'X'):
+                genome_offset += length
+
+        return genome_positions
+
+    def map_store_positions(self, store, transcript_names, positions):
+        '''
+        Calculates the genome positions of many (transcript name, position) queries against an alignment store.
+
+        The queries are grouped by transcript, and the positions of each transcript are
+        mapped at once by map_positions(), directly on the packed CIGAR operations of the store.
+
+        Parameters:
+        -----------
+        store : AlignmentStore
+            The alignments (see transcript_to_genome.store), or any mapping from
+            transcript names to alignments accepted by map_positions().
+
+        transcript_names : sequence of str
+            The transcript of each query.
+
+        positions : sequence of int
+            The 0-based position of each query in its transcript.
+
+        Returns:
+        --------
+        list of int or None
+            The genome position of each query, in the order of the queries; None for the
+            queries that fall in an insertion, outside of their transcript, or whose
+            transcript is not in the store.
+        '''
+        queries_by_transcript = {}
+        for query, transcript_name in enumerate(transcript_names):
+            queries_by_transcript.setdefault(transcript_name, []).append(query)
+
+        genome_positions = [None] * len(positions)
+
+        for transcript_name, queries in queries_by_transcript.items():
+            if transcript_name not in store:
+                continue
+            results = self.map_positions(store[transcript_name], [positions[query] for query in queries])
+            for query, genome_position in zip(queries, results):
+                genome_positions[query] = genome_position
+
+        return genome_positions
+
+
+def read_alignments(filename):
+    '''
+    Reads the file that contains the transcript alignments into a data frame.
+    '''
+    # pandas is only needed to read and write the files : importing the class does not load it
+    import pandas as pd
+
+    df1 = pd.read_csv(filename, sep='\t', header=0, names=['transcript_name', 'chromosome', 'transcript_start', 'cigar_string'])
     df1['transcript_start'] = df1['transcript_start'].astype(int)
     df1 = df1.rename(columns={'transcript_start': 'start_transcript_on_genome'})
 
+    return df1
 
-    # Read file 2
-    filename2 = 'input_transcripts_positions.txt'  
-    df2 = pd.read_csv(filename2, sep='\t', header=0, names=['transcript_name','transcript_coordinate'])
+
+def read_positions(filename):
+    '''
+    Reads the file that contains the nucleotide positions into a data frame.
+    '''
+    import pandas as pd
+
+    df2 = pd.read_csv(filename, sep='\t', header=0, names=['transcript_name','transcript_coordinate'])
     df2['transcript_coordinate'] = df2['transcript_coordinate'].astype(int)
     df2 = df2.rename(columns={'transcript_coordinate': 'transcript_index'})
 
+    return df2
 
-    # Merge these two files 
-    combined_data = pd.merge(df1, df2, on='transcript_name', how='outer')
 
+def map_transcripts(df1, df2):
+    '''
+    Merges the alignments with the positions, and maps the positions of every transcript.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The merged data frame, with the columns transformed_cigar,
+        transcript_index_in_cigar and genome_position.
+    '''
+    import pandas as pd
+
+    instrumentation = current()
 
-     # Initialize new columns in the combined dataframes to store the computed results
-    combined_data['transformed_cigar'] = None
-    combined_data['transcript_index_in_cigar'] = None
-    combined_data['genome_position'] = None
+    # Merge these two files 
+    with instrumentation.stage('merge'):
+        combined_data = pd.merge(df1, df2, on='transcript_name', how='outer')
+
+        # Initialize new columns in the combined dataframes to store the computed results
+        combined_data['transformed_cigar'] = None
+        combined_data['transcript_index_in_cigar'] = None
+        combined_data['genome_position'] = None
 
+    # The three methods are called inside the same loop : the time of each call is accumulated
+    clock = time.perf_counter
 
     # Iterate over each distinct transcript_name
     for transcript_name, transcript_data in combined_data.groupby('transcript_name'):
@@ -166,20 +320,26 @@ if __name__ == "__main__":
        transcript_genome = transcriptToGenome()
     
 
+       # Transform the CIGAR string once : it is the same for all the rows of the transcript
+       start = clock()
+       transformed_cigar = transcript_genome.transformCigar(transcript_data['cigar_string'].iloc[0])
+       instrumentation.add('transform_cigar', clock() - start)
+
+
        # Process each row for the current transcript using iterrows() to access row data correctly
        for a_position, a_row in transcript_data.iterrows():         # Unpack position and row data
         
-           # Transform the CIGAR string
-           transformed_cigar = transcript_genome.transformCigar(a_row['cigar_string'])
-        
            # Find the transcript index in the transformed CIGAR string
+           start = clock()
            transcript_index = transcript_genome.findTranscriptIndex(transformed_cigar, a_row['transcript_index'] + 1)
         
            # Calculate the genome position corresponding to the transcript index
+           middle = clock()
            genome_position = transcript_genome.calculateGenomePosition(
                transformed_cigar,
                transcript_index, 
                a_row['start_transcript_on_genome'])
+           end = clock()
         
 
            # Update the combined data frame with computed values
@@ -187,10 +347,135 @@ if __name__ == "__main__":
            combined_data.at[a_position, 'transcript_index_in_cigar'] = transcript_index
            combined_data.at[a_position, 'genome_position'] = genome_position
 
-    # Print the updated combined data frame to verify the results
-    print(combined_data)
+           instrumentation.add('find_transcript_index', middle - start)
+           instrumentation.add('calculate_genome_position', end - middle)
+           instrumentation.add('store_results', clock() - end)
+
+    if instrumentation.enabled:
+        count_queries(instrumentation, combined_data['transcript_index'], combined_data['transformed_cigar'],
+                      combined_data['genome_position'])
+
+    return combined_data
+
+
+def map_transcripts_batch(df1, df2):
+    '''
+    Merges the alignments with the positions, and maps the positions of every transcript at once.
+
+    Same as map_transcripts(), but the positions of each transcript are mapped
+    together by map_positions() instead of row by row, and the results of all the
+    transcripts are stored in the data frame at the end.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The merged data frame, with the columns transformed_cigar and genome_position.
+    '''
+    import pandas as pd
+
+    instrumentation = current()
+
+    # Merge these two files 
+    with instrumentation.stage('merge'):
+        combined_data = pd.merge(df1, df2, on='transcript_name', how='outer')
+
+        # Initialize new columns in the combined dataframes to store the computed results
+        combined_data['transformed_cigar'] = None
+        combined_data['genome_position'] = None
+
+    # The methods are called once per transcript : the time of each call is accumulated
+    clock = time.perf_counter
+
+    # The rows and the computed values of all the transcripts
+    cigar_rows, transformed_cigars = [], []
+    position_rows, genome_positions = [], []
+
+    # Iterate over each distinct transcript_name
+    for transcript_name, transcript_data in combined_data.groupby('transcript_name'):
+       
+       # Create an instance of the transcriptToGenome class
+       transcript_genome = transcriptToGenome()
+       alignment = transcript_data.iloc[0]
+    
+
+       # Transform the CIGAR string once : it is the same for all the rows of the transcript
+       start = clock()
+       transformed_cigar = transcript_genome.transformCigar(alignment['cigar_string'])
+       instrumentation.add('transform_cigar', clock() - start)
+
+       cigar_rows.extend(transcript_data.index)
+       transformed_cigars.extend([transformed_cigar] * len(transcript_data))
+
+
+       # Map all the positions of the transcript at once (the alignments without query have none)
+       queried = transcript_data['transcript_index'].notna()
+       positions = transcript_data.loc[queried, 'transcript_index'].astype(int).tolist()
+
+       start = clock()
+       results = transcript_genome.map_positions(alignment, positions)
+       instrumentation.add('map_positions', clock() - start)
+
+       position_rows.extend(transcript_data.index[queried])
+       genome_positions.extend(None if result is None else int(result) for result in results)
+
+    # Update the combined data frame with computed values
+    with instrumentation.stage('store_results'):
+        combined_data.loc[cigar_rows, 'transformed_cigar'] = pd.Series(transformed_cigars, index=cigar_rows, dtype=object)
+        combined_data.loc[position_rows, 'genome_position'] = pd.Series(genome_positions, index=position_rows, dtype=object)
+
+    if instrumentation.enabled:
+        count_queries(instrumentation, combined_data['transcript_index'], combined_data['transformed_cigar'],
+                      combined_data['genome_position'])
+
+    return combined_data
+
+
+def run_pipeline(filename1, filename2, output_filename, verbose=False, batch=False):
+    '''
+    Reads both files, maps the positions and writes the results.
+
+    With batch=True, the positions are mapped by map_transcripts_batch() instead of map_transcripts().
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The data frame returned by map_transcripts() or map_transcripts_batch().
+    '''
+    instrumentation = current()
+
+    # Read file 1 
+    with instrumentation.stage('read_transcript_alignments'):
+        df1 = read_alignments(filename1)
+
+    # Read file 2
+    with instrumentation.stage('read_nucleotide_positions'):
+        df2 = read_positions(filename2)
+
+    combined_data = (map_transcripts_batch if batch else map_transcripts)(df1, df2)
+
+    # Print the updated combined data frame to verify the results, then the columns of interest
+    if verbose:
+        print(combined_data)
+        print("Results :")
+        print(combined_data.loc[:, ["transcript_name", "transcript_index", "chromosome", "genome_position"]])
+
+    # Write the columns of interest in a file
+    with instrumentation.stage('write'):
+        combined_data[["transcript_name", "transcript_index", "chromosome", "genome_position"]].to_csv(output_filename, sep='\t', index=False)
+
+    return combined_data
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+
+    # The data frames are only printed with --verbose : at scale, printing them takes longer than the mapping
+    parser = argparse.ArgumentParser(description='Maps the transcript positions to genome positions.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the intermediate data frames')
+    parser.add_argument('--batch', action='store_true', help='map the positions of each transcript at once (map_positions)')
+    arguments = parser.parse_args()
 
-    # Print the columns of interest on the screen and in a file 
-    print("Results :")
-    print(combined_data.loc[:, ["transcript_name", "transcript_index", "chromosome", "genome_position"]])
-    combined_data[["transcript_name", "transcript_index", "chromosome", "genome_position"]].to_csv("output_genome_positions_voop.txt", sep='\t', index=False)
\ No newline at end of file
+    run_pipeline('input_transcripts_alignments.txt', 'input_transcripts_positions.txt', "output_genome_positions_voop.txt",
+                 verbose=arguments.verbose, batch=arguments.batch)
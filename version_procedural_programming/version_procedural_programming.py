@@ -17,7 +17,23 @@
 
 import os
 import re  
-import pandas as pd
+import sys
+
+# pandas is imported only by the functions that read files (and by the main
+# block below), so that importing the mapping functions stays side-effect free
+# and fast.
+
+# The stages of the pipeline are timed by the instrumentation of the
+# transcript_to_genome package when it is active (e.g. by its benchmark),
+# and do nothing otherwise. When the script runs from its own directory, the
+# package is found in the parent directory; its instrument module only needs
+# the standard library.
+
+try:
+    from transcript_to_genome.instrument import count_queries, current
+except ImportError:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from transcript_to_genome.instrument import count_queries, current
 
 
 def transform_cigar(cigar_string):
@@ -235,62 +251,27 @@ def calculate_genome_position(transcript_modified_string, transcript_position_mo
 # genome_position = calculate_genome_position(transcript_string_modified_string, transcript_position_modified_string, position_start_transcript_on_genome)
 # print(f'Transcript position in the expanded CIGAR string {transcript_position_modified_string} corresponds to genome index {genome_position}.')
 
-# Verifying the entire pipeline on TR1 :
-
-print("Verifying the entire pipeline on TR1 :")
-position_start_transcript_on_genome = 3  # The index of the genome sequence that coincides with the transcript_start
-
-transformed_string = transform_cigar("8M7D6M2I2M11D7M")
-print(transformed_string)
-nucleotide_number = 19                         # the NUCLEOTIDE NUMBER in the original transcript
-transcript_position = nucleotide_number        # to make it equivalent with the INDEX
-
-index = find_transcript_index(transformed_string, transcript_position)
-print(f'Nucleotide number {nucleotide_number} corresponds to index {index} on the expanded CIGAR string.')
-transcript_string_modified_string = transformed_string
-transcript_position_modified_string = index    
-
-genome_position = calculate_genome_position(transcript_string_modified_string, index, position_start_transcript_on_genome)
-print(f'Nucleotide number {transcript_position} corresponds to the genome index {genome_position}.')
-
-
-# Verifying the entire pipeline on TR2 :
-
-print("Verifying the entire pipeline on TR2 :")
-position_start_transcript_on_genome = 10 # The index of the genome sequence that coincides with the transcript_start
-transformed_string = transform_cigar("20M")
-print(transformed_string)
-
-transcript_position = 11  # The nucleotide position in the original transcript that is mapped on expanded CIGAR string
-index = find_transcript_index(transformed_string, transcript_position)
-print(f'Nucleotide number {nucleotide_number} corresponds to index {index} on the expanded CIGAR string.')
-transcript_string_modified_string = transformed_string
-transcript_position_modified_string = index 
-
-genome_position = calculate_genome_position(transcript_string_modified_string, index, position_start_transcript_on_genome)
-print(f'Nucleotide number {transcript_position} corresponds to the genome index {genome_position}.')
-
 
 
 # Read the file that contains the transcript alignments
 
 def read_transcript_alignments(filename):
 
+    import pandas as pd
+
     df = pd.read_csv(filename, sep='\t', header=0, names=['transcript_name', 'chromosome', 'transcript_start', 'cigar_string'])
     df['transcript_start'] = df['transcript_start'].astype(int)
     df = df.rename(columns={'transcript_start': 'start_transcript_on_genome'})
 
     return df
 
-filename1 = 'input_transcripts_alignments.txt'  
-transcript_alignments = read_transcript_alignments(filename1)
-# print(transcript_alignments)
-
 
 # Read the file that contains the nucleotide positions 
 
 def read_nucleotide_positions(filename):
-    
+
+    import pandas as pd
+
     df = pd.read_csv(filename, sep='\t', header=0, names=['transcript_name','transcript_coordinate'])
 
     df['transcript_coordinate'] = df['transcript_coordinate'].astype(int)
@@ -299,56 +280,141 @@ def read_nucleotide_positions(filename):
     return df
 
 
-filename2 = 'input_transcripts_positions.txt'  
-nucleotide_positions = read_nucleotide_positions(filename2)
-# print(nucleotide_positions)
+# Map the nucleotide positions of all the transcripts
+
+def map_nucleotide_positions(transcript_alignments, nucleotide_positions, verbose=False):
+
+    import pandas as pd
+
+    instrumentation = current()
+
+
+    # Merge these DataFrames based on 'transcript_name'
+
+    with instrumentation.stage('merge'):
+        combined_data = pd.merge(transcript_alignments, nucleotide_positions, on='transcript_name', how='outer')
+    if verbose:
+        print("\nThe combined files that contain both transcript alignments and nucleotide positions :")
+        print(combined_data)
+
+
+    # Applying the 1st function : transform_cigar()
+    # Each distinct CIGAR string is transformed only once, then the rows that share it reuse the result
+
+    with instrumentation.stage('transform_cigar'):
+        transformed_strings = {cigar_string: transform_cigar(cigar_string) for cigar_string in combined_data["cigar_string"].unique()}
+        combined_data["transformed_string"] = combined_data["cigar_string"].map(transformed_strings)
+
+
+    # Applying the 2nd function : find_transcript_index()
+    # Apply the second function with additional argument using a lambda function
+
+    with instrumentation.stage('find_transcript_index'):
+        combined_data["index_in_transformed_string"] = combined_data.apply(
+            lambda row: find_transcript_index(row["transformed_string"], row["index_in_transcript"] + 1),
+            axis=1
+        )
+
+
+    # Applying the 3rd function : calculate_genome_position()
+
+    with instrumentation.stage('calculate_genome_position'):
+        combined_data["genome_index"] = combined_data.apply(
+            lambda row: calculate_genome_position(
+                row["transformed_string"],
+                row["index_in_transformed_string"]  ,
+                row["start_transcript_on_genome"]
+            ),
+            axis=1
+        )
+    if verbose:
+        print(combined_data)
+
+    if instrumentation.enabled:
+        count_queries(instrumentation, combined_data["index_in_transcript"], combined_data["transformed_string"],
+                      combined_data["genome_index"])
+
+    return combined_data
+
+
+# The whole pipeline : read both files, map the positions and write the results
+
+def run_pipeline(filename1, filename2, output_filename, verbose=False):
+
+    instrumentation = current()
+
+    with instrumentation.stage('read_transcript_alignments'):
+        transcript_alignments = read_transcript_alignments(filename1)
+
+    with instrumentation.stage('read_nucleotide_positions'):
+        nucleotide_positions = read_nucleotide_positions(filename2)
+
+    combined_data = map_nucleotide_positions(transcript_alignments, nucleotide_positions, verbose=verbose)
+
+
+    # Printing the columns of interest on the screen and in a file :
+
+    combined_data = combined_data.rename(columns={'index_in_transcript': 'transcript_index'})
+    if verbose:
+        print("Results :")
+        print(combined_data.loc[:, ["transcript_name", "transcript_index", "chromosome", "genome_index"]])
+
+    with instrumentation.stage('write'):
+        combined_data[["transcript_name", "transcript_index", "chromosome", "genome_index"]].to_csv(output_filename, sep='\t', index=False)
+
+    return combined_data
+
+
+if __name__ == "__main__":
 
+    import argparse
 
-# Merge these DataFrames based on 'transcript_name'
 
-combined_data = pd.merge(transcript_alignments, nucleotide_positions, on='transcript_name', how='outer')
-print("\nThe combined files that contain both transcript alignments and nucleotide positions :")
-print(combined_data)
-# output_file = 'input_transcripts_alignments_and_nucleotide_positions.txt' 
-# combined_data.to_csv(output_file, sep='\t', index=False) 
+    # The data frames are only printed with --verbose : at scale, printing them takes longer than the mapping
 
+    parser = argparse.ArgumentParser(description='Maps the transcript positions to genome positions.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the intermediate data frames')
+    verbose = parser.parse_args().verbose
 
-# Applying the 1st function : transform_cigar()
 
+    # Verifying the entire pipeline on TR1 :
 
-combined_data["transformed_string"] = combined_data["cigar_string"].apply(transform_cigar) 
-# print(combined_data)
+    print("Verifying the entire pipeline on TR1 :")
+    position_start_transcript_on_genome = 3  # The index of the genome sequence that coincides with the transcript_start
 
+    transformed_string = transform_cigar("8M7D6M2I2M11D7M")
+    print(transformed_string)
+    nucleotide_number = 19                         # the NUCLEOTIDE NUMBER in the original transcript
+    transcript_position = nucleotide_number        # to make it equivalent with the INDEX
 
-# Applying the 2nd function : find_transcript_index()
-# Apply the second function with additional argument using a lambda function
+    index = find_transcript_index(transformed_string, transcript_position)
+    print(f'Nucleotide number {nucleotide_number} corresponds to index {index} on the expanded CIGAR string.')
+    transcript_string_modified_string = transformed_string
+    transcript_position_modified_string = index    
 
+    genome_position = calculate_genome_position(transcript_string_modified_string, index, position_start_transcript_on_genome)
+    print(f'Nucleotide number {transcript_position} corresponds to the genome index {genome_position}.')
 
-combined_data["index_in_transformed_string"] = combined_data.apply(
-    lambda row: find_transcript_index(row["transformed_string"], row["index_in_transcript"] + 1),
-    axis=1
-)
-# print(combined_data)
 
+    # Verifying the entire pipeline on TR2 :
 
-# Applying the 3rd function : calculate_genome_position()
+    print("Verifying the entire pipeline on TR2 :")
+    position_start_transcript_on_genome = 10 # The index of the genome sequence that coincides with the transcript_start
+    transformed_string = transform_cigar("20M")
+    print(transformed_string)
 
+    transcript_position = 11  # The nucleotide position in the original transcript that is mapped on expanded CIGAR string
+    index = find_transcript_index(transformed_string, transcript_position)
+    print(f'Nucleotide number {nucleotide_number} corresponds to index {index} on the expanded CIGAR string.')
+    transcript_string_modified_string = transformed_string
+    transcript_position_modified_string = index 
 
-combined_data["genome_index"] = combined_data.apply(
-    lambda row: calculate_genome_position(
-        row["transformed_string"],
-        row["index_in_transformed_string"]  ,
-        row["start_transcript_on_genome"]
-    ),
-    axis=1
-)
-print(combined_data)
+    genome_position = calculate_genome_position(transcript_string_modified_string, index, position_start_transcript_on_genome)
+    print(f'Nucleotide number {transcript_position} corresponds to the genome index {genome_position}.')
 
 
-# Printing the columns of interest on the screen and in a file :
 
-print("Results :")
-combined_data = combined_data.rename(columns={'index_in_transcript': 'transcript_index'})
-print(combined_data.loc[:, ["transcript_name", "transcript_index", "chromosome", "genome_index"]])
+    # Read both files, map the positions and write the results
 
-combined_data[["transcript_name", "transcript_index", "chromosome", "genome_index"]].to_csv("output_genome_positions.txt", sep='\t', index=False)
\ No newline at end of file
+    run_pipeline('input_transcripts_alignments.txt', 'input_transcripts_positions.txt', "output_genome_positions.txt",
+                 verbose=verbose)